@@ -36,7 +36,9 @@ setup(
         'openai==2.14.0',
         'sortedcontainers==2.4.0',
         'langdetect==1.0.9',
+        'numpy==2.5.4',
         'ollama==0.6.1',
+        'httpx==0.28.1',
     ],
     extras_require={
         'dev': [
@@ -1,3 +1,7 @@
+import asyncio
+import urllib.parse
+
+import httpx
 import pytest
 
 from lsprotocol.types import Range, Position
@@ -168,3 +172,24 @@ def test_analyses(doc, analyses, text_sections, exp, analyser):
     res_diag, res_action = analyser._handle_analyses(doc, analyses, text_sections)
 
     assert [diag.range for diag in res_diag] == exp
+
+
+def test_analyse_text(analyser, monkeypatch):
+    monkeypatch.setattr(GrammarBotAnalyser, 'CHARACTER_LIMIT_MAX', 30)
+    monkeypatch.setattr(GrammarBotAnalyser, 'CHARACTER_LIMIT_MIN', 20)
+    text = 'This is a sentence. ' * 5
+
+    def handle(request):
+        span = urllib.parse.parse_qs(request.content.decode())['text'][0]
+        return httpx.Response(
+            200,
+            json={'matches': [{'offset': span.index('sentence'), 'length': 8}]},
+            headers={'X-RateLimit-Requests-Remaining': '100'},
+        )
+
+    analyser._client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    res = asyncio.run(analyser._analyse_text(text))
+
+    assert len(res) > 1
+    for match in res:
+        assert text[match['offset']:match['offset']+match['length']] == 'sentence'
@@ -0,0 +1,491 @@
+import asyncio
+import re
+import threading
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from lsprotocol.types import (
+    DidChangeTextDocumentParams,
+    DidOpenTextDocumentParams,
+    Diagnostic,
+    Position,
+    Range,
+    TextDocumentContentChangePartial,
+    TextDocumentItem,
+    VersionedTextDocumentIdentifier,
+)
+
+from textLSP.analysers.analyser import Analyser, PersistentResultCache
+from textLSP.analysers import analyser as analyser_module
+from textLSP.analysers.handler import AnalyserHandler
+from textLSP.documents.document import BaseDocument
+from textLSP.types import Interval
+
+
+class AsyncDummyAnalyser(Analyser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checked_changes = list()
+        self.delay = 0
+        self.started = threading.Event()
+
+    def _did_open(self, doc):
+        pass
+
+    def _get_diagnostics(self, doc, changes):
+        return [
+            Diagnostic(
+                range=doc.range_at_offset(change.start, change.length),
+                message=str(doc.version),
+            )
+            for change in changes
+        ]
+
+    async def _did_change(self, doc, changes):
+        self.checked_changes.append(changes)
+        self.started.set()
+        await asyncio.sleep(self.delay)
+        self.add_diagnostics(doc, self._get_diagnostics(doc, changes))
+
+
+class ThreadDummyAnalyser(AsyncDummyAnalyser):
+    def _did_change(self, doc, changes):
+        self.checked_changes.append(changes)
+        self.started.set()
+        time.sleep(self.delay)
+        self.add_diagnostics(doc, self._get_diagnostics(doc, changes))
+
+
+def _mistake_diagnostics(self, doc, changes):
+    return [
+        Diagnostic(
+            range=doc.range_at_offset(change.start + match.start(), len(match.group()), True),
+            message='mistake',
+        )
+        for change in changes
+        for match in re.finditer(
+            'mistake',
+            doc.text_at_offset(change.start, change.length, True),
+        )
+    ]
+
+
+class AsyncMistakeAnalyser(AsyncDummyAnalyser):
+    _get_diagnostics = _mistake_diagnostics
+
+
+class ThreadMistakeAnalyser(ThreadDummyAnalyser):
+    _get_diagnostics = _mistake_diagnostics
+
+
+class DummyWorkDoneProgress():
+    def __init__(self):
+        self.tokens = dict()
+
+    def create(self, *args, **kwargs):
+        pass
+
+    def begin(self, *args, **kwargs):
+        pass
+
+    def end(self, *args, **kwargs):
+        pass
+
+
+def _language_server(doc, published):
+    ls = SimpleNamespace(
+        workspace=SimpleNamespace(get_text_document=lambda uri: doc),
+        work_done_progress=DummyWorkDoneProgress(),
+        # versions of the documents of the published diagnostics
+        publish_stored_diagnostics=lambda doc: published.append(doc.version),
+        window_show_message=lambda params: None,
+    )
+    ls.analyser_handler = AnalyserHandler(ls)
+    return ls
+
+
+async def _change(handler, doc, text):
+    # as done by the workspace before the notification is handled
+    change = TextDocumentContentChangePartial(
+        range=Range(
+            start=doc.last_position(),
+            end=doc.last_position(),
+        ),
+        text=text,
+    )
+    doc.apply_change(change)
+    doc.version += 1
+    handler.update_document(doc, change)
+    return asyncio.create_task(handler.did_change(
+        DidChangeTextDocumentParams(
+            text_document=VersionedTextDocumentIdentifier(
+                uri=doc.uri,
+                version=doc.version,
+            ),
+            content_changes=[change],
+        )
+    ))
+
+
+@pytest.mark.parametrize('analyser_class', [
+    AsyncDummyAnalyser,
+    ThreadDummyAnalyser,
+])
+def test_debounced_changes(analyser_class):
+    doc = BaseDocument('DUMMY_URL', 'This is a sentence.', version=0)
+    published = list()
+    ls = _language_server(doc, published)
+    handler = ls.analyser_handler
+    analyser = analyser_class(
+        ls,
+        {
+            Analyser.CONFIGURATION_CHECK: {Analyser.CONFIGURATION_CHECK_ON_CHANGE: True},
+            Analyser.CONFIGURATION_DEBOUNCE: 0.05,
+        },
+        'dummy',
+    )
+    handler.analysers['dummy'] = analyser
+
+    async def wait_started():
+        await asyncio.get_running_loop().run_in_executor(None, analyser.started.wait)
+        analyser.started.clear()
+
+    async def run():
+        await handler.did_open(DidOpenTextDocumentParams(
+            TextDocumentItem(uri=doc.uri, language_id='txt', version=0, text=doc.source),
+        ))
+
+        # changes within the debounce time are checked together
+        for text in [' Word', 's', '.']:
+            await _change(handler, doc, text)
+            await asyncio.sleep(0.01)
+        await wait_started()
+        assert len(analyser.checked_changes) == 1
+        await asyncio.gather(*handler._change_checks.get(doc.uri, dict()).values())
+        assert published == [3]
+
+        # a change during a check makes its results outdated
+        analyser.delay = 0.1
+        await _change(handler, doc, ' Again')
+        await wait_started()
+        task = await _change(handler, doc, '.')
+        await task
+        analyser.delay = 0
+        await asyncio.gather(*handler._change_checks.get(doc.uri, dict()).values())
+
+        assert len(analyser.checked_changes) == 3
+        assert published == [3, 5]
+        assert [diag.message for diag in analyser.get_diagnostics(doc)] == ['3', '5']
+        # the dropped changes are checked again
+        last_change = analyser.checked_changes[-1][0]
+        assert doc.source[last_change.start:last_change.start+last_change.length] == ' Again.'
+
+    asyncio.run(run())
+    handler.shutdown()
+
+
+@pytest.mark.parametrize('analyser_class', [
+    AsyncDummyAnalyser,
+    ThreadDummyAnalyser,
+])
+def test_visible_ranges_first(analyser_class, monkeypatch):
+    monkeypatch.setattr(Analyser, 'PRIORITY_CHUNK_SIZE', 50)
+    doc = BaseDocument(
+        'DUMMY_URL',
+        ''.join(f'This is paragraph {idx}.\n\n' for idx in range(40)),
+        version=0,
+    )
+    published = list()
+    ls = _language_server(doc, published)
+    handler = ls.analyser_handler
+    analyser = analyser_class(ls, dict(), 'dummy')
+    handler.analysers['dummy'] = analyser
+
+    async def run():
+        await handler.did_change_visible_ranges(
+            doc.uri,
+            [Range(
+                start=Position(line=30, character=0),
+                end=Position(line=40, character=0),
+            )],
+            Position(line=36, character=0),
+        )
+        await handler.did_open(DidOpenTextDocumentParams(
+            TextDocumentItem(uri=doc.uri, language_id='txt', version=0, text=doc.source),
+        ))
+        # the rest is checked in the background
+        assert len(handler._background_checks[doc.uri]) == 1
+        await asyncio.gather(*[
+            task
+            for task, _ in handler._background_checks.get(doc.uri, dict()).values()
+        ])
+
+    asyncio.run(run())
+    handler.shutdown()
+
+    ranges = [
+        doc.range_at_offset(changes[0].start, changes[0].length, True)
+        for changes in analyser.checked_changes
+    ]
+    # each chunk is published once checked
+    assert len(ranges) > 3
+    assert len(published) == len(ranges)
+    # the chunks cover the document without overlapping
+    lines = sorted((pos_range.start.line, pos_range.end.line) for pos_range in ranges)
+    assert lines[0][0] == 0
+    assert lines[-1][1] >= 79
+    for (_, end), (start, _) in zip(lines, lines[1:]):
+        assert end <= start <= end + 1
+    # the cursor first, then the visible ones, then the rest by distance
+    assert ranges[0].start.line <= 36 <= ranges[0].end.line
+    distances = [
+        max(0, 30 - pos_range.end.line, pos_range.start.line - 40)
+        for pos_range in ranges[1:]
+    ]
+    assert distances == sorted(distances)
+    assert distances[0] == 0
+
+
+@pytest.mark.parametrize('analyser_class', [
+    AsyncMistakeAnalyser,
+    ThreadMistakeAnalyser,
+])
+def test_background_checks(analyser_class, monkeypatch):
+    monkeypatch.setattr(Analyser, 'PRIORITY_CHUNK_SIZE', 50)
+    doc = BaseDocument(
+        'DUMMY_URL',
+        ''.join(f'Paragraph {idx} has a mistake.\n\n' for idx in range(40)),
+        version=0,
+    )
+    published = list()
+    ls = _language_server(doc, published)
+    handler = ls.analyser_handler
+    analyser = analyser_class(
+        ls,
+        {
+            Analyser.CONFIGURATION_CHECK: {Analyser.CONFIGURATION_CHECK_ON_CHANGE: True},
+            Analyser.CONFIGURATION_DEBOUNCE: 0.05,
+        },
+        'dummy',
+    )
+    analyser.delay = 0.02
+    handler.analysers['dummy'] = analyser
+
+    async def run():
+        await handler.did_change_visible_ranges(
+            doc.uri,
+            [Range(
+                start=Position(line=0, character=0),
+                end=Position(line=10, character=0),
+            )],
+            Position(line=4, character=0),
+        )
+        await handler.did_open(DidOpenTextDocumentParams(
+            TextDocumentItem(uri=doc.uri, language_id='txt', version=0, text=doc.source),
+        ))
+        # the lock of the document is not held by the background checks
+        assert len(handler._background_checks[doc.uri]) == 1
+        assert not handler._document_locks[doc.uri].locked()
+        await asyncio.sleep(0.05)
+
+        # a change cancels the background checks
+        await (await _change(handler, doc, 'This is paragraph 40.'))
+        assert doc.uri not in handler._background_checks
+        num_checked = len(analyser.checked_changes)
+        # ... which are resumed once the document did not change
+        await asyncio.gather(*handler._change_checks.get(doc.uri, dict()).values())
+        await asyncio.gather(*[
+            task
+            for task, _ in handler._background_checks.get(doc.uri, dict()).values()
+        ])
+        assert len(analyser.checked_changes) > num_checked
+
+    asyncio.run(run())
+    handler.shutdown()
+
+    # each paragraph was checked or taken from the result cache
+    assert not handler._interrupted_checks.get(doc.uri)
+    assert len(analyser.get_diagnostics(doc)._positions) == 40
+    analyser._schedule_document_checks(doc)
+    assert analyser.pop_scheduled_checks() == list()
+    assert published[-1] == doc.version
+
+
+@pytest.mark.parametrize('analyser_class', [
+    AsyncMistakeAnalyser,
+    ThreadMistakeAnalyser,
+])
+def test_result_cache(analyser_class, monkeypatch):
+    monkeypatch.setattr(Analyser, 'PRIORITY_CHUNK_SIZE', 50)
+    paragraphs = [
+        f'Paragraph {idx} has a mistake.' if idx % 2 else f'Paragraph {idx} is fine.'
+        for idx in range(10)
+    ]
+    doc = BaseDocument('DUMMY_URL', '\n\n'.join(paragraphs), version=0)
+    published = list()
+    ls = _language_server(doc, published)
+    handler = ls.analyser_handler
+    analyser = analyser_class(ls, dict(), 'dummy')
+    handler.analysers['dummy'] = analyser
+
+    async def run(doc):
+        await handler.did_open(DidOpenTextDocumentParams(
+            TextDocumentItem(uri=doc.uri, language_id='txt', version=doc.version, text=doc.source),
+        ))
+
+    asyncio.run(run(doc))
+    assert len(analyser.get_diagnostics(doc)._positions) == 5
+
+    # the first paragraph is edited, which shifts the others
+    paragraphs[0] = 'The first paragraph has a mistake.'
+    doc = BaseDocument('DUMMY_URL', '\n\n'.join(paragraphs), version=1)
+    ls.workspace.get_text_document = lambda uri: doc
+    analyser.checked_changes.clear()
+    misses = analyser._result_cache.misses
+    asyncio.run(run(doc))
+    handler.shutdown()
+
+    assert len(analyser.checked_changes) == 1
+    changes = analyser.checked_changes[0]
+    assert len(changes) == 1
+    assert doc.text_at_offset(changes[0].start, changes[0].length, True).strip() == paragraphs[0]
+    assert analyser._result_cache.misses - misses == 1
+
+    expected = _mistake_diagnostics(
+        analyser,
+        doc,
+        [Interval(0, len(doc.cleaned_source))],
+    )
+    assert [diag.range for diag in analyser.get_diagnostics(doc)] == [
+        diag.range for diag in expected
+    ]
+
+
+@pytest.mark.parametrize('analyser_class', [
+    AsyncMistakeAnalyser,
+    ThreadMistakeAnalyser,
+])
+def test_persistent_result_cache(analyser_class, tmp_path, monkeypatch):
+    monkeypatch.setattr(Analyser, 'PRIORITY_CHUNK_SIZE', 50)
+    doc = BaseDocument(
+        'DUMMY_URL',
+        '\n\n'.join(f'Paragraph {idx} has a mistake.' for idx in range(5)),
+        version=0,
+    )
+    file_path = str(tmp_path / 'results.sqlite')
+    threads = list()
+    connect = PersistentResultCache._connect
+
+    def _connect(self):
+        threads.append(threading.current_thread().name)
+        return connect(self)
+
+    monkeypatch.setattr(PersistentResultCache, '_connect', _connect)
+    config = {
+        Analyser.CONFIGURATION_PERSISTENT_RESULT_CACHE: True,
+        Analyser.CONFIGURATION_PERSISTENT_RESULT_CACHE_PATH: file_path,
+    }
+
+    def open_document():
+        # a new server after a restart
+        ls = _language_server(doc, list())
+        handler = ls.analyser_handler
+        analyser = analyser_class(ls, config, 'dummy')
+        handler.analysers['dummy'] = analyser
+        asyncio.run(handler.did_open(DidOpenTextDocumentParams(
+            TextDocumentItem(uri=doc.uri, language_id='txt', version=0, text=doc.source),
+        )))
+        handler.shutdown()
+        analyser.close()
+        return analyser
+
+    analyser = open_document()
+    assert len(analyser.checked_changes) > 0
+    expected = [diag.range for diag in analyser.get_diagnostics(doc)]
+    assert len(expected) == 5
+
+    analyser = open_document()
+    assert len(analyser.checked_changes) == 0
+    assert [diag.range for diag in analyser.get_diagnostics(doc)] == expected
+    # the database is not accessed by the event loop or the checks
+    assert len(threads) > 0
+    assert all(name.startswith('textLSP-result-cache') for name in threads)
+
+    # the least recently used results are removed
+    cache = PersistentResultCache(file_path, max_items=2)
+    cache.store([('key1', tuple()), ('key2', tuple())])
+    assert set(cache.load(['key1']).result()) == {'key1'}
+    cache.store([('key3', tuple())])
+    assert set(cache.load(['key1', 'key2', 'key3']).result()) == {'key1', 'key3'}
+    cache.close()
+
+
+class ConcurrentDummyAnalyser(ThreadDummyAnalyser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def _did_change(self, doc, changes):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        super()._did_change(doc, changes)
+
+
+@pytest.mark.parametrize('concurrency', [1, 3])
+def test_concurrency(concurrency, monkeypatch):
+    monkeypatch.setattr(Analyser, 'PRIORITY_CHUNK_SIZE', 50)
+    doc = BaseDocument(
+        'DUMMY_URL',
+        ''.join(f'This is paragraph {idx}.\n\n' for idx in range(20)),
+        version=0,
+    )
+    ls = _language_server(doc, list())
+    handler = ls.analyser_handler
+    analyser = ConcurrentDummyAnalyser(
+        ls,
+        {Analyser.CONFIGURATION_CONCURRENCY: concurrency},
+        'dummy',
+    )
+    handler.analysers['dummy'] = analyser
+
+    asyncio.run(handler.did_open(DidOpenTextDocumentParams(
+        TextDocumentItem(uri=doc.uri, language_id='txt', version=0, text=doc.source),
+    )))
+    handler.shutdown()
+
+    # the chunks of a single event run concurrently
+    assert len(analyser.checked_changes) > concurrency
+    assert analyser.max_running == concurrency
+
+
+def test_stopped_loop(monkeypatch):
+    monkeypatch.setattr(analyser_module, 'LOOP_CALL_POLL_INTERVAL', 0.01)
+    doc = BaseDocument('DUMMY_URL', 'This is a sentence.', version=0)
+    ls = _language_server(doc, list())
+    analyser = ThreadDummyAnalyser(ls, dict(), 'dummy')
+    analyser.init_document_items(doc)
+
+    # e.g. the server is shutting down
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(
+        target=analyser.run_check,
+        args=(loop, analyser._did_change, (doc, [Interval(0, 4)])),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(timeout=5)
+    loop.close()
+
+    # the worker thread does not wait for the loop
+    assert not thread.is_alive()
+    assert len(analyser.checked_changes) == 1
+    assert len(analyser.get_diagnostics(doc)._positions) == 0
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from textLSP.analysers.openai import OpenAIAnalyser
@@ -15,9 +17,9 @@ def analyser():
 
 def test_edit(analyser):
     with pytest.raises(AuthenticationError):
-        analyser._edit('This is as santance.')
+        asyncio.run(analyser._edit('This is as santance.'))
 
 
 def test_generate(analyser):
     with pytest.raises(AuthenticationError):
-        analyser._generate('Write me a sentence:')
+        asyncio.run(analyser._generate('Write me a sentence:'))
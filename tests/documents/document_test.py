@@ -1,3 +1,5 @@
+import random
+
 import pytest
 
 from lsprotocol.types import (
@@ -7,7 +9,7 @@ from lsprotocol.types import (
 )
 
 from textLSP.types import Interval
-from textLSP.documents.document import BaseDocument, ChangeTracker
+from textLSP.documents.document import BaseDocument, ChangeJournal, ChangeTracker
 
 
 @pytest.mark.parametrize('content,position,exp', [
@@ -255,8 +257,7 @@ def test_get_sentence_at_offset(content, offset, length, exp):
             ),
         ],
         [
-            Interval(24, 1),
-            Interval(25, 1),
+            Interval(24, 2),
         ],
     ),
     (
@@ -296,8 +297,7 @@ def test_get_sentence_at_offset(content, offset, length, exp):
             ),
         ],
         [
-            Interval(167, 1),
-            Interval(168, 1),
+            Interval(167, 2),
         ],
     ),
     (
@@ -350,7 +350,7 @@ def test_get_sentence_at_offset(content, offset, length, exp):
             ),
         ],
         [
-            Interval(168, 1),
+            Interval(169, 1),
         ],
     ),
     (
@@ -404,9 +404,7 @@ def test_get_sentence_at_offset(content, offset, length, exp):
             ),
         ],
         [
-            Interval(169, 1),
-            Interval(170, 1),
-            Interval(171, 1),
+            Interval(169, 3),
         ],
     ),
     (
@@ -440,8 +438,7 @@ def test_get_sentence_at_offset(content, offset, length, exp):
             ),
         ],
         [
-            Interval(19, 20),
-            Interval(39, 21),
+            Interval(19, 41),
         ],
     ),
     (
@@ -517,7 +514,7 @@ def test_get_sentence_at_offset(content, offset, length, exp):
             ),
         ],
         [
-            Interval(18, 1),
+            Interval(19, 1),
         ],
     ),
 ])
@@ -532,6 +529,283 @@ def test_updates(content, edits, exp):
     assert tracker.get_changes() == exp
 
 
+def _insertion(line, character, text):
+    return TextDocumentContentChangePartial(
+        range=Range(
+            start=Position(line=line, character=character),
+            end=Position(line=line, character=character),
+        ),
+        text=text,
+    )
+
+
+def test_shared_change_journal():
+    doc = BaseDocument(
+        'DUMMY_URL',
+        'This is a sentence.\n'
+        'This is a sentence.\n',
+    )
+    journal = ChangeJournal(doc, True)
+    tracker1 = ChangeTracker(doc, True, journal)
+    tracker2 = ChangeTracker(doc, True, journal)
+
+    for edit in [_insertion(0, 4, 'X'), _insertion(1, 4, 'Y')]:
+        doc.apply_change(edit)
+        journal.update_document(edit, doc)
+    assert tracker1.get_changes() == [Interval(4, 1), Interval(25, 1)]
+
+    tracker1.reset()
+    assert len(tracker1) == 0
+    assert len(journal.get_entries(0)) == 2
+
+    edit = _insertion(0, 5, 'Z')
+    doc.apply_change(edit)
+    journal.update_document(edit, doc)
+    assert tracker1.get_changes() == [Interval(5, 1)]
+    assert tracker2.get_changes() == [Interval(4, 2), Interval(26, 1)]
+
+    tracker1.reset()
+    tracker2.reset()
+    assert len(journal.get_entries(journal.end)) == 0
+    assert journal._base == journal.end
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_change_tracker_coalescing(seed):
+    rng = random.Random(seed)
+    content = ''.join(rng.choice(['ab', 'c', ' ', '\n']) for _ in range(30))
+    doc = BaseDocument('DUMMY_URL', content)
+    tracker = ChangeTracker(doc)
+    # inserted and deleted-before characters marked as changed
+    changed = [False] * len(content)
+
+    for _ in range(10):
+        start = rng.randint(0, len(doc.source))
+        end = rng.randint(start, min(len(doc.source), start + 3))
+        text = rng.choice(['', 'x', 'yz\n'])
+        source = doc.source
+        edit = TextDocumentContentChangePartial(
+            range=Range(
+                start=Position(
+                    line=source.count('\n', 0, start),
+                    character=start - source.rfind('\n', 0, start) - 1,
+                ),
+                end=Position(
+                    line=source.count('\n', 0, end),
+                    character=end - source.rfind('\n', 0, end) - 1,
+                ),
+            ),
+            text=text,
+        )
+        doc.apply_change(edit)
+        tracker.update_document(edit, doc)
+        if start == end and len(text) == 0:
+            continue
+        changed[start:end] = [True] * len(text)
+        if len(text) == 0 and start > 0:
+            changed[start-1] = True
+
+    exp = list()
+    for idx, is_changed in enumerate(changed):
+        if not is_changed:
+            continue
+        if len(exp) > 0 and exp[-1].start + exp[-1].length == idx:
+            exp[-1] = Interval(exp[-1].start, exp[-1].length+1)
+        else:
+            exp.append(Interval(idx, 1))
+
+    assert [
+        interval
+        for interval in tracker.get_changes()
+        if interval.length > 0
+    ] == exp
+
+
+@pytest.mark.parametrize('content,edits,offset,length,exp', [
+    (
+        'This is a sentence.\n'
+        'This is another sentence.\n',
+        [],
+        28,
+        7,
+        Range(
+            start=Position(line=1, character=8),
+            end=Position(line=1, character=14),
+        ),
+    ),
+    (
+        'This is a sentence.\n'
+        'This is another sentence.\n',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=0),
+                    end=Position(line=0, character=0),
+                ),
+                text='A new line.\n',
+            ),
+        ],
+        40,
+        7,
+        Range(
+            start=Position(line=2, character=8),
+            end=Position(line=2, character=14),
+        ),
+    ),
+    (
+        'This is a sentence.\n'
+        'This is another sentence.\n',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=18),
+                    end=Position(line=1, character=0),
+                ),
+                text=' and ',
+            ),
+        ],
+        23,
+        22,
+        Range(
+            start=Position(line=0, character=23),
+            end=Position(line=0, character=44),
+        ),
+    ),
+])
+def test_range_at_offset_after_edits(content, edits, offset, length, exp):
+    doc = BaseDocument('DUMMY_URL', content)
+    # build the line index of the initial version
+    doc.range_at_offset(0, 1)
+
+    for edit in edits:
+        doc.apply_change(edit)
+
+    res = doc.range_at_offset(offset, length)
+    assert res == exp
+    assert doc.offset_at_position(res.start) == offset
+    assert doc.offset_at_position(res.end) == offset + length - 1
+
+
+@pytest.mark.parametrize('content,edits', [
+    (
+        'This is a sentence.\n'
+        'This is another sentence.\n',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=0),
+                    end=Position(line=0, character=0),
+                ),
+                text='A new line.\n',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=1, character=18),
+                    end=Position(line=2, character=4),
+                ),
+                text=' And',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=2, character=0),
+                    end=Position(line=2, character=0),
+                ),
+                text='The end.',
+            ),
+        ],
+    ),
+    (
+        'This is a sentence.\r\n'
+        'This is another sentence.\r\n',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=0),
+                    end=Position(line=0, character=0),
+                ),
+                text='A new line.\r\n',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=1, character=18),
+                    end=Position(line=2, character=4),
+                ),
+                text=' And',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=2, character=0),
+                    end=Position(line=2, character=0),
+                ),
+                text='The end.',
+            ),
+        ],
+    ),
+])
+def test_rope_source(content, edits):
+    doc = BaseDocument('DUMMY_URL', content)
+    rope_doc = BaseDocument(
+        'DUMMY_URL',
+        content,
+        config={BaseDocument.CONFIGURATION_ROPE: True},
+    )
+
+    for edit in edits:
+        doc.apply_change(edit)
+        rope_doc.apply_change(edit)
+        # edits do not materialise the rope
+        assert rope_doc._rope._text is None
+        assert not rope_doc._rope.has_irregular_line_breaks
+
+        assert rope_doc.source == doc.source
+        assert rope_doc.lines == doc.lines
+
+
+@pytest.mark.parametrize('content,edits', [
+    (
+        'This is a sentence. This is another one.\n'
+        '\n'
+        'This is a new paragraph!\n',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=18),
+                    end=Position(line=0, character=19),
+                ),
+                text='\n\nHere',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=3, character=0),
+                    end=Position(line=4, character=0),
+                ),
+                text='',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=3, character=24),
+                    end=Position(line=3, character=24),
+                ),
+                text=' Are we done? Yes.',
+            ),
+        ],
+    ),
+])
+def test_boundaries_after_edits(content, edits):
+    doc = BaseDocument('DUMMY_URL', content)
+    # build the boundary index of the initial version
+    doc.paragraph_at_offset(0)
+    doc.sentence_at_offset(0)
+
+    for edit in edits:
+        doc.apply_change(edit)
+
+        fresh_doc = BaseDocument('DUMMY_URL', doc.source)
+        for offset in range(len(doc.source)):
+            assert doc.paragraph_at_offset(offset) == fresh_doc.paragraph_at_offset(offset)
+            assert doc.sentence_at_offset(offset) == fresh_doc.sentence_at_offset(offset)
+
+
 @pytest.mark.parametrize(
     "content,lang,exp",
     [
@@ -553,3 +827,157 @@ def test_document_language(content, lang, exp):
     doc = BaseDocument("DUMMY_URL", content, config=config)
 
     assert doc.language == exp
+
+
+MIXED_LANGUAGE_CONTENT = (
+    'This is an English paragraph. It has more than twenty characters in it.\n'
+    '\n'
+    'Das ist ein deutscher Absatz. Er enthält mehr als zwanzig Zeichen.\n'
+    '\n'
+    'Ceci est un paragraphe français. Il contient plus de vingt caractères.\n'
+    '\n'
+    'Short one.\n'
+)
+
+
+@pytest.mark.parametrize('lang,interval,exp', [
+    ('auto', Interval(10, 5), 'en'),
+    ('auto', Interval(80, 5), 'de'),
+    ('auto', Interval(150, 5), 'fr'),
+    # mostly German
+    ('auto', Interval(65, 60), 'de'),
+    # too short, falls back to the document language
+    ('auto:de', Interval(215, 3), None),
+    ('de', Interval(10, 5), 'de'),
+])
+def test_language_at_interval(lang, interval, exp):
+    doc = BaseDocument(
+        'DUMMY_URL',
+        MIXED_LANGUAGE_CONTENT,
+        config={BaseDocument.CONFIGURATION_LANGUAGE: lang},
+    )
+    if exp is None:
+        exp = doc.language
+
+    assert doc.language_at_interval(interval) == exp
+
+
+def test_language_at_interval_cache(monkeypatch):
+    detected = list()
+    detect = BaseDocument._detect_language
+
+    def _detect(self, text):
+        detected.append(text)
+        return detect(self, text)
+
+    monkeypatch.setattr(BaseDocument, '_detect_language', _detect)
+    doc = BaseDocument(
+        'DUMMY_URL',
+        MIXED_LANGUAGE_CONTENT,
+        config={BaseDocument.CONFIGURATION_LANGUAGE: 'auto'},
+    )
+    for offset in [10, 80, 150]:
+        doc.language_at_interval(Interval(offset, 1))
+    assert len(detected) == 3
+
+    doc.apply_change(
+        TextDocumentContentChangePartial(
+            range=Range(
+                start=Position(line=2, character=4),
+                end=Position(line=2, character=4),
+            ),
+            text='wirklich ',
+        ),
+    )
+    for offset in [10, 80, 160]:
+        doc.language_at_interval(Interval(offset, 1))
+    assert len(detected) == 4
+    assert detected[-1].startswith('Das wirklich ist')
+
+
+@pytest.mark.parametrize('content,position_range,exp', [
+    (
+        'This is a sentence.\n'
+        '\n'
+        'This is a paragraph.\n'
+        'This is its second line.\n'
+        '\n'
+        'This is the last paragraph.',
+        Range(
+            start=Position(line=3, character=5),
+            end=Position(line=3, character=5),
+        ),
+        Range(
+            start=Position(line=2, character=0),
+            end=Position(line=5, character=0),
+        ),
+    ),
+    (
+        'This is a sentence.\n'
+        '\n'
+        'This is a paragraph.\n'
+        'This is its second line.\n'
+        '\n'
+        'This is the last paragraph.',
+        Range(
+            start=Position(line=0, character=5),
+            end=Position(line=5, character=0),
+        ),
+        Range(
+            start=Position(line=0, character=0),
+            end=Position(line=6, character=0),
+        ),
+    ),
+    (
+        'Line one.\n'
+        'Line two.\n'
+        'Line three.\n'
+        'Line four.\n'
+        'Line five.\n',
+        Range(
+            start=Position(line=2, character=0),
+            end=Position(line=2, character=0),
+        ),
+        Range(
+            start=Position(line=1, character=0),
+            end=Position(line=4, character=0),
+        ),
+    ),
+])
+def test_get_region(content, position_range, exp, monkeypatch):
+    monkeypatch.setattr(BaseDocument, 'REGION_MAX_CONTEXT_LINES', 1)
+    doc = BaseDocument('DUMMY_URL', content)
+    region_range, region = doc.get_region(position_range)
+
+    assert region_range == exp
+    lines = region.lines
+    for idx in range(exp.start.line):
+        assert lines[idx] == '\n'
+    for idx in range(exp.start.line, exp.end.line):
+        assert lines[idx] == doc.lines[idx]
+    assert len(lines) == exp.end.line
+
+
+@pytest.mark.parametrize('content', [
+    'This is a sentence.\n'
+    '\n'
+    'This is a paragraph.\r\n'
+    'é😋 is its second line.',
+    'Ends with a newline.\n\n',
+    '',
+])
+def test_ranges_at_offsets(content):
+    doc = BaseDocument('DUMMY_URL', content)
+    offsets = list()
+    lengths = list()
+    for offset in range(len(content)):
+        for length in range(len(content)-offset+1):
+            offsets.append(offset)
+            lengths.append(length)
+    offsets.append(len(content))
+    lengths.append(0)
+
+    assert doc.ranges_at_offsets(offsets, lengths) == [
+        doc.range_at_offset(offset, length)
+        for offset, length in zip(offsets, lengths)
+    ]
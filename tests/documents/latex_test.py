@@ -377,8 +377,7 @@ def test_get_paragraphs_at_range(content, range, exp):
             ),
         ],
         [
-            Interval(3, 1),
-            Interval(4, 1),
+            Interval(3, 2),
         ],
     ),
     (
@@ -421,8 +420,7 @@ def test_get_paragraphs_at_range(content, range, exp):
             ),
         ],
         [
-            Interval(31, 1),
-            Interval(32, 1),
+            Interval(31, 2),
         ],
     ),
     (
@@ -508,9 +506,7 @@ def test_get_paragraphs_at_range(content, range, exp):
             ),
         ],
         [
-            Interval(33, 1),
-            Interval(34, 1),
-            Interval(35, 1),
+            Interval(33, 3),
         ],
     ),
     (
@@ -567,9 +563,7 @@ def test_get_paragraphs_at_range(content, range, exp):
             ),
         ],
         [
-            Interval(33, 1),
-            Interval(34, 1),
-            Interval(35, 1),
+            Interval(33, 3),
         ],
     ),
     (
@@ -596,7 +590,7 @@ def test_get_paragraphs_at_range(content, range, exp):
             ),
         ],
         [
-            Interval(33, 16),
+            Interval(32, 1),
         ],
     ),
 ])
@@ -611,6 +605,70 @@ def test_change_tracker(content, edits, exp):
     assert tracker.get_changes() == exp
 
 
+def test_change_tracker_without_cleaning():
+    doc = LatexDocument(
+        'DUMMY_URL',
+        '\\section{Introduction}\n'
+        '\n'
+        'This is a \\textbf{sentence}.\n',
+    )
+    tracker = ChangeTracker(doc, True)
+    edit = TextDocumentContentChangePartial(
+        range=Range(
+            start=Position(line=2, character=18),
+            end=Position(line=2, character=18),
+        ),
+        text='long ',
+    )
+    doc.apply_change(edit)
+    tracker.update_document(edit, doc)
+    # the changes are recorded without cleaning the document
+    assert doc._cleaned_source is None
+
+    assert doc.cleaned_source == 'Introduction\n\nThis is a long sentence.\n'
+    assert tracker.get_changes() == [Interval(24, 5)]
+
+
+def test_rope_source():
+    content = (
+        '\\section{Introduction}\n'
+        '\n'
+        'This is a \\textbf{sentence}.\n'
+    )
+    doc = LatexDocument('DUMMY_URL', content)
+    rope_doc = LatexDocument(
+        'DUMMY_URL',
+        content,
+        config={LatexDocument.CONFIGURATION_ROPE: True},
+    )
+    for edit in [
+        TextDocumentContentChangePartial(
+            range=Range(
+                start=Position(line=2, character=18),
+                end=Position(line=2, character=18),
+            ),
+            text='long ',
+        ),
+        TextDocumentContentChangePartial(
+            range=Range(
+                start=Position(line=0, character=9),
+                end=Position(line=0, character=21),
+            ),
+            text='Start',
+        ),
+    ]:
+        assert rope_doc.cleaned_source == doc.cleaned_source
+        doc.apply_change(edit)
+        rope_doc.apply_change(edit)
+        # the rope is not used, edits keep the tree and the cleaned source
+        assert rope_doc._rope is None
+        assert rope_doc._tree is not None
+        assert rope_doc._cleaned_source is not None
+
+    assert rope_doc.cleaned_source == doc.cleaned_source
+    assert rope_doc.cleaned_source == 'Start\n\nThis is a long sentence.\n'
+
+
 @pytest.mark.parametrize('content,changes,exp,offset_test,position_test', [
     (
         '\\documentclass[11pt]{article}\n'
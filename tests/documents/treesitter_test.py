@@ -0,0 +1,609 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import copy
+import gc
+import json
+import os
+import random
+import threading
+import tracemalloc
+
+from types import SimpleNamespace
+
+import pytest
+
+from lsprotocol.types import (
+    Position,
+    Range,
+    TextDocumentContentChangePartial
+)
+from textLSP.documents.document import ChangeJournal, ChangeTracker, TreeSitterDocument
+from textLSP.documents.latex import LatexDocument
+from textLSP.documents.markdown import MarkDownDocument
+from textLSP.documents.org import OrgDocument
+from textLSP.utils import get_instance_lock
+
+
+TOKENS = {
+    LatexDocument: [
+        'word ', 'Word', '.', ',', '-', ' ', '\n', '\n\n', '\\section{Title}',
+        '\\textbf{bold}', '{', '}', '% comment\n',
+        '\\begin{itemize}\n\\item one\n\\end{itemize}',
+    ],
+    MarkDownDocument: [
+        'word ', 'Word', '.', ',', ' ', '\n', '\n\n', '# Title\n', '*em*',
+        '**b**', '`code`', '- item\n', '[l](u)', '> q\n', '===\n', '---\n',
+        '```\ncode\n```\n', '| a | b |\n',
+    ],
+    OrgDocument: [
+        'word ', 'Word', '.', ',', ' ', '\n', '\n\n', '* Heading\n',
+        '** Sub\n', '- item\n', '#+BEGIN_SRC\ncode\n#+END_SRC\n',
+        ':PROPERTIES:\n:END:\n',
+    ],
+}
+
+
+def _random_text(rng, doc_class, num_tokens):
+    return ''.join(rng.choice(TOKENS[doc_class]) for _ in range(num_tokens))
+
+
+def _position(text, offset):
+    return Position(
+        line=text.count('\n', 0, offset),
+        character=offset - text.rfind('\n', 0, offset) - 1,
+    )
+
+
+def _random_change(rng, doc_class, text):
+    start = rng.randint(0, len(text))
+    end = rng.randint(start, min(len(text), start + rng.choice([0, 0, 1, 3, 10])))
+    return TextDocumentContentChangePartial(
+        range=Range(
+            start=_position(text, start),
+            end=_position(text, end),
+        ),
+        text=_random_text(rng, doc_class, rng.choice([0, 1, 1, 2, 3])),
+    )
+
+
+def _is_run(doc, interval):
+    offset_start, offset_end, start_line, start_char, end_line, end_char = interval
+    return (
+        start_line == end_line
+        and end_char - start_char == offset_end - offset_start
+        and '\n' not in doc.cleaned_source[offset_start:offset_end+1]
+    )
+
+
+def _intervals(doc):
+    # runs of text are split at cleaning checkpoints, which depend on the
+    # edit history, so adjacent runs are merged before comparing
+    res = list()
+    for idx in range(len(doc._text_intervals)):
+        interval = list(doc._text_intervals.get_interval_values(idx)[:-1])
+        if (
+            len(res) > 0
+            and _is_run(doc, res[-1])
+            and _is_run(doc, interval)
+            and res[-1][4] == interval[2]
+            and res[-1][5] + 1 == interval[3]
+        ):
+            res[-1][1] = interval[1]
+            res[-1][5] = interval[5]
+        else:
+            res.append(interval)
+    return res
+
+
+@pytest.mark.parametrize('doc_class,seed', [
+    (doc_class, seed)
+    for doc_class in [LatexDocument, MarkDownDocument, OrgDocument]
+    for seed in range(20)
+])
+def test_incremental_cleaning(doc_class, seed, monkeypatch):
+    # frequent checkpoints and small windows to exercise resynchronization
+    monkeypatch.setattr(TreeSitterDocument, 'CHECKPOINT_STEP', 2)
+    monkeypatch.setattr(TreeSitterDocument, 'CAPTURE_WINDOW_LINES', 1)
+    rng = random.Random(seed)
+
+    doc = doc_class('DUMMY_URL', _random_text(rng, doc_class, rng.randint(0, 60)))
+    doc.cleaned_source
+    for _ in range(10):
+        doc.apply_change(_random_change(rng, doc_class, doc.source))
+        cleaned_source = doc.cleaned_source
+        intervals = _intervals(doc)
+
+        full_doc = doc_class(
+            'DUMMY_URL',
+            doc.source,
+            config={TreeSitterDocument.CONFIGURATION_REPARSE_ALL: True},
+        )
+        if full_doc.tree.root_node.sexp() != doc.tree.root_node.sexp():
+            # tree-sitter's error recovery can produce a different tree when
+            # reparsing incrementally, compare with the full cleaning of the
+            # same tree instead
+            full_doc = doc
+            doc._clean_source()
+
+        assert cleaned_source == full_doc.cleaned_source
+        assert intervals == _intervals(full_doc)
+
+
+@pytest.mark.parametrize('doc_class,paragraph', [
+    (
+        LatexDocument,
+        '\\section{Section}\n\n'
+        'This is a \\textbf{sentence} with some words, and more words.\n'
+        'Another sentence here.\n\n',
+    ),
+    (
+        MarkDownDocument,
+        '# Section\n\n'
+        'This is a **sentence** with some words, and more words.\n'
+        'Another sentence here.\n\n',
+    ),
+    (
+        OrgDocument,
+        '* Section\n\n'
+        'This is a *sentence* with some words, and more words.\n'
+        'Another sentence here.\n\n',
+    ),
+])
+def test_incremental_cleaning_latency(doc_class, paragraph, monkeypatch):
+    content = paragraph * 200
+    changes = [
+        TextDocumentContentChangePartial(
+            range=Range(
+                start=Position(line=line, character=4),
+                end=Position(line=line, character=4),
+            ),
+            text=' new',
+        )
+        for line in range(2, 1000, 50)
+    ]
+
+    parses = list()
+    captures = list()
+    parse_source = doc_class._parse_source
+    iterate_captures = doc_class._iterate_captures
+
+    def counting_parse_source(self):
+        parses.append(self)
+        return parse_source(self)
+
+    def counting_iterate_captures(self, start_point):
+        for capture in iterate_captures(self, start_point):
+            captures.append(capture)
+            yield capture
+
+    monkeypatch.setattr(doc_class, '_parse_source', counting_parse_source)
+    monkeypatch.setattr(doc_class, '_iterate_captures', counting_iterate_captures)
+
+    doc = doc_class('DUMMY_URL', content)
+    doc.cleaned_source
+    num_captures = len(captures)
+    assert len(parses) == 1
+
+    parses.clear()
+    captures.clear()
+    for change in changes:
+        doc.apply_change(change)
+        doc.cleaned_source
+
+    # the edits are parsed incrementally and only the captures around them
+    # are cleaned again
+    assert len(parses) == 0
+    assert len(captures) < num_captures
+    full_doc = doc_class(
+        'DUMMY_URL',
+        doc.source,
+        config={TreeSitterDocument.CONFIGURATION_REPARSE_ALL: True},
+    )
+    assert doc.cleaned_source == full_doc.cleaned_source
+
+
+@pytest.mark.parametrize('doc_class,paragraph', [
+    (
+        LatexDocument,
+        'This is a \\textbf{sentence} with some words, and more words.\n\n',
+    ),
+    (
+        MarkDownDocument,
+        'This is a **sentence** with some words, and more words.\n\n',
+    ),
+    (
+        OrgDocument,
+        'This is a *sentence* with some words, and more words.\n\n',
+    ),
+])
+def test_change_tracker_footprint(doc_class, paragraph):
+    content = paragraph * 500
+    doc = doc_class('DUMMY_URL', content)
+    doc.cleaned_source
+
+    tracemalloc.start()
+    # one tracker per analyser
+    journal = ChangeJournal(doc, True)
+    trackers = [ChangeTracker(doc, True, journal) for _ in range(3)]
+    for line in range(0, 1000, 50):
+        change = TextDocumentContentChangePartial(
+            range=Range(
+                start=Position(line=line, character=4),
+                end=Position(line=line, character=4),
+            ),
+            text=' new',
+        )
+        doc.apply_change(change)
+        journal.update_document(change, doc)
+
+    del doc
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the trackers don't keep a copy of the document
+    assert retained < len(content)
+    assert len(trackers[0].get_changes()) == 20
+
+
+@pytest.mark.parametrize('doc_class,seed', [
+    (doc_class, seed)
+    for doc_class in [LatexDocument, MarkDownDocument, OrgDocument]
+    for seed in range(5)
+])
+def test_ranges_at_offsets(doc_class, seed):
+    rng = random.Random(seed)
+    doc = doc_class('DUMMY_URL', _random_text(rng, doc_class, 100))
+
+    for cleaned in [False, True]:
+        length = len(doc.cleaned_source if cleaned else doc.source)
+        offsets = [rng.randint(0, length-1) for _ in range(100)]
+        lengths = [rng.randint(0, length-offset) for offset in offsets]
+        assert doc.ranges_at_offsets(offsets, lengths, cleaned) == [
+            doc.range_at_offset(offset, length, cleaned)
+            for offset, length in zip(offsets, lengths)
+        ]
+
+
+@pytest.mark.parametrize('doc_class', [
+    LatexDocument,
+    MarkDownDocument,
+    OrgDocument,
+])
+def test_shared_grammar(doc_class):
+    content = TOKENS[doc_class][0] * 10
+    docs = [doc_class(f'DUMMY_URL_{idx}', content) for idx in range(3)]
+    docs.append(copy.deepcopy(docs[0]))
+
+    grammar = docs[0]._grammar
+    for doc in docs:
+        assert doc._grammar is grammar
+        assert doc._query is grammar.query
+        assert doc.cleaned_source == docs[0].cleaned_source
+
+    # parsers are returned to the pool after each parse
+    with grammar.parser() as parser:
+        with grammar.parser() as other_parser:
+            assert parser is not other_parser
+    with grammar.parser() as reused_parser:
+        assert reused_parser in (parser, other_parser)
+
+
+@pytest.mark.parametrize('doc_class', [
+    LatexDocument,
+    MarkDownDocument,
+    OrgDocument,
+])
+def test_wait_cleaned_source(doc_class):
+    content = ''.join(TOKENS[doc_class]) * 50
+    doc = doc_class('DUMMY_URL', content)
+    exp_doc = doc_class('DUMMY_URL', 'Word ' + content)
+
+    async def clean():
+        waiters = [asyncio.create_task(doc.wait_cleaned_source()) for _ in range(2)]
+        await asyncio.sleep(0)
+        # the snapshot being cleaned becomes outdated
+        doc.apply_change(
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=0),
+                    end=Position(line=0, character=0),
+                ),
+                text='Word ',
+            )
+        )
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(clean()) == [exp_doc.cleaned_source] * 2
+    assert doc._cleaning is None
+    assert doc.cleaned_source == exp_doc.cleaned_source
+    for offset in range(0, len(exp_doc.cleaned_source) - 3, 7):
+        assert doc.range_at_offset(offset, 3, True) == exp_doc.range_at_offset(offset, 3, True)
+
+
+@pytest.mark.parametrize('doc_class,seed', [
+    (doc_class, seed)
+    for doc_class in [LatexDocument, MarkDownDocument, OrgDocument]
+    for seed in range(3)
+])
+def test_snapshot(doc_class, seed):
+    rng = random.Random(seed)
+    content = _random_text(rng, doc_class, 200)
+    doc = doc_class('DUMMY_URL', content)
+    doc.cleaned_source
+    snapshot = doc.get_snapshot()
+
+    # incremental cleaning of the document edits its intervals in place
+    for _ in range(10):
+        doc.apply_change(_random_change(rng, doc_class, doc.source))
+        doc.cleaned_source
+
+    exp_doc = doc_class('DUMMY_URL', content)
+    assert snapshot.source == content
+    assert snapshot.cleaned_source == exp_doc.cleaned_source
+    assert _intervals(snapshot) == _intervals(exp_doc)
+
+
+@pytest.mark.parametrize('doc_class,section', [
+    (
+        LatexDocument,
+        '\\section{Title}\n\nThis is \\textbf{a} paragraph.\nIt has two lines.\n\n',
+    ),
+    (
+        MarkDownDocument,
+        '# Title\n\nThis is *a* paragraph.\nIt has two lines.\n\n',
+    ),
+    (
+        OrgDocument,
+        '* Title\n\nThis is a paragraph.\nIt has two lines.\n\n',
+    ),
+])
+def test_large_document_region(doc_class, section):
+    doc = doc_class(
+        'DUMMY_URL',
+        section * 100,
+        config={TreeSitterDocument.CONFIGURATION_LARGE_FILE_SIZE: 1000},
+    )
+    assert doc.is_large
+    num_lines = section.count('\n')
+    paragraph_line = 50*num_lines + 2
+
+    region_range, region = doc.get_region(
+        Range(
+            start=Position(line=paragraph_line+1, character=3),
+            end=Position(line=paragraph_line+1, character=3),
+        )
+    )
+    assert region_range == Range(
+        start=Position(line=paragraph_line, character=0),
+        end=Position(line=paragraph_line+3, character=0),
+    )
+    assert not region.is_large
+    assert region.cleaned_source.strip() == 'This is a paragraph. It has two lines.'
+
+    offset = region.cleaned_source.index('two')
+    pos_range = region.range_at_offset(offset, 3, True)
+    assert pos_range.start.line == paragraph_line + 1
+    assert doc.lines[paragraph_line+1][pos_range.start.character:].startswith('two')
+
+    # the document itself is never cleaned
+    assert doc.language == 'en'
+    assert doc._cleaned_source is None
+    assert doc._text_intervals is None
+
+
+@pytest.mark.parametrize('doc_class', [
+    LatexDocument,
+    MarkDownDocument,
+    OrgDocument,
+])
+def test_cleaning_cache(doc_class, tmp_path, monkeypatch):
+    monkeypatch.setattr(TreeSitterDocument, 'CLEANING_CACHE_DIR', str(tmp_path))
+    content = ''.join(TOKENS[doc_class]) * 20
+    config = {TreeSitterDocument.CONFIGURATION_CLEANING_CACHE: True}
+    doc = doc_class('DUMMY_URL', content, config=dict(config))
+    exp_cleaned_source = doc.cleaned_source
+    exp_intervals = _intervals(doc)
+    assert len(os.listdir(tmp_path)) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError('The document should not be cleaned')
+
+    with monkeypatch.context() as m:
+        m.setattr(doc_class, '_iterate_captures', fail)
+        m.setattr(doc_class, '_parse_source', fail)
+        m.setattr(doc_class, '_detect_language', fail)
+        cached_doc = doc_class('DUMMY_URL', content, config=dict(config))
+        assert cached_doc.cleaned_source == exp_cleaned_source
+        assert _intervals(cached_doc) == exp_intervals
+        assert cached_doc.language == doc.language
+
+    # changed documents are cleaned without the cache
+    change = TextDocumentContentChangePartial(
+        range=Range(
+            start=Position(line=0, character=0),
+            end=Position(line=0, character=0),
+        ),
+        text='Word ',
+    )
+    exp_doc = doc_class('DUMMY_URL', 'Word ' + content)
+    cached_doc.apply_change(change)
+    assert cached_doc.cleaned_source == exp_doc.cleaned_source
+    assert _intervals(cached_doc) == _intervals(exp_doc)
+    assert len(os.listdir(tmp_path)) == 1
+
+    # the cache depends on the configuration
+    doc_class('DUMMY_URL', content, config={**config, 'language': 'de'}).cleaned_source
+    assert len(os.listdir(tmp_path)) == 2
+
+
+@pytest.mark.parametrize('doc_class', [
+    LatexDocument,
+    MarkDownDocument,
+    OrgDocument,
+])
+def test_cleaning_cache_shared_config(doc_class, tmp_path, monkeypatch):
+    monkeypatch.setattr(TreeSitterDocument, 'CLEANING_CACHE_DIR', str(tmp_path))
+    content = ''.join(TOKENS[doc_class]) * 20
+    # the documents of a type share their configuration
+    config = {TreeSitterDocument.CONFIGURATION_CLEANING_CACHE: True}
+    doc_class('DUMMY_URL_1', content, config=config).cleaned_source
+
+    other_doc = doc_class('DUMMY_URL_2', 'Word\n' + content, config=config)
+    other_doc.cleaned_source
+    other_doc.apply_change(TextDocumentContentChangePartial(
+        range=Range(
+            start=Position(line=0, character=0),
+            end=Position(line=0, character=0),
+        ),
+        text='Word ',
+    ))
+    other_doc.cleaned_source
+    num_entries = len(os.listdir(tmp_path))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('The document should not be cleaned')
+
+    with monkeypatch.context() as m:
+        m.setattr(doc_class, '_iterate_captures', fail)
+        m.setattr(doc_class, '_parse_source', fail)
+        doc_class('DUMMY_URL_1', content, config=config).cleaned_source
+    assert len(os.listdir(tmp_path)) == num_entries
+
+
+@pytest.mark.parametrize('doc_class', [
+    LatexDocument,
+    MarkDownDocument,
+    OrgDocument,
+])
+def test_cleaning_contention(doc_class):
+    large_doc = doc_class('DUMMY_URL_LARGE', ''.join(TOKENS[doc_class]) * 500)
+    small_doc = doc_class('DUMMY_URL_SMALL', ''.join(TOKENS[doc_class]))
+    exp_cleaned_source = doc_class(
+        'DUMMY_URL_SMALL',
+        ''.join(TOKENS[doc_class]),
+    ).cleaned_source
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with get_instance_lock(large_doc):
+            locked.set()
+            release.wait()
+
+    with ThreadPoolExecutor(3) as executor:
+        holder = executor.submit(hold_lock)
+        try:
+            assert locked.wait(10)
+            large_future = executor.submit(lambda: large_doc.cleaned_source)
+            small_future = executor.submit(lambda: small_doc.cleaned_source)
+            # the small document does not wait for the lock of the large one
+            assert small_future.result(timeout=10) == exp_cleaned_source
+            assert not large_future.done()
+        finally:
+            release.set()
+        holder.result()
+        large_future.result()
+
+
+@pytest.fixture
+def grammar_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        TreeSitterDocument,
+        'LIB_PATH_TEMPLATE',
+        str(tmp_path / 'cache' / '{}.so'),
+    )
+    monkeypatch.setattr(
+        TreeSitterDocument,
+        'LIB_INFO_PATH_TEMPLATE',
+        str(tmp_path / 'cache' / '{}.json'),
+    )
+    src_path = tmp_path / 'tree-sitter-dummy' / 'src'
+    src_path.mkdir(parents=True)
+    (src_path / 'parser.c').write_text('int tree_sitter_dummy(void) { return 0; }\n')
+    return tmp_path
+
+
+def test_build_library(grammar_cache):
+    source_path = str(grammar_cache / 'tree-sitter-dummy')
+    lib_path = TreeSitterDocument.LIB_PATH_TEMPLATE.format('dummy')
+
+    assert TreeSitterDocument.is_library_stale('dummy', 'URL', 'v1', source_path)
+    assert TreeSitterDocument.build_library('dummy', 'URL', 'v1', source_path)
+    assert not TreeSitterDocument.build_library('dummy', 'URL', 'v1', source_path)
+    # locally built libraries are used for any version
+    assert not TreeSitterDocument.is_library_stale('dummy', 'URL', 'v2')
+
+    mtime = os.path.getmtime(lib_path)
+    parser_path = grammar_cache / 'tree-sitter-dummy' / 'src' / 'parser.c'
+    os.utime(parser_path, (mtime + 10, mtime + 10))
+    assert TreeSitterDocument.is_library_stale('dummy', 'URL', 'v1', source_path)
+    assert TreeSitterDocument.build_library('dummy', 'URL', 'v1', source_path)
+    assert TreeSitterDocument.build_library('dummy', 'URL', 'v1', source_path, force=True)
+
+
+def test_library_stale_version(grammar_cache):
+    os.makedirs(os.path.dirname(TreeSitterDocument.LIB_PATH_TEMPLATE.format('dummy')))
+    with open(TreeSitterDocument.LIB_PATH_TEMPLATE.format('dummy'), 'w'):
+        pass
+    with open(TreeSitterDocument.LIB_INFO_PATH_TEMPLATE.format('dummy'), 'w') as fout:
+        json.dump(TreeSitterDocument._get_library_info('URL', 'v1'), fout)
+
+    assert not TreeSitterDocument.is_library_stale('dummy', 'URL', 'v1')
+    assert TreeSitterDocument.is_library_stale('dummy', 'URL', 'v2')
+    assert TreeSitterDocument.is_library_stale('dummy', 'URL2', 'v1')
+
+
+def test_get_language_without_build(grammar_cache, caplog):
+    # grammars are only built by `textlsp build-grammars` by default
+    assert not TreeSitterDocument.BUILD_ON_DEMAND
+
+    with pytest.raises(RuntimeError, match='textlsp build-grammars'):
+        TreeSitterDocument.get_language('dummy', 'URL', 'v1')
+    assert 'textlsp build-grammars' in caplog.text
+
+
+def test_sliced_parse(monkeypatch):
+    content = ''.join(TOKENS[LatexDocument]) * 200
+    exp_tree = LatexDocument('DUMMY_URL', content).tree
+    monkeypatch.setattr(TreeSitterDocument, 'PARSE_SLICE_MICROS', 100)
+    monkeypatch.setattr(TreeSitterDocument, 'PARSE_MAX_SLICES', 3)
+
+    doc = LatexDocument('DUMMY_URL', content)
+    assert doc.tree.root_node.sexp() == exp_tree.root_node.sexp()
+
+
+def test_parse_failure(monkeypatch):
+    doc = LatexDocument('DUMMY_URL', 'Word.')
+    monkeypatch.setattr(TreeSitterDocument, 'PARSE_MAX_SLICES', 3)
+    calls = list()
+    timeouts = list()
+
+    class FailingParser():
+        def set_language(self, language):
+            pass
+
+        def set_timeout_micros(self, micros):
+            timeouts.append(micros)
+
+        def reset(self):
+            pass
+
+        def parse(self, source):
+            calls.append(timeouts[-1])
+            raise ValueError('Parsing failed')
+
+    @contextlib.contextmanager
+    def parser():
+        yield FailingParser()
+
+    monkeypatch.setattr(
+        doc,
+        '_grammar',
+        SimpleNamespace(parser=parser, language=doc._grammar.language),
+    )
+    # failed slices are resumed, the last parse has no timeout
+    with pytest.raises(ValueError):
+        doc._parse_source()
+    assert calls == [TreeSitterDocument.PARSE_SLICE_MICROS] * 3 + [0]
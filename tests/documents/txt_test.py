@@ -1,5 +1,11 @@
 import pytest
 
+from lsprotocol.types import (
+    Position,
+    Range,
+    TextDocumentContentChangePartial,
+)
+
 from textLSP.documents.txt import TxtDocument
 
 
@@ -85,3 +91,66 @@ def test_highlight(src, offset, exp):
         res += lines[pos_range.end.line][:pos_range.end.character+1]
 
     assert res == exp
+
+
+@pytest.mark.parametrize('src,changes', [
+    (
+        'This is a sentence.\n'
+        'This is a sentence.\n'
+        '\n'
+        'This is a sentence.',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=1, character=19),
+                    end=Position(line=2, character=0),
+                ),
+                text='',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=19),
+                    end=Position(line=0, character=19),
+                ),
+                text='\n\n',
+            ),
+        ],
+    ),
+    (
+        # single character lines affect the matches that follow
+        'a\nb\nc\nd\n'
+        'This is a sentence.',
+        [
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=0, character=0),
+                    end=Position(line=1, character=0),
+                ),
+                text='',
+            ),
+            TextDocumentContentChangePartial(
+                range=Range(
+                    start=Position(line=2, character=1),
+                    end=Position(line=2, character=1),
+                ),
+                text='\ne',
+            ),
+        ],
+    ),
+])
+def test_incremental_clean(src, changes):
+    doc = TxtDocument(
+        'tmp.txt',
+        src,
+    )
+    doc.cleaned_source
+
+    for change in changes:
+        doc.apply_change(change)
+        cleaned_source = doc.cleaned_source
+
+        full_doc = TxtDocument(
+            'tmp.txt',
+            doc.source,
+        )
+        assert cleaned_source == full_doc.cleaned_source
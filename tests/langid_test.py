@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from textLSP.documents.document import BaseDocument
+from textLSP import langid
+from textLSP.langid import (
+    NGramLanguageIdentifier,
+    get_language_identifier,
+    warm_up_language_identifier,
+)
+
+
+@pytest.fixture(scope='module')
+def identifier(tmp_path_factory):
+    return NGramLanguageIdentifier(str(tmp_path_factory.mktemp('langid') / 'profiles'))
+
+
+@pytest.mark.parametrize('text,exp', [
+    ('This is an English paragraph. It has more than twenty characters in it.', 'en'),
+    ('Das ist ein deutscher Absatz. Er enthält mehr als zwanzig Zeichen.', 'de'),
+    ('Ceci est un paragraphe français. Il contient plus de vingt caractères.', 'fr'),
+    ('Ez egy magyar bekezdés. Több mint húsz karaktert tartalmaz.', 'hu'),
+    ('Это русский абзац. В нём больше двадцати символов.', 'ru'),
+    ('これは日本語の段落です。二十文字以上あります。', 'ja'),
+    ('1234 5678 -- ...', None),
+    ('', None),
+])
+def test_detect(identifier, text, exp):
+    assert identifier.detect(text) == exp
+
+
+def test_compiled_profiles(tmp_path, monkeypatch):
+    path = str(tmp_path / 'profiles')
+    NGramLanguageIdentifier.compile_profiles(path)
+
+    def _compile_profiles(*args):
+        raise AssertionError('profiles compiled again')
+
+    monkeypatch.setattr(NGramLanguageIdentifier, 'compile_profiles', _compile_profiles)
+    identifier = NGramLanguageIdentifier(path)
+
+    assert isinstance(identifier._log_probs, np.memmap)
+    assert identifier.detect('This is a sentence in English.') == 'en'
+
+
+@pytest.mark.parametrize('detector', [
+    BaseDocument.LANGUAGE_DETECTOR_BUILTIN,
+    BaseDocument.LANGUAGE_DETECTOR_LANGDETECT,
+])
+def test_document_language_detector(detector):
+    doc = BaseDocument(
+        'DUMMY_URL',
+        'Das ist ein Dokument. Es enthält mehr als zwanzig Zeichen.',
+        config={
+            BaseDocument.CONFIGURATION_LANGUAGE: 'auto',
+            BaseDocument.CONFIGURATION_LANGUAGE_DETECTOR: detector,
+        },
+    )
+
+    assert doc.language == 'de'
+
+
+def test_warm_up_language_identifier(monkeypatch):
+    created = list()
+
+    class DummyIdentifier():
+        def __init__(self):
+            created.append(self)
+
+    monkeypatch.setattr(langid, 'NGramLanguageIdentifier', DummyIdentifier)
+    monkeypatch.setattr(langid, '_language_identifier', None)
+
+    warm_up_language_identifier().join()
+    assert len(created) == 1
+    assert get_language_identifier() is created[0]
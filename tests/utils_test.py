@@ -1,5 +1,10 @@
+import random
+import threading
+
 import pytest
 
+from lsprotocol.types import Position
+
 from textLSP import utils, types
 
 
@@ -206,3 +211,233 @@ def test_token_diff(s1, s2, exp):
     res = types.TokenDiff.token_level_diff(s1, s2)
 
     assert res == exp
+
+
+@pytest.mark.parametrize('text,edits,chunk_size', [
+    (
+        'This is a sentence.\nThis is another.\n',
+        [
+            (0, 0, 'Start. '),
+            (10, 15, ''),
+            (20, 20, 'é😋\n'),
+        ],
+        4,
+    ),
+    (
+        '',
+        [
+            (0, 0, 'First line.\nSecond line.\n'),
+            (12, 25, ''),
+            (12, 12, 'Last line.'),
+        ],
+        3,
+    ),
+])
+def test_rope(text, edits, chunk_size, monkeypatch):
+    monkeypatch.setattr(types.Rope, 'CHUNK_SIZE', chunk_size)
+    rope = types.Rope(text)
+
+    for start, end, new_text in edits:
+        text = text[:start] + new_text + text[end:]
+        rope.replace(start, end, new_text)
+
+        assert len(rope) == len(text)
+        assert rope.slice(3, 12) == text[3:12]
+        for offset in range(len(text)+1):
+            assert rope.byte_offset(offset) == len(text[:offset].encode('utf-8'))
+
+        index = types.LineIndex(text)
+        rope_index = types.RopeLineIndex(rope)
+        assert len(rope_index) == len(index)
+        assert list(rope_index.lines) == list(index.lines)
+        assert [rope_index.line_start(i) for i in range(len(index)+1)] == index.line_starts
+
+    assert rope.text == text
+    assert rope.to_bytes() == text.encode('utf-8')
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_line_index_update(seed):
+    rng = random.Random(seed)
+    tokens = ['word', ' ', '\n', '\r', '\r\n', '\n\n', 'é😋']
+    text = ''.join(rng.choice(tokens) for _ in range(30))
+    index = types.LineIndex(text)
+
+    for _ in range(30):
+        start = rng.randint(0, len(text))
+        end = rng.randint(start, min(len(text), start + 5))
+        new_text = ''.join(rng.choice(tokens) for _ in range(rng.randint(0, 3)))
+        text = text[:start] + new_text + text[end:]
+        index.update(text, start, end, len(new_text))
+
+        exp = types.LineIndex(text)
+        assert index.lines == exp.lines
+        assert index.line_starts == exp.line_starts
+        assert index.has_irregular_line_breaks == exp.has_irregular_line_breaks
+        for offset in range(len(text) + 1):
+            assert index.byte_offset(offset) == len(text[:offset].encode('utf-8'))
+
+
+@pytest.mark.parametrize('text,irregular', [
+    ('', False),
+    ('a\nb', False),
+    ('a\nb\n', False),
+    ('a\r\nb', False),
+    ('a\rb', True),
+    ('a\nb\r', True),
+])
+def test_line_index_irregular_line_breaks(text, irregular):
+    assert types.LineIndex(text).has_irregular_line_breaks == irregular
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_span_tree(seed):
+    rng = random.Random(seed)
+    tree = types.SpanTree()
+    # sorted, disjoint [start, end) spans
+    exp = list()
+
+    for _ in range(50):
+        # replaces [start, end) with `length` characters
+        start = rng.randint(0, 60)
+        end = rng.randint(start, start + 5)
+        length = rng.randint(0, 4)
+        span_start = start if length > 0 else max(0, start - 1)
+        span_end = start + length if length > 0 else start
+        shift = length - end + start
+        tree.replace(start, end, span_start, span_end, shift)
+
+        before = [span for span in exp if span[1] < start]
+        replaced = [span for span in exp if span[1] >= start and span[0] <= end]
+        after = [span for span in exp if span[0] > end]
+        if len(replaced) > 0:
+            span_start = min(span_start, replaced[0][0])
+            if replaced[-1][1] > end:
+                span_end = max(span_end, replaced[-1][1] + shift)
+        exp = before + [(span_start, span_end)] + [
+            (span[0] + shift, span[1] + shift)
+            for span in after
+        ]
+
+        assert list(tree) == exp
+
+
+def _interval_list(items):
+    intervals = types.OffsetPositionIntervalList()
+    for item in items:
+        intervals.add_interval_values(*item)
+    return intervals
+
+
+@pytest.mark.parametrize('items,position,strict,exp', [
+    (
+        [
+            (0, 3, 0, 0, 0, 3, 'This'),
+            (4, 4, 0, 4, 0, 4, ' '),
+            (5, 6, 0, 5, 0, 6, 'is'),
+            (7, 7, 1, 0, 1, 0, ' '),
+            (8, 9, 1, 1, 1, 2, 'it'),
+        ],
+        Position(line=0, character=5),
+        True,
+        2,
+    ),
+    (
+        [
+            (0, 3, 0, 0, 0, 3, 'This'),
+            (4, 4, 0, 4, 0, 4, ' '),
+            (5, 6, 0, 5, 0, 6, 'is'),
+            (7, 7, 1, 0, 1, 0, ' '),
+            (8, 9, 1, 1, 1, 2, 'it'),
+        ],
+        Position(line=0, character=8),
+        True,
+        None,
+    ),
+    (
+        [
+            (0, 3, 0, 0, 0, 3, 'This'),
+            (4, 4, 0, 4, 0, 4, ' '),
+            (5, 6, 0, 5, 0, 6, 'is'),
+            (7, 7, 1, 0, 1, 0, ' '),
+            (8, 9, 1, 1, 1, 2, 'it'),
+        ],
+        Position(line=0, character=8),
+        False,
+        3,
+    ),
+    (
+        [
+            (0, 3, 0, 0, 0, 3, 'This'),
+            (4, 4, 0, 4, 0, 4, ' '),
+            (5, 6, 2, 5, 2, 6, 'is'),
+        ],
+        Position(line=1, character=0),
+        False,
+        2,
+    ),
+])
+def test_offset_position_interval_list(items, position, strict, exp):
+    intervals = _interval_list(items)
+
+    assert len(intervals) == len(items)
+    assert intervals.get_idx_at_position(position, strict) == exp
+    for idx, item in enumerate(items):
+        assert intervals.get_interval_values(idx) == item
+        assert intervals.get_idx_at_offset(item[0]) == idx
+
+
+def test_offset_position_interval_list_splice():
+    intervals = _interval_list([
+        (0, 3, 0, 0, 0, 3, 'This'),
+        (4, 4, 0, 4, 0, 4, ' '),
+        (5, 6, 0, 5, 0, 6, 'is'),
+        (7, 7, 1, 0, 1, 0, ' '),
+        (8, 9, 1, 1, 1, 2, 'it'),
+    ])
+    intervals.splice(
+        1,
+        3,
+        _interval_list([
+            (4, 4, 0, 4, 0, 4, '\n'),
+            (5, 5, 1, 0, 1, 0, '\n'),
+        ]),
+        offset_shift=-1,
+        line_shift=1,
+    )
+
+    assert intervals.values == ['This', '\n', '\n', ' ', 'it']
+    assert intervals.get_interval_values(3) == (6, 6, 2, 0, 2, 0, ' ')
+    assert intervals.get_interval_values(4) == (7, 8, 2, 1, 2, 2, 'it')
+
+
+def test_synchronized_method():
+    class Resource():
+        def __init__(self):
+            self.entered = threading.Event()
+            self.release = threading.Event()
+
+        @utils.synchronized_method
+        def hold(self):
+            self.entered.set()
+            self.release.wait(5)
+
+        @utils.synchronized_method
+        def get(self):
+            return True
+
+    resource = Resource()
+    other = Resource()
+    thread = threading.Thread(target=resource.hold)
+    thread.start()
+    resource.entered.wait(5)
+
+    # other instances are not blocked
+    assert other.get()
+    lock = utils.get_instance_lock(resource)
+    assert lock is not utils.get_instance_lock(other)
+    assert not lock.acquire(blocking=False)
+
+    resource.release.set()
+    thread.join()
+    assert resource.get()
@@ -1,6 +1,22 @@
+import asyncio
+import bisect
+import concurrent.futures
+import contextvars
+import copy
+import functools
+import hashlib
+import inspect
+import json
 import logging
+import os
+import sqlite3
+import threading
+import time
 
-from typing import List, Optional
+from os import path
+
+from typing import Any, Awaitable, Callable, Iterable, List, NamedTuple, Optional, Tuple
+from lsprotocol import converters
 from pygls.lsp.server import LanguageServer
 from pygls.workspace import TextDocument
 from lsprotocol.types import (
@@ -8,7 +24,6 @@ from lsprotocol.types import (
         DidChangeTextDocumentParams,
         DidCloseTextDocumentParams,
         DidSaveTextDocumentParams,
-        TextDocumentContentChangeEvent,
         TextDocumentContentChangeWholeDocument,
         Diagnostic,
         DiagnosticSeverity,
@@ -26,17 +41,257 @@ from lsprotocol.types import (
 )
 
 from ..documents.document import BaseDocument, ChangeTracker
-from ..utils import merge_dicts
+from ..utils import merge_dicts, get_textlsp_version, get_user_cache
 from ..types import (
     Interval,
     TextLSPCodeActionKind,
     ProgressBar,
     PositionDict,
+    LRUCache,
 )
 
 
 logger = logging.getLogger(__name__)
 
+# event loop of the check running on the current worker thread
+_worker_state = threading.local()
+# set for checks whose results are dropped if the document changed since
+# their snapshot was taken
+OUTDATED_RESULTS_DROPPED = contextvars.ContextVar(
+    'outdated_results_dropped',
+    default=False,
+)
+# results of the check running in the current context, which are stored in
+# the result cache when it finishes
+_check_results = contextvars.ContextVar('check_results', default=None)
+
+
+# seconds a worker thread waits for the event loop to run a call
+LOOP_CALL_TIMEOUT = 60
+# seconds after which a waiting worker thread checks if the loop still runs
+LOOP_CALL_POLL_INTERVAL = 0.5
+
+
+class LoopUnavailableError(RuntimeError):
+    """
+    Raised on a worker thread if the event loop does not run its call, e.g.
+    because the server is shutting down. The results of the check are
+    dropped.
+    """
+    pass
+
+
+def _on_loop_thread(method):
+    """
+    Calls the method on the thread of the event loop if it is called by a
+    check running on a worker thread, since the items of the analysers are
+    only changed on the event loop.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        loop = getattr(_worker_state, 'loop', None)
+        if loop is None:
+            return method(*args, **kwargs)
+
+        future = concurrent.futures.Future()
+
+        def call():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(method(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        try:
+            loop.call_soon_threadsafe(call)
+        except RuntimeError as e:
+            raise LoopUnavailableError(str(e)) from e
+
+        deadline = time.monotonic() + LOOP_CALL_TIMEOUT
+        while True:
+            try:
+                return future.result(timeout=LOOP_CALL_POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if loop.is_closed() or not loop.is_running():
+                    future.cancel()
+                    raise LoopUnavailableError('The event loop is not running')
+                if time.monotonic() > deadline:
+                    future.cancel()
+                    raise LoopUnavailableError(
+                        f'The event loop did not run {method.__name__} in'
+                        f' {LOOP_CALL_TIMEOUT} seconds'
+                    )
+
+    return wrapper
+
+
+class ScheduledCheck(NamedTuple):
+    function: Callable
+    args: Tuple[Any, ...]
+    # the lines of the document which are checked, so that the visible ones
+    # can be checked first
+    uri: Optional[str] = None
+    position_range: Optional[Range] = None
+
+
+class _CheckResults():
+    """
+    Copies of the diagnostics and code actions added by a check, since the
+    added ones are shifted by later changes of the document.
+    """
+
+    def __init__(self):
+        self.diagnostics = list()
+        self.code_actions = list()
+        # cleared if the results are incomplete, e.g. a request failed
+        self.cacheable = True
+
+
+class PersistentResultCache():
+    """
+    SQLite database of the cached results of paragraphs, so that the results
+    of known paragraphs are reused after the server is restarted. A row holds
+    the JSON encoded results of a paragraph, the least recently used rows are
+    removed. The database is only accessed by a dedicated thread, `load()`
+    and `store()` return futures.
+    """
+    # number of keys looked up by a query
+    BATCH_SIZE = 500
+    # seconds a check waits for the stored results
+    LOAD_TIMEOUT = 10
+
+    def __init__(self, file_path: str, max_items: int = 100000):
+        self.file_path = file_path
+        self.max_items = max_items
+        self._connection = None
+        # upper bound of the number of rows, counted when it is over the limit
+        self._num_items = None
+        self._converter = converters.get_converter()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='textLSP-result-cache',
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(path.dirname(self.file_path), exist_ok=True)
+            connection = sqlite3.connect(self.file_path, timeout=5)
+            try:
+                # other servers can read while one is writing
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS results '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)'
+                )
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS results_used ON results (used)'
+                )
+                connection.commit()
+                self._num_items = connection.execute(
+                    'SELECT COUNT(*) FROM results'
+                ).fetchone()[0]
+            except sqlite3.Error:
+                connection.close()
+                raise
+            self._connection = connection
+        return self._connection
+
+    def _encode(self, records: tuple) -> str:
+        return json.dumps([
+            [
+                isinstance(item, Diagnostic),
+                self._converter.unstructure(item),
+                offsets,
+            ]
+            for item, offsets in records
+        ])
+
+    def _decode(self, value: str) -> tuple:
+        return tuple(
+            (
+                self._converter.structure(
+                    item,
+                    Diagnostic if is_diagnostic else CodeAction,
+                ),
+                tuple(tuple(offset) for offset in offsets),
+            )
+            for is_diagnostic, item, offsets in json.loads(value)
+        )
+
+    def load(self, keys: List[str]) -> concurrent.futures.Future:
+        """
+        Returns a future of the stored results of the keys which are found.
+        """
+        return self._executor.submit(self._load, list(keys))
+
+    def _load(self, keys: List[str]) -> dict:
+        res = dict()
+        try:
+            connection = self._connect()
+            for idx in range(0, len(keys), self.BATCH_SIZE):
+                batch = keys[idx:idx+self.BATCH_SIZE]
+                for key, value in connection.execute(
+                    f'SELECT key, value FROM results WHERE key IN ({",".join("?" * len(batch))})',
+                    batch,
+                ):
+                    try:
+                        res[key] = self._decode(value)
+                    except Exception as e:
+                        logger.warning(f'Could not decode a cached result: {e}')
+
+            if len(res) > 0:
+                # recently used rows are kept
+                now = time.time()
+                connection.executemany(
+                    'UPDATE results SET used = ? WHERE key = ?',
+                    [(now, key) for key in res],
+                )
+                connection.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f'Could not read the persistent result cache: {e}')
+
+        return res
+
+    def store(self, items: List[Tuple[str, tuple]]) -> concurrent.futures.Future:
+        return self._executor.submit(self._store, list(items))
+
+    def _store(self, items: List[Tuple[str, tuple]]):
+        now = time.time()
+        try:
+            connection = self._connect()
+            connection.executemany(
+                'INSERT OR REPLACE INTO results (key, value, used) VALUES (?, ?, ?)',
+                [(key, self._encode(records), now) for key, records in items],
+            )
+            # replaced rows are counted as well, the rows are only counted
+            # again if the limit might be reached
+            self._num_items += len(items)
+            if self._num_items > self.max_items:
+                num = connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                if num > self.max_items:
+                    connection.execute(
+                        'DELETE FROM results WHERE key IN '
+                        '(SELECT key FROM results ORDER BY used LIMIT ?)',
+                        (num - self.max_items,),
+                    )
+                self._num_items = min(num, self.max_items)
+            connection.commit()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f'Could not write the persistent result cache: {e}')
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        """
+        Closes the database once the pending writes are done.
+        """
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=True)
+
 
 class Analyser():
     CONFIGURATION_SEVERITY = 'severity'
@@ -44,6 +299,13 @@ class Analyser():
     CONFIGURATION_CHECK_ON_OPEN = 'on_open'
     CONFIGURATION_CHECK_ON_CHANGE = 'on_change'
     CONFIGURATION_CHECK_ON_SAVE = 'on_save'
+    CONFIGURATION_CONCURRENCY = 'concurrency'
+    CONFIGURATION_MAX_REQUESTS = 'max_requests'
+    CONFIGURATION_DEBOUNCE = 'debounce'
+    CONFIGURATION_RESULT_CACHE_SIZE = 'result_cache_size'
+    CONFIGURATION_PERSISTENT_RESULT_CACHE = 'persistent_result_cache'
+    CONFIGURATION_PERSISTENT_RESULT_CACHE_PATH = 'persistent_result_cache_path'
+    CONFIGURATION_PERSISTENT_RESULT_CACHE_SIZE = 'persistent_result_cache_size'
 
     SETTINGS_DEFAULT_CHECK_ON = {
         CONFIGURATION_CHECK_ON_OPEN: True,
@@ -51,6 +313,28 @@ class Analyser():
         CONFIGURATION_CHECK_ON_SAVE: True,
     }
 
+    # number of checks of the analyser running at the same time
+    DEFAULT_CONCURRENCY = 1
+    # number of requests of a check of an asynchronous analyser running at
+    # the same time
+    DEFAULT_MAX_REQUESTS = 4
+    # seconds without changes after which the changes of a document are
+    # checked
+    DEFAULT_DEBOUNCE = 0.5
+    # number of paragraphs whose results are cached
+    DEFAULT_RESULT_CACHE_SIZE = 10000
+    DEFAULT_PERSISTENT_RESULT_CACHE = False
+    # relative paths are in the user cache
+    DEFAULT_PERSISTENT_RESULT_CACHE_PATH = 'results.sqlite'
+    DEFAULT_PERSISTENT_RESULT_CACHE_SIZE = 100000
+
+    # number of lines analysed at the beginning of large documents when they
+    # are opened, before the client reports the visible ranges
+    LARGE_DOCUMENT_OPEN_LINES = 100
+    # documents with more cleaned characters are checked in chunks of
+    # paragraphs of about this size, the visible ones first
+    PRIORITY_CHUNK_SIZE = 5000
+
     def __init__(self, language_server: LanguageServer, config: dict, name: str):
         self.name = name
         self.default_severity = DiagnosticSeverity.Information
@@ -61,7 +345,18 @@ class Analyser():
         self._code_actions_dict = dict()
         self._content_change_dict = dict()
         self._checked_documents = set()
+        # line spans of the analysed regions of large documents
+        self._analysed_regions = dict()
         self._progressbar_token = ProgressBar.create_token()
+        self._scheduled_checks = list()
+        # id -> (document, snapshot) of the documents of the scheduled checks
+        self._scheduled_snapshots = dict()
+        # documents with changes to be checked by check_changes()
+        self._changed_documents = set()
+        # paragraph key -> results of the paragraph with relative offsets
+        self._result_cache = None
+        # backs the result cache if enabled
+        self._persistent_result_cache = None
 
     def _did_open(self, doc: TextDocument):
         raise NotImplementedError()
@@ -69,19 +364,215 @@ class Analyser():
     def did_open(self, params: DidOpenTextDocumentParams):
         doc = self.get_document(params)
         self.init_document_items(doc)
-        self._content_change_dict[doc.uri] = ChangeTracker(doc, True)
-        if self.should_run_on(Analyser.CONFIGURATION_CHECK_ON_OPEN):
-            with ProgressBar(
-                    self.language_server,
-                    f'{self.name} checking',
-                    token=self._progressbar_token
+        self._content_change_dict[doc.uri] = ChangeTracker(
+            doc,
+            not doc.is_large,
+            self.language_server.analyser_handler.get_change_journal(doc),
+        )
+        if doc.is_large:
+            # only the regions around the visible and edited lines are
+            # analysed
+            self._analysed_regions[doc.uri] = list()
+            self.did_change_visible_ranges(
+                doc.uri,
+                [Range(
+                    start=Position(line=0, character=0),
+                    end=Position(line=self.LARGE_DOCUMENT_OPEN_LINES, character=0),
+                )],
+            )
+        elif self.should_run_on(Analyser.CONFIGURATION_CHECK_ON_OPEN):
+            self._schedule_document_checks(doc)
+            self._checked_documents.add(doc.uri)
+
+    def _schedule_document_checks(self, doc: BaseDocument):
+        """
+        Schedules the check of the full document. Long documents are checked
+        in chunks of paragraphs, which are published one by one. The results
+        of paragraphs which were checked before are taken from the result
+        cache, only the other ones are checked. The persistent result cache
+        is looked up by the checks, since it is read on its own thread.
+        """
+        cache = self._get_result_cache()
+        length = len(doc.cleaned_source)
+        if cache is None and length <= self.PRIORITY_CHUNK_SIZE:
+            self._schedule_check(self._did_open, doc)
+            return
+
+        paragraphs = list()
+        offset = 0
+        while offset < length:
+            paragraph = doc.paragraph_at_offset(offset, cleaned=True)
+            paragraphs.append(paragraph)
+            offset = paragraph.start + paragraph.length
+
+        if cache is not None:
+            keys = self._get_result_cache_keys(doc, paragraphs)
+            uncached = self._add_records(
+                doc,
+                paragraphs,
+                [cache.get(key) for key in keys],
+            )
+            logger.debug(
+                f'{self.name} result cache ({doc.uri}): '
+                f'{len(paragraphs) - len(uncached)} of {len(paragraphs)} '
+                f'paragraphs cached, hits: {cache.hits}, misses: {cache.misses}'
+            )
+            paragraphs = [paragraphs[idx] for idx in uncached]
+            keys = [keys[idx] for idx in uncached]
+
+        # paragraph indices of the chunks
+        chunks = list()
+        chunk_length = 0
+        for idx, paragraph in enumerate(paragraphs):
+            if len(chunks) == 0 or chunk_length >= self.PRIORITY_CHUNK_SIZE:
+                chunks.append(list())
+                chunk_length = 0
+            chunks[-1].append(idx)
+            chunk_length += paragraph.length
+
+        ranges = doc.ranges_at_offsets(
+            [paragraphs[indices[0]].start for indices in chunks],
+            [
+                paragraphs[indices[-1]].start + paragraphs[indices[-1]].length
+                - paragraphs[indices[0]].start
+                for indices in chunks
+            ],
+            True,
+        )
+        persistent_cache = self._get_persistent_result_cache()
+        for indices, pos_range in zip(chunks, ranges):
+            chunk_paragraphs = [paragraphs[idx] for idx in indices]
+            function, args = self._get_paragraph_check(doc, chunk_paragraphs)
+            if function == self._did_open:
+                pos_range = None
+
+            if cache is None:
+                self._schedule_check(function, doc, *args, position_range=pos_range)
+            else:
+                self._schedule_check(
+                    (
+                        self._async_cached_check
+                        if inspect.iscoroutinefunction(self._did_change)
+                        else self._cached_check
+                    ),
+                    doc,
+                    chunk_paragraphs,
+                    [keys[idx] for idx in indices],
+                    persistent_cache,
+                    position_range=pos_range,
+                )
+
+    def _get_paragraph_check(
+        self,
+        doc: BaseDocument,
+        paragraphs: List[Interval],
+    ) -> Tuple[Callable, tuple]:
+        """
+        Returns the check of the cleaned paragraphs and its arguments after
+        the document, consecutive paragraphs are checked as one interval.
+        """
+        intervals = list()
+        for paragraph in paragraphs:
+            if (
+                len(intervals) > 0
+                and intervals[-1].start + intervals[-1].length == paragraph.start
             ):
-                self._did_open(doc)
-                self._checked_documents.add(doc.uri)
+                intervals[-1] = Interval(
+                    intervals[-1].start,
+                    intervals[-1].length + paragraph.length,
+                )
+            else:
+                intervals.append(Interval(paragraph.start, paragraph.length))
+
+        if intervals == [Interval(0, len(doc.cleaned_source))]:
+            return self._did_open, ()
+        return self._did_change, (intervals,)
 
     def _did_change(self, doc: TextDocument, changes: List[Interval]):
         raise NotImplementedError()
 
+    def analyse_ranges(self, doc: BaseDocument, ranges: List[Range]):
+        """
+        Analyses the regions of a large document around the given ranges,
+        which were not analysed since their last change.
+        """
+        analysed = self._analysed_regions.setdefault(doc.uri, list())
+        for pos_range in ranges:
+            region_range, region = doc.get_region(pos_range)
+            start_line = region_range.start.line
+            end_line = region_range.end.line
+            if start_line >= end_line or any(
+                start <= start_line and end_line <= end
+                for start, end in analysed
+            ):
+                continue
+
+            self.remove_code_items_at_range(doc, region_range, (True, False))
+            # positions in the region are the same as in the document, so the
+            # results are added to the document
+            self._schedule_check(self._did_open, region, position_range=region_range)
+            analysed.append((start_line, end_line))
+
+    def did_change_visible_ranges(self, uri: str, ranges: List[Range]):
+        # only set for open large documents
+        if (
+            uri not in self._analysed_regions
+            or not self.should_run_on(Analyser.CONFIGURATION_CHECK_ON_OPEN)
+        ):
+            return
+
+        self.analyse_ranges(self.get_document(uri), ranges)
+
+    def _invalidate_regions(self, doc: BaseDocument, params: DidChangeTextDocumentParams):
+        """
+        Forgets the analysed regions of a large document from the first
+        changed line.
+        """
+        analysed = self._analysed_regions.get(doc.uri)
+        if analysed is None:
+            return
+
+        first_line = min(
+            (
+                0 if type(change) == TextDocumentContentChangeWholeDocument
+                else change.range.start.line
+                for change in params.content_changes
+            ),
+            default=None,
+        )
+        if first_line is not None:
+            self._analysed_regions[doc.uri] = [
+                (start, end)
+                for start, end in analysed
+                if end <= first_line
+            ]
+
+    def _analyse_changes(self, doc: BaseDocument, changes: List[Interval]):
+        if not doc.is_large:
+            self._schedule_check(self._did_change, doc, changes)
+            return
+
+        # changes of large documents are tracked in the source
+        length = len(doc.source)
+        ranges = [
+            Range(
+                start=doc.position_at_offset(min(change.start, length)),
+                end=doc.position_at_offset(min(change.start + change.length, length)),
+            )
+            for change in changes
+        ]
+        # the results of an earlier check of the changes might have been
+        # dropped, so their regions are analysed again
+        self._analysed_regions[doc.uri] = [
+            (start, end)
+            for start, end in self._analysed_regions.get(doc.uri, list())
+            if not any(
+                start <= pos_range.end.line and pos_range.start.line < end
+                for pos_range in ranges
+            )
+        ]
+        self.analyse_ranges(doc, ranges)
+
     def _handle_line_shifts(self, params: DidChangeTextDocumentParams):
         # FIXME: this method is very complex, try to make it easier to read
         should_update_diagnostics = False
@@ -178,7 +669,7 @@ class Analyser():
                 # There is a line shift: diff > 0
                 val += diff
                 accumulative_shifts.append((change.range.start, val, change))
-        pos = doc.last_position(True)
+        pos = doc.last_position(not doc.is_large)
         pos = Position(
             line=pos.line - (accumulative_shifts[-1][1] if len(accumulative_shifts) else 0) + 1,
             character=0
@@ -258,7 +749,7 @@ class Analyser():
         return should_update_diagnostics
 
     def _remove_overflown_code_items(self, doc: BaseDocument):
-        last_position = doc.last_position(True)
+        last_position = doc.last_position(not doc.is_large)
 
         self._diagnostics_dict[doc.uri].remove_from(last_position, False)
         self._code_actions_dict[doc.uri].remove_from(last_position, False)
@@ -296,6 +787,7 @@ class Analyser():
         doc = self.get_document(params)
         should_update_diagnostics = self._handle_shifts(params)
         self._update_code_actions(doc)
+        self._invalidate_regions(doc, params)
 
         if self.should_run_on(Analyser.CONFIGURATION_CHECK_ON_CHANGE):
             if self._content_change_dict[doc.uri].full_document_change:
@@ -303,19 +795,55 @@ class Analyser():
                     DidOpenTextDocumentParams(params.text_document)
                 )
             else:
-                changes = self._content_change_dict[doc.uri].get_changes()
-                self._content_change_dict[doc.uri] = ChangeTracker(doc, True)
-                with ProgressBar(
-                        self.language_server,
-                        f'{self.name} checking',
-                        token=self._progressbar_token
-                ):
-                    self._did_change(doc, changes)
+                # the changes are collected until the document stops
+                # changing
+                self._changed_documents.add(doc.uri)
         elif should_update_diagnostics:
             self.language_server.publish_stored_diagnostics(doc)
 
-    def update_document(self, doc: TextDocument, change: TextDocumentContentChangeEvent):
-        self._content_change_dict[doc.uri].update_document(change, doc)
+    def has_unchecked_changes(self, uri: str) -> bool:
+        return uri in self._changed_documents
+
+    def check_changes(self, uri: str) -> bool:
+        """
+        Schedules the checks of the changes of the document since its last
+        check. The changes are kept until `finish_checking_changes()`, so
+        that they are checked again if the document changes in the meantime.
+        """
+        self._changed_documents.discard(uri)
+        tracker = self._content_change_dict.get(uri)
+        if tracker is None or len(tracker) == 0:
+            return False
+
+        self._analyse_changes(self.get_document(uri), tracker.get_changes())
+        return True
+
+    def resume_document_checks(self, uri: str):
+        """
+        Schedules the document checks which were cancelled by a change of the
+        document. Paragraphs found in the result cache are not checked again.
+        Without the result cache the document is not checked again, but it
+        can be analysed with the code action of the document.
+        """
+        doc = self.get_document(uri)
+        if doc.is_large:
+            # analysed again once visible
+            self._analysed_regions[uri] = list()
+        elif self._get_result_cache() is None:
+            self._checked_documents.discard(uri)
+        else:
+            self._schedule_document_checks(doc)
+
+    def finish_checking_changes(self, uri: str, version: int):
+        tracker = self._content_change_dict.get(uri)
+        if tracker is not None and self.get_document(uri).version == version:
+            tracker.reset()
+
+    def _is_outdated(self, doc: BaseDocument) -> bool:
+        return (
+            OUTDATED_RESULTS_DROPPED.get()
+            and self.get_document(doc.uri).version != doc.version
+        )
 
     def did_save(self, params: DidSaveTextDocumentParams):
         if self.should_run_on(Analyser.CONFIGURATION_CHECK_ON_SAVE):
@@ -328,25 +856,429 @@ class Analyser():
                     )
                 else:
                     changes = self._content_change_dict[doc.uri].get_changes()
-                    self._content_change_dict[doc.uri] = ChangeTracker(doc, True)
-                    with ProgressBar(
-                            self.language_server,
-                            f'{self.name} checking',
-                            token=self._progressbar_token
-                    ):
-                        self._did_change(doc, changes)
+                    self._content_change_dict[doc.uri].reset()
+                    self._analyse_changes(doc, changes)
 
     def _did_close(self, doc: TextDocument):
         pass
 
     def did_close(self, params: DidCloseTextDocumentParams):
+        self._analysed_regions.pop(params.text_document.uri, None)
+        self._changed_documents.discard(params.text_document.uri)
         self._did_close(self.get_document(params))
 
+    def _schedule_check(self, function: Callable, *args, position_range: Range = None):
+        """
+        Schedules a check to be run by the analyser handler, on a worker
+        thread or, if the function is a coroutine function, on the event
+        loop. Documents are passed as snapshots of their current version,
+        since they can change while the check is running. The checks of an
+        event share the snapshots of a document.
+        """
+        uri = None
+        snapshot_args = list()
+        for arg in args:
+            if isinstance(arg, BaseDocument):
+                uri = arg.uri
+                item = self._scheduled_snapshots.get(id(arg))
+                if item is None:
+                    # the document is kept, so that its id is not reused
+                    item = (arg, arg.get_snapshot())
+                    self._scheduled_snapshots[id(arg)] = item
+                arg = item[1]
+            snapshot_args.append(arg)
+
+        self._scheduled_checks.append(ScheduledCheck(
+            function,
+            tuple(snapshot_args),
+            uri,
+            position_range,
+        ))
+
+    def pop_scheduled_checks(self) -> List[ScheduledCheck]:
+        res = self._scheduled_checks
+        self._scheduled_checks = list()
+        self._scheduled_snapshots = dict()
+        return res
+
+    def run_check(self, loop: asyncio.AbstractEventLoop, function: Callable, args: Tuple[Any, ...]):
+        """
+        Runs a scheduled check on a worker thread. Diagnostics and code
+        actions are changed on the thread of the given event loop.
+        """
+        _worker_state.loop = loop
+        try:
+            function(*args)
+        except LoopUnavailableError as e:
+            logger.warning(f'{self.name}: the results of a check are dropped: {e}')
+        finally:
+            _worker_state.loop = None
+
+    def _get_result_cache(self) -> Optional[LRUCache]:
+        size = int(self.config.get(
+            Analyser.CONFIGURATION_RESULT_CACHE_SIZE,
+            Analyser.DEFAULT_RESULT_CACHE_SIZE,
+        ))
+        if size <= 0:
+            self._result_cache = None
+        elif self._result_cache is None:
+            self._result_cache = LRUCache(size)
+        else:
+            self._result_cache.max_size = size
+        return self._result_cache
+
+    def _get_result_cache_keys(self, doc: BaseDocument, paragraphs: List[Interval]) -> List[str]:
+        """
+        Returns the keys of the results of the cleaned paragraphs, which are
+        the hashes of the analyser, its configuration, the language of the
+        document and the text of the paragraph.
+        """
+        digest = hashlib.sha256()
+        for part in (
+            self.name,
+            get_textlsp_version(),
+            json.dumps(self.config, sort_keys=True, default=str),
+            doc.language,
+        ):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+
+        res = list()
+        for paragraph in paragraphs:
+            paragraph_digest = digest.copy()
+            paragraph_digest.update(doc.text_at_offset(
+                paragraph.start,
+                paragraph.length,
+                True,
+            ).encode('utf-8'))
+            res.append(paragraph_digest.hexdigest())
+        return res
+
+    def _get_persistent_result_cache(self) -> Optional[PersistentResultCache]:
+        if not self.config.get(
+            Analyser.CONFIGURATION_PERSISTENT_RESULT_CACHE,
+            Analyser.DEFAULT_PERSISTENT_RESULT_CACHE,
+        ):
+            return None
+
+        file_path = path.join(
+            get_user_cache(),
+            path.expanduser(self.config.get(
+                Analyser.CONFIGURATION_PERSISTENT_RESULT_CACHE_PATH,
+                Analyser.DEFAULT_PERSISTENT_RESULT_CACHE_PATH,
+            )),
+        )
+        max_items = int(self.config.get(
+            Analyser.CONFIGURATION_PERSISTENT_RESULT_CACHE_SIZE,
+            Analyser.DEFAULT_PERSISTENT_RESULT_CACHE_SIZE,
+        ))
+        cache = self._persistent_result_cache
+        if cache is None or cache.file_path != file_path:
+            if cache is not None:
+                cache.close()
+            cache = PersistentResultCache(file_path, max_items)
+            self._persistent_result_cache = cache
+        cache.max_items = max_items
+        return cache
+
+    @staticmethod
+    def _get_range_holders(item) -> list:
+        """
+        Returns the parts of a diagnostic or code action with a range, the
+        text edits of code actions first.
+        """
+        if isinstance(item, Diagnostic):
+            return [item]
+
+        res = list()
+        if item.edit is not None:
+            for change in item.edit.document_changes:
+                res.extend(change.edits)
+        res.extend(item.diagnostics or list())
+        return res
+
+    def _add_records(
+        self,
+        doc: BaseDocument,
+        paragraphs: List[Interval],
+        paragraph_records: List[Optional[tuple]],
+    ) -> List[int]:
+        """
+        Adds the cached results of the paragraphs at their offsets in the
+        document. Returns the indices of the paragraphs without cached
+        results, i.e. their records are None.
+        """
+        uncached = list()
+        items = list()
+        offsets = list()
+        lengths = list()
+        for idx, (paragraph, records) in enumerate(zip(paragraphs, paragraph_records)):
+            if records is None:
+                uncached.append(idx)
+                continue
+
+            for item, item_offsets in records:
+                items.append(item)
+                for offset, length in item_offsets:
+                    offsets.append(paragraph.start + offset)
+                    lengths.append(length)
+
+        if len(uncached) == len(paragraphs):
+            return uncached
+
+        ranges = iter(
+            doc.ranges_at_offsets(offsets, lengths, True)
+            if len(offsets) > 0
+            else list()
+        )
+        diagnostics = list()
+        code_actions = list()
+        for item in items:
+            item = copy.deepcopy(item)
+            for holder in self._get_range_holders(item):
+                holder.range = next(ranges)
+            if isinstance(item, Diagnostic):
+                diagnostics.append(item)
+            else:
+                self._update_single_code_action(item, doc)
+                code_actions.append(item)
+
+        self.add_code_actions(doc, code_actions)
+        self.add_diagnostics(doc, diagnostics)
+        return uncached
+
+    def _cache_results(
+        self,
+        doc: BaseDocument,
+        paragraphs: List[Interval],
+        keys: List[str],
+        results: _CheckResults,
+    ):
+        """
+        Stores the results of a check per checked paragraph, with offsets
+        relative to the paragraph. Paragraphs with results which can not be
+        mapped back to the same ranges or which span over the paragraph are
+        not stored.
+        """
+        if not results.cacheable:
+            return
+
+        items = [
+            item
+            for item in results.diagnostics + results.code_actions
+            if len(self._get_range_holders(item)) > 0
+        ]
+        ranges = [
+            holder.range
+            for item in items
+            for holder in self._get_range_holders(item)
+        ]
+        starts = [doc.offset_at_position(pos_range.start, True) for pos_range in ranges]
+        # the end of the ranges is usually the last character
+        lengths = [
+            doc.offset_at_position(pos_range.end, True) - start + 1
+            for pos_range, start in zip(ranges, starts)
+        ]
+        valid = [length > 0 for length in lengths]
+        if len(ranges) > 0:
+            mapped = doc.ranges_at_offsets(starts, lengths, True)
+            retry = [idx for idx, pos_range in enumerate(mapped) if pos_range != ranges[idx]]
+            if len(retry) > 0:
+                mapped = doc.ranges_at_offsets(
+                    [starts[idx] for idx in retry],
+                    [lengths[idx] - 1 for idx in retry],
+                    True,
+                )
+                for idx, pos_range in zip(retry, mapped):
+                    lengths[idx] -= 1
+                    valid[idx] = pos_range == ranges[idx]
+
+        paragraph_starts = [paragraph.start for paragraph in paragraphs]
+        records = [list() for _ in paragraphs]
+        cacheable = [True] * len(paragraphs)
+        range_idx = 0
+        for item in items:
+            num = len(self._get_range_holders(item))
+            item_starts = starts[range_idx:range_idx+num]
+            item_lengths = lengths[range_idx:range_idx+num]
+            item_valid = valid[range_idx:range_idx+num]
+            range_idx += num
+
+            idx = bisect.bisect_right(paragraph_starts, item_starts[0]) - 1
+            if idx < 0:
+                continue
+            paragraph = paragraphs[idx]
+            paragraph_end = paragraph.start + paragraph.length
+            if item_starts[0] >= paragraph_end:
+                # not in the checked paragraphs
+                continue
+            if not all(item_valid) or any(
+                start < paragraph.start or start + length > paragraph_end
+                for start, length in zip(item_starts, item_lengths)
+            ):
+                cacheable[idx] = False
+                continue
+
+            records[idx].append((
+                item,
+                tuple(
+                    (start - paragraph.start, length)
+                    for start, length in zip(item_starts, item_lengths)
+                ),
+            ))
+
+        self._put_cached_results([
+            (key, tuple(paragraph_records))
+            for key, paragraph_records, is_cacheable in zip(keys, records, cacheable)
+            if is_cacheable
+        ])
+
+    @_on_loop_thread
+    def _put_cached_results(self, items: List[Tuple[str, tuple]], persist=True):
+        if self._result_cache is None:
+            return
+        for key, records in items:
+            self._result_cache.put(key, records)
+
+        persistent_cache = self._get_persistent_result_cache()
+        if persist and persistent_cache is not None and len(items) > 0:
+            # written on the thread of the cache
+            persistent_cache.store(items)
+
+    def _skip_result_cache(self):
+        """
+        Keeps the results of the running check out of the result cache, e.g.
+        if some of its requests failed.
+        """
+        results = _check_results.get()
+        if results is not None:
+            results.cacheable = False
+
+    def _add_stored_results(
+        self,
+        doc: BaseDocument,
+        paragraphs: List[Interval],
+        keys: List[str],
+        stored: dict,
+    ) -> Tuple[List[Interval], List[str]]:
+        """
+        Adds the results loaded from the persistent result cache and returns
+        the paragraphs and keys which still have to be checked.
+        """
+        if len(stored) > 0:
+            self._put_cached_results(list(stored.items()), persist=False)
+        uncached = self._add_records(doc, paragraphs, [stored.get(key) for key in keys])
+        return (
+            [paragraphs[idx] for idx in uncached],
+            [keys[idx] for idx in uncached],
+        )
+
+    def _cached_check(
+        self,
+        doc: BaseDocument,
+        paragraphs: List[Interval],
+        keys: List[str],
+        persistent_cache: Optional[PersistentResultCache],
+    ):
+        """
+        Checks the paragraphs without results in the persistent result cache
+        and stores their results.
+        """
+        if persistent_cache is not None:
+            try:
+                stored = persistent_cache.load(keys).result(
+                    timeout=PersistentResultCache.LOAD_TIMEOUT,
+                )
+            except (concurrent.futures.TimeoutError, RuntimeError) as e:
+                logger.warning(f'Could not load the persistent result cache: {e}')
+                stored = dict()
+            paragraphs, keys = self._add_stored_results(doc, paragraphs, keys, stored)
+            if len(paragraphs) == 0:
+                return
+
+        function, args = self._get_paragraph_check(doc, paragraphs)
+        results = _CheckResults()
+        token = _check_results.set(results)
+        try:
+            function(doc, *args)
+        finally:
+            _check_results.reset(token)
+        self._cache_results(doc, paragraphs, keys, results)
+
+    async def _async_cached_check(
+        self,
+        doc: BaseDocument,
+        paragraphs: List[Interval],
+        keys: List[str],
+        persistent_cache: Optional[PersistentResultCache],
+    ):
+        if persistent_cache is not None:
+            try:
+                stored = await asyncio.wait_for(
+                    asyncio.wrap_future(persistent_cache.load(keys)),
+                    PersistentResultCache.LOAD_TIMEOUT,
+                )
+            except (asyncio.TimeoutError, RuntimeError) as e:
+                logger.warning(f'Could not load the persistent result cache: {e}')
+                stored = dict()
+            paragraphs, keys = self._add_stored_results(doc, paragraphs, keys, stored)
+            if len(paragraphs) == 0:
+                return
+
+        function, args = self._get_paragraph_check(doc, paragraphs)
+        results = _CheckResults()
+        token = _check_results.set(results)
+        try:
+            res = function(doc, *args)
+            if inspect.isawaitable(res):
+                await res
+        finally:
+            _check_results.reset(token)
+        self._cache_results(doc, paragraphs, keys, results)
+
+    async def gather_requests(self, coroutines: Iterable[Awaitable]) -> list:
+        """
+        Awaits the coroutines of a check, e.g. the requests of its paragraphs,
+        at most `max_requests` of them at the same time. The results are in
+        the order of the coroutines.
+        """
+        semaphore = asyncio.Semaphore(max(1, int(self.config.get(
+            Analyser.CONFIGURATION_MAX_REQUESTS,
+            Analyser.DEFAULT_MAX_REQUESTS,
+        ))))
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[run(coroutine) for coroutine in coroutines])
+
+    def get_debounce(self) -> float:
+        return max(0.0, float(self.config.get(
+            Analyser.CONFIGURATION_DEBOUNCE,
+            Analyser.DEFAULT_DEBOUNCE,
+        )))
+
+    def get_concurrency(self) -> int:
+        return max(1, int(self.config.get(
+            Analyser.CONFIGURATION_CONCURRENCY,
+            Analyser.DEFAULT_CONCURRENCY,
+        )))
+
+    def get_progress_bar(self) -> ProgressBar:
+        return ProgressBar(
+            self.language_server,
+            f'{self.name} checking',
+            token=self._progressbar_token,
+        )
+
     def update_settings(self, settings):
         self.config = merge_dicts(self.config, settings)
 
     def close(self):
-        pass
+        if getattr(self, '_persistent_result_cache', None) is not None:
+            self._persistent_result_cache.close()
+            self._persistent_result_cache = None
 
     def get_document(self, document_descriptor) -> BaseDocument:
         if type(document_descriptor) != str:
@@ -379,12 +1311,21 @@ class Analyser():
     def get_diagnostics(self, doc: TextDocument):
         return self._diagnostics_dict.get(doc.uri, PositionDict())
 
+    @_on_loop_thread
     def add_diagnostics(self, doc: TextDocument, diagnostics: List[Diagnostic]):
+        results = _check_results.get()
+        if results is not None:
+            results.diagnostics.extend(copy.deepcopy(diagnostics))
+        if self._is_outdated(doc):
+            return
         for diag in diagnostics:
             self._diagnostics_dict[doc.uri].add(diag.range.start, diag)
         self.language_server.publish_stored_diagnostics(doc)
 
+    @_on_loop_thread
     def remove_code_items_at_range(self, doc: TextDocument, pos_range: Range, inclusive=(True, True)):
+        if self._is_outdated(doc):
+            return 0
         num = 0
         num += self._diagnostics_dict[doc.uri].remove_between(pos_range, inclusive)
         num += self._code_actions_dict[doc.uri].remove_between(pos_range, inclusive)
@@ -417,7 +1358,8 @@ class Analyser():
             )
         ]
 
-        if not (
+        # paragraphs are looked up in the cleaned source
+        if not doc.is_large and not (
             self.should_run_on(self.CONFIGURATION_CHECK_ON_CHANGE)
             or self.should_run_on(self.CONFIGURATION_CHECK_ON_SAVE)
         ):
@@ -473,7 +1415,13 @@ class Analyser():
 
         return res
 
+    @_on_loop_thread
     def add_code_actions(self, doc: TextDocument, actions: List[CodeAction]):
+        results = _check_results.get()
+        if results is not None:
+            results.code_actions.extend(copy.deepcopy(actions))
+        if self._is_outdated(doc):
+            return
         for action in actions:
             self._code_actions_dict[doc.uri].add(
                 action.edit.document_changes[0].edits[0].range.start,
@@ -524,30 +1472,14 @@ class Analyser():
         self.init_diagnostics(doc)
         self.init_code_actions(doc)
 
-    def _command_analyse(self, doc: BaseDocument, interval: Interval = None):
-        if interval is not None:
-            self._did_change(doc, [interval])
-        else:
-            self._did_open(doc)
-
     def command_analyse(self, **kwargs):
         doc = self.get_document(kwargs['uri'])
         if 'interval' in kwargs:
             interval = kwargs['interval']
             interval = Interval(interval['start'], interval['length'])
-            with ProgressBar(
-                    self.language_server,
-                    f'{self.name} checking',
-                    token=self._progressbar_token
-            ):
-                self._command_analyse(doc, interval)
+            self._schedule_check(self._did_change, doc, [interval])
         else:
-            with ProgressBar(
-                    self.language_server,
-                    f'{self.name} checking',
-                    token=self._progressbar_token
-            ):
-                self._command_analyse(doc)
+            self._schedule_document_checks(doc)
             self._checked_documents.add(kwargs['uri'])
 
     def get_completions(self, params: Optional[CompletionParams] = None) -> Optional[CompletionList]:
@@ -1,5 +1,5 @@
 import logging
-import requests
+import httpx
 import urllib.parse
 import bisect
 
@@ -46,6 +46,7 @@ class GrammarBotAnalyser(Analyser):
             'X-RapidAPI-Key': self.config[GrammarBotAnalyser.CONFIGURATION_API_KEY],
             'X-RapidAPI-Host': 'grammarbot.p.rapidapi.com'
         }
+        self._client = httpx.AsyncClient()
 
     def _handle_analyses(self, doc: BaseDocument, analyses, text_sections=None):
         diagnostics = list()
@@ -55,19 +56,29 @@ class GrammarBotAnalyser(Analyser):
         if text_sections is not None:
             text_ends = [section[1] for section in text_sections]
 
+        # the analyses might be a generator
+        analyses = list(analyses)
+        offsets = list()
         for match in analyses:
             offset = match['offset']
-            length = match['length']
             if text_ends is not None:
                 idx = bisect.bisect_left(text_ends, offset)
                 if idx == 0:
                     offset = text_sections[idx][0] + offset
                 else:
                     offset = text_sections[idx][0] + offset - text_ends[idx-1]
+            offsets.append(offset)
+        ranges = doc.ranges_at_offsets(
+            offsets,
+            [match['length']+1 for match in analyses],
+            True,
+        )
 
+        for match, offset, range in zip(analyses, offsets, ranges):
+            length = match['length']
             token = source[offset:offset+length]
             diagnostic = Diagnostic(
-                range=doc.range_at_offset(offset, length+1, True),
+                range=range,
                 message=f'"{token}": {match["message"]}',
                 source='grammarbot',
                 severity=self.get_severity(),
@@ -90,15 +101,15 @@ class GrammarBotAnalyser(Analyser):
 
         return diagnostics, code_actions
 
-    def _did_open(self, doc: BaseDocument):
+    async def _did_open(self, doc: BaseDocument):
         diagnostics, code_actions = self._handle_analyses(
             doc,
-            self._analyse_text(doc.cleaned_source)
+            await self._analyse_text(doc.cleaned_source)
         )
         self.add_diagnostics(doc, diagnostics)
         self.add_code_actions(doc, code_actions)
 
-    def _did_change(self, doc: BaseDocument, changes: List[Interval]):
+    async def _did_change(self, doc: BaseDocument, changes: List[Interval]):
         text = ''
         # (in_text_start_offset, in_analysis_text_end_offset_inclusive)
         text_sections = list()
@@ -128,14 +139,14 @@ class GrammarBotAnalyser(Analyser):
 
         diagnostics, code_actions = self._handle_analyses(
             doc,
-            self._analyse_text(text),
+            await self._analyse_text(text),
             text_sections
         )
 
         self.add_diagnostics(doc, diagnostics)
         self.add_code_actions(doc, code_actions)
 
-    def _analyse_text(self, text):
+    async def _analyse_text(self, text) -> List[dict]:
         spans = list(batch_text(
             text,
             TEXT_PASSAGE_PATTERN,
@@ -150,15 +161,22 @@ class GrammarBotAnalyser(Analyser):
             # Safety measure
             raise AnalysisError(f'Too large input. Size: {len(spans)}, max: {limit}')
 
+        res = list()
         offset = 0
-        for span in spans:
-            for item in self._analyse_api_call(span):
+        # the spans are requested concurrently
+        for span, matches in zip(spans, await self.gather_requests(
+            self._analyse_api_call(span)
+            for span in spans
+        )):
+            for item in matches:
                 item['offset'] += offset
-                yield item
+                res.append(item)
 
             offset += len(span)
 
-    def _analyse_api_call(self, text):
+        return res
+
+    async def _analyse_api_call(self, text) -> List[dict]:
         if self._remaining_requests is not None:
             overflow = self.config.setdefault(
                 GrammarBotAnalyser.CONFIGURATION_REQUESTS_OVERFLOW,
@@ -170,10 +188,9 @@ class GrammarBotAnalyser(Analyser):
         urltext = urllib.parse.quote(text)
         payload = f'text={urltext}&language=en-US'
 
-        response = requests.request(
-            "POST",
+        response = await self._client.post(
             GrammarBotAnalyser.URL,
-            data=payload,
+            content=payload,
             headers=self._headers
         )
         data = response.json()
@@ -188,5 +205,4 @@ class GrammarBotAnalyser(Analyser):
             response.headers['X-RateLimit-Requests-Remaining']
         )
 
-        for match in data['matches']:
-            yield match
+        return data['matches']
@@ -1,7 +1,10 @@
 import logging
 import asyncio
+import contextvars
+import inspect
 
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 from lsprotocol.types import MessageType
 from lsprotocol.types import (
     DidOpenTextDocumentParams,
@@ -14,11 +17,14 @@ from lsprotocol.types import (
     CompletionParams,
     CompletionList,
     ShowMessageParams,
+    Range,
+    Position,
 )
 from pygls.workspace import TextDocument
 
 from .. import analysers
-from .analyser import Analyser, AnalysisError
+from .analyser import Analyser, AnalysisError, ScheduledCheck, OUTDATED_RESULTS_DROPPED
+from ..documents.document import ChangeJournal, CleanableDocument
 from ..utils import get_class
 from ..types import ConfigurationError, ProgressBar
 
@@ -31,6 +37,26 @@ class AnalyserHandler:
     def __init__(self, language_server, settings=None):
         self.language_server = language_server
         self.analysers = dict()
+        # changes of the open documents shared by the analysers
+        self._change_journals = dict()
+        # the events of a document are handled one at a time, in order
+        self._document_locks = dict()
+        # the checks of the analysers are run on worker threads, so that
+        # they do not block the event loop
+        self._executor = ThreadPoolExecutor(thread_name_prefix='textLSP-analyser')
+        # (concurrency, semaphore) limiting the running checks per analyser
+        self._analyser_semaphores = dict()
+        # uri -> analyser name -> debounced task checking the changes
+        self._change_checks = dict()
+        # uri -> (visible ranges, cursor position) reported by the client
+        self._viewports = dict()
+        # uri -> analyser name -> (task, checks) running the checks outside
+        # the visible ranges after the event of the document was handled
+        self._background_checks = dict()
+        # uri -> names of the analysers whose background checks were
+        # cancelled by a change, their document checks are resumed once the
+        # document does not change
+        self._interrupted_checks = dict()
         self.update_settings(settings)
 
     def update_settings(self, settings):
@@ -74,8 +100,13 @@ class AnalyserHandler:
                 analyser.close()
 
     def shutdown(self):
+        for uri in list(self._change_checks):
+            self._cancel_change_checks(uri)
+        for uri in list(self._background_checks):
+            self._cancel_background_checks(uri)
         for analyser in self.analysers.values():
             analyser.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
     def get_diagnostics(self, doc: TextDocument):
         try:
@@ -110,6 +141,269 @@ class AnalyserHandler:
 
         return res if len(res) > 0 else None
 
+    def _get_analyser_semaphore(self, analyser_name: str, analyser: Analyser) -> asyncio.Semaphore:
+        concurrency = analyser.get_concurrency()
+        item = self._analyser_semaphores.get(analyser_name)
+        if item is None or item[0] != concurrency:
+            item = (concurrency, asyncio.Semaphore(concurrency))
+            self._analyser_semaphores[analyser_name] = item
+        return item[1]
+
+    async def _run_check(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        analyser: Analyser,
+        check: ScheduledCheck,
+    ):
+        function, args, _, _ = check
+        if inspect.iscoroutinefunction(function):
+            # asynchronous checks wait for I/O on the event loop
+            await function(*args)
+            return
+
+        future = loop.run_in_executor(
+            self._executor,
+            contextvars.copy_context().run,
+            analyser.run_check,
+            loop,
+            function,
+            args,
+        )
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # worker threads cannot be interrupted, the analyser is busy
+            # until the check finishes
+            await asyncio.wait([future])
+            raise
+
+    async def _run_checks(self, analyser_name: str, analyser: Analyser):
+        """
+        Runs the checks scheduled by the analyser. The checks of the cursor
+        and the visible ranges are run before this returns, so that the next
+        event of the document shifts their results. The other ones are run
+        in the background, until the next change of the document.
+        """
+        checks = analyser.pop_scheduled_checks()
+        background = [check for check in checks if self._is_background_check(check)]
+        if len(background) > 0:
+            checks = [check for check in checks if not self._is_background_check(check)]
+
+        await self._run_check_list(analyser_name, analyser, checks)
+        for check in background:
+            self._schedule_background_check(analyser_name, analyser, check)
+
+    async def _run_check_list(
+        self,
+        analyser_name: str,
+        analyser: Analyser,
+        checks: List[ScheduledCheck],
+    ):
+        """
+        Runs the checks on worker threads, or on the event loop if they are
+        asynchronous, at most `concurrency` of them at the same time. The
+        checks closest to the cursor and the visible ranges are run first.
+        Checks added to the list while it runs are run as well.
+        """
+        if len(checks) == 0:
+            return
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._get_analyser_semaphore(analyser_name, analyser)
+
+        async def run_next():
+            async with semaphore:
+                # the viewport might change while the checks are running
+                idx = min(
+                    range(len(checks)),
+                    key=lambda idx: self._get_check_priority(checks[idx]),
+                )
+                await self._run_check(loop, analyser, checks.pop(idx))
+
+        with analyser.get_progress_bar():
+            while len(checks) > 0:
+                tasks = [asyncio.create_task(run_next()) for _ in checks]
+                try:
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                except asyncio.CancelledError:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.wait(tasks)
+                    raise
+
+                for res in results:
+                    if isinstance(res, BaseException):
+                        raise res
+
+    def _is_background_check(self, check: ScheduledCheck) -> bool:
+        # neither the cursor nor the visible ranges
+        return check.uri is not None and self._get_check_priority(check) > (0, 0)
+
+    def _schedule_background_check(
+        self,
+        analyser_name: str,
+        analyser: Analyser,
+        check: ScheduledCheck,
+    ):
+        background_checks = self._background_checks.setdefault(check.uri, dict())
+        item = background_checks.get(analyser_name)
+        if item is not None and not item[0].done():
+            # picked up by the running task
+            item[1].append(check)
+            return
+
+        checks = [check]
+        task = asyncio.create_task(
+            self._run_background_checks(analyser_name, analyser, check.uri, checks)
+        )
+        background_checks[analyser_name] = (task, checks)
+
+    def _cancel_background_checks(self, uri: str, interrupted=False):
+        """
+        Cancels the background checks of the document. If `interrupted`, the
+        document checks of the analysers are resumed once the document does
+        not change.
+        """
+        for analyser_name, (task, _) in self._background_checks.pop(uri, dict()).items():
+            if not task.done():
+                task.cancel()
+                if interrupted:
+                    self._interrupted_checks.setdefault(uri, set()).add(analyser_name)
+        if not interrupted:
+            self._interrupted_checks.pop(uri, None)
+
+    async def _run_background_checks(
+        self,
+        analyser_name: str,
+        analyser: Analyser,
+        uri: str,
+        checks: List[ScheduledCheck],
+    ):
+        # the document might change while the checks are running
+        OUTDATED_RESULTS_DROPPED.set(True)
+        try:
+            await self._run_check_list(analyser_name, analyser, checks)
+        except AnalysisError as e:
+            self.language_server.window_show_message(
+                ShowMessageParams(
+                    message=str(f"{analyser_name}: {e}"),
+                    type=MessageType.Error,
+                )
+            )
+        except Exception as e:
+            self.language_server.window_show_message(
+                ShowMessageParams(
+                    message=str("Server error. See log for details."),
+                    type=MessageType.Error,
+                )
+            )
+            logger.exception(str(e))
+        finally:
+            background_checks = self._background_checks.get(uri)
+            if (
+                background_checks is not None
+                and background_checks.get(analyser_name, (None,))[0] is asyncio.current_task()
+            ):
+                del background_checks[analyser_name]
+
+    def _get_check_priority(self, check: ScheduledCheck) -> Tuple[int, int]:
+        """
+        Returns a key ordering the check of the paragraph of the cursor first,
+        then the visible ones, then the rest by their distance from the
+        visible lines.
+        """
+        viewport = self._viewports.get(check.uri)
+        if viewport is None or check.position_range is None:
+            return (0, 0)
+
+        ranges, cursor = viewport
+        start = check.position_range.start.line
+        end = check.position_range.end.line
+        if cursor is not None and start <= cursor.line <= end:
+            return (-1, 0)
+
+        lines = [(pos_range.start.line, pos_range.end.line) for pos_range in ranges]
+        if cursor is not None:
+            lines.append((cursor.line, cursor.line))
+        return (0, min(
+            max(0, first_line - end, start - last_line)
+            for first_line, last_line in lines
+        ))
+
+    def _schedule_change_check(
+        self,
+        analyser_name: str,
+        analyser: Analyser,
+        uri: str,
+        version: int,
+    ):
+        checks = self._change_checks.setdefault(uri, dict())
+        task = checks.pop(analyser_name, None)
+        if task is not None:
+            task.cancel()
+        checks[analyser_name] = asyncio.create_task(
+            self._check_changes(analyser_name, analyser, uri, version)
+        )
+
+    def _cancel_change_checks(self, uri: str):
+        for task in self._change_checks.pop(uri, dict()).values():
+            task.cancel()
+
+    async def _check_changes(
+        self,
+        analyser_name: str,
+        analyser: Analyser,
+        uri: str,
+        version: int,
+    ):
+        """
+        Checks the changes of a document once it did not change for the
+        debounce time of the analyser. It is cancelled by the next change and
+        the results of the outdated checks are dropped.
+        """
+        try:
+            await asyncio.sleep(analyser.get_debounce())
+            lock = self._document_locks.get(uri)
+            if lock is None:
+                return
+
+            async with lock:
+                doc = self.language_server.workspace.get_text_document(uri)
+                # a newer change is waiting for the lock
+                if doc.version != version:
+                    return
+
+                OUTDATED_RESULTS_DROPPED.set(True)
+                try:
+                    scheduled = analyser.check_changes(uri)
+                    interrupted = self._interrupted_checks.get(uri, set())
+                    if analyser_name in interrupted:
+                        interrupted.discard(analyser_name)
+                        analyser.resume_document_checks(uri)
+                        scheduled = True
+                    if scheduled:
+                        await self._run_checks(analyser_name, analyser)
+                except AnalysisError as e:
+                    self.language_server.window_show_message(
+                        ShowMessageParams(
+                            message=str(f"{analyser_name}: {e}"),
+                            type=MessageType.Error,
+                        )
+                    )
+                analyser.finish_checking_changes(uri, version)
+        except Exception as e:
+            self.language_server.window_show_message(
+                ShowMessageParams(
+                    message=str("Server error. See log for details."),
+                    type=MessageType.Error,
+                )
+            )
+            logger.exception(str(e))
+        finally:
+            checks = self._change_checks.get(uri)
+            if checks is not None and checks.get(analyser_name) is asyncio.current_task():
+                del checks[analyser_name]
+
     async def _submit_task(self, function, *args, **kwargs):
         functions = list()
         for name, analyser in self.analysers.items():
@@ -135,6 +429,16 @@ class AnalyserHandler:
                 )
                 logger.exception(str(e))
 
+    async def _clean_document(self, uri: str):
+        """
+        Waits until the document is cleaned on a worker thread, so that the
+        analysers do not clean it on the event loop.
+        """
+        doc = self.language_server.workspace.get_text_document(uri)
+        # large documents are only cleaned in regions
+        if isinstance(doc, CleanableDocument) and not doc.is_large:
+            await doc.wait_cleaned_source()
+
     async def _did_open(
         self,
         analyser_name: str,
@@ -145,6 +449,7 @@ class AnalyserHandler:
             analyser.did_open(
                 params,
             )
+            await self._run_checks(analyser_name, analyser)
         except AnalysisError as e:
             self.language_server.window_show_message(
                 ShowMessageParams(
@@ -154,7 +459,12 @@ class AnalyserHandler:
             )
 
     async def did_open(self, params: DidOpenTextDocumentParams):
-        await self._submit_task(self._did_open, params=params)
+        uri = params.text_document.uri
+        self._cancel_change_checks(uri)
+        self._cancel_background_checks(uri)
+        async with self._document_locks.setdefault(uri, asyncio.Lock()):
+            await self._clean_document(uri)
+            await self._submit_task(self._did_open, params=params)
 
     async def _did_change(
         self,
@@ -166,6 +476,18 @@ class AnalyserHandler:
             analyser.did_change(
                 params,
             )
+            await self._run_checks(analyser_name, analyser)
+            uri = params.text_document.uri
+            if (
+                analyser.has_unchecked_changes(uri)
+                or analyser_name in self._interrupted_checks.get(uri, set())
+            ):
+                self._schedule_change_check(
+                    analyser_name,
+                    analyser,
+                    uri,
+                    params.text_document.version,
+                )
         except AnalysisError as e:
             self.language_server.window_show_message(
                 ShowMessageParams(
@@ -175,7 +497,13 @@ class AnalyserHandler:
             )
 
     async def did_change(self, params: DidChangeTextDocumentParams):
-        await self._submit_task(self._did_change, params=params)
+        uri = params.text_document.uri
+        # the checks of the earlier changes are outdated
+        self._cancel_change_checks(uri)
+        self._cancel_background_checks(uri, interrupted=True)
+        async with self._document_locks.setdefault(uri, asyncio.Lock()):
+            await self._clean_document(uri)
+            await self._submit_task(self._did_change, params=params)
 
     async def _did_save(
         self,
@@ -187,6 +515,7 @@ class AnalyserHandler:
             analyser.did_save(
                 params,
             )
+            await self._run_checks(analyser_name, analyser)
         except AnalysisError as e:
             self.language_server.window_show_message(
                 ShowMessageParams(
@@ -196,7 +525,10 @@ class AnalyserHandler:
             )
 
     async def did_save(self, params: DidSaveTextDocumentParams):
-        await self._submit_task(self._did_save, params=params)
+        uri = params.text_document.uri
+        async with self._document_locks.setdefault(uri, asyncio.Lock()):
+            await self._clean_document(uri)
+            await self._submit_task(self._did_save, params=params)
 
     async def _did_close(
         self, analyser_name: str, analyser: Analyser, params: DidCloseTextDocumentParams
@@ -206,7 +538,52 @@ class AnalyserHandler:
         )
 
     async def did_close(self, params: DidCloseTextDocumentParams):
-        await self._submit_task(self._did_close, params=params)
+        uri = params.text_document.uri
+        self._cancel_change_checks(uri)
+        self._cancel_background_checks(uri)
+        self._viewports.pop(uri, None)
+        async with self._document_locks.setdefault(uri, asyncio.Lock()):
+            await self._submit_task(self._did_close, params=params)
+            self._change_journals.pop(uri, None)
+        self._document_locks.pop(uri, None)
+
+    async def _did_change_visible_ranges(
+        self,
+        analyser_name: str,
+        analyser: Analyser,
+        uri: str,
+        ranges: List[Range],
+    ):
+        try:
+            analyser.did_change_visible_ranges(uri, ranges)
+            await self._run_checks(analyser_name, analyser)
+        except AnalysisError as e:
+            self.language_server.window_show_message(
+                ShowMessageParams(
+                    message=str(f"{analyser_name}: {e}"),
+                    type=MessageType.Error,
+                )
+            )
+
+    async def did_change_visible_ranges(
+        self,
+        uri: str,
+        ranges: List[Range],
+        cursor: Optional[Position] = None,
+    ):
+        """
+        Prioritises the checks of the visible ranges and the cursor, and
+        analyses the regions of large documents which are visible in the
+        client.
+        """
+        # taken into account by the running checks of the document as well
+        self._viewports[uri] = (ranges, cursor)
+        async with self._document_locks.setdefault(uri, asyncio.Lock()):
+            await self._submit_task(
+                self._did_change_visible_ranges,
+                uri=uri,
+                ranges=ranges,
+            )
 
     async def _command_analyse(
         self,
@@ -216,6 +593,7 @@ class AnalyserHandler:
     ):
         try:
             analyser.command_analyse(*args)
+            await self._run_checks(analyser_name, analyser)
         except AnalysisError as e:
             self.language_server.window_show_message(
                 ShowMessageParams(
@@ -231,6 +609,7 @@ class AnalyserHandler:
             analyser = self.analysers[analyser_name]
             try:
                 analyser.command_analyse(**kwargs)
+                await self._run_checks(analyser_name, analyser)
             except AnalysisError as e:
                 self.language_server.window_show_message(
                     ShowMessageParams(
@@ -258,7 +637,9 @@ class AnalyserHandler:
 
         if hasattr(analyser, ext_command):
             try:
-                getattr(analyser, ext_command)(**kwargs)
+                res = getattr(analyser, ext_command)(**kwargs)
+                if inspect.isawaitable(res):
+                    await res
             except Exception as e:
                 self.language_server.window_show_message(
                     ShowMessageParams(
@@ -277,11 +658,19 @@ class AnalyserHandler:
                 )
             )
 
+    def get_change_journal(self, doc: TextDocument) -> ChangeJournal:
+        journal = self._change_journals.get(doc.uri)
+        if journal is None:
+            journal = ChangeJournal(doc, not doc.is_large)
+            self._change_journals[doc.uri] = journal
+        return journal
+
     def update_document(
         self, doc: TextDocument, change: TextDocumentContentChangeEvent
     ):
-        for name, analyser in self.analysers.items():
-            analyser.update_document(doc, change)
+        journal = self._change_journals.get(doc.uri)
+        if journal is not None:
+            journal.update_document(change, doc)
 
     def get_completions(
         self, params: Optional[CompletionParams] = None
@@ -114,11 +114,17 @@ class HFCheckerAnalyser(Analyser):
                     edit.offset -= 1
                     edit.length += 1
 
-            token = edit.old_token
-
             if edit.offset+offset >= len(doc.cleaned_source):
                 edit.offset -= 1
-            range = doc.range_at_offset(edit.offset+offset, edit.length, True)
+
+        ranges = doc.ranges_at_offsets(
+            [edit.offset+offset for edit in edits],
+            [edit.length for edit in edits],
+            True,
+        )
+        for edit, range in zip(edits, ranges):
+            token = edit.old_token
+
             range = Range(
                 start=range.start,
                 end=Position(
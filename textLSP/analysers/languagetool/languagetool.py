@@ -35,12 +35,17 @@ class LanguageToolAnalyser(Analyser):
     def _analyse(self, text, doc, offset=0) -> Tuple[List[Diagnostic], List[CodeAction]]:
         diagnostics = list()
         code_actions = list()
-        matches = self._get_tool_for_language(doc.language).check(text)
-
-        for match in matches:
+        language = doc.language_at_interval(Interval(offset, len(text)), True)
+        matches = self._get_tool_for_language(language).check(text)
+        ranges = doc.ranges_at_offsets(
+            [match.offset+offset for match in matches],
+            [match.error_length for match in matches],
+            True,
+        )
+
+        for match, range in zip(matches, ranges):
             token = text[match.offset:match.offset+match.error_length]
 
-            range = doc.range_at_offset(match.offset+offset, match.error_length, True)
             range = Range(
                 start=range.start,
                 end=Position(
@@ -159,8 +164,9 @@ class LanguageToolAnalyser(Analyser):
     def _did_close(self, doc: BaseDocument):
         workspace = self.language_server.workspace
         doc_langs = {
-            document.language
+            lang
             for _, document in workspace.documents.items()
+            for lang in document.languages
         }
         tool_langs = set(self.tools.keys())
 
@@ -184,6 +190,7 @@ class LanguageToolAnalyser(Analyser):
         for lang, tool in self.tools.items():
             tool.close()
         self.tool = dict()
+        super().close()
 
     def __del__(self):
         self.close()
@@ -86,7 +86,9 @@ class OllamaAnalyser(Analyser):
                 logger.exception(e, stack_info=True)
                 raise ConfigurationError(f"{self.name}: {e}")
 
-    def _generate(self, prompt, options=None, keep_alive=None):
+        self._client = ollama.AsyncClient()
+
+    async def _generate(self, prompt, options=None, keep_alive=None):
         logger.debug(f"Generating for input: {prompt}")
         if options is None:
             options = {
@@ -100,7 +102,7 @@ class OllamaAnalyser(Analyser):
                 self.CONFIGURATION_KEEP_ALIVE, self.SETTINGS_DEFAULT_KEEP_ALIVE
             )
         try:
-            res = ollama.chat(
+            res = await self._client.chat(
                 model=self.config.get(
                     self.CONFIGURATION_MODEL, self.SETTINGS_DEFAULT_MODEL
                 ),
@@ -120,7 +122,7 @@ class OllamaAnalyser(Analyser):
 
         return res
 
-    def _analyse(
+    async def _analyse(
         self, text, doc, offset=0
     ) -> Tuple[List[Diagnostic], List[CodeAction]]:
         diagnostics = list()
@@ -129,10 +131,11 @@ class OllamaAnalyser(Analyser):
         # we don not want trailing whitespace
         text = text.rstrip()
 
-        res = self._generate(
+        res = await self._generate(
             prompt=f"{self.config.get(self.CONFIGURATION_EDIT_INSTRUCTION, self.SETTINGS_DEFAULT_EDIT_INSTRUCTION)}{text}",
         )
         if res is None:
+            self._skip_result_cache()
             return [], []
 
         edits = TokenDiff.token_level_diff(text, res['message']['content'].strip())
@@ -147,9 +150,14 @@ class OllamaAnalyser(Analyser):
                     edit.offset -= 1
                     edit.length += 1
 
+        ranges = doc.ranges_at_offsets(
+            [edit.offset + offset for edit in edits],
+            [edit.length for edit in edits],
+            True,
+        )
+        for edit, range in zip(edits, ranges):
             token = edit.old_token
 
-            range = doc.range_at_offset(edit.offset + offset, edit.length, True)
             range = Range(
                 start=range.start,
                 end=Position(
@@ -186,24 +194,14 @@ class OllamaAnalyser(Analyser):
 
         return diagnostics, code_actions
 
-    def _did_open(self, doc: BaseDocument):
-        diagnostics = list()
-        code_actions = list()
-        checked = set()
-        for paragraph in doc.paragraphs_at_offset(
-            0, len(doc.cleaned_source), cleaned=True
-        ):
-            diags, actions = self._handle_paragraph(doc, paragraph)
-            diagnostics.extend(diags)
-            code_actions.extend(actions)
-            checked.add(paragraph)
-
-        self.add_diagnostics(doc, diagnostics)
-        self.add_code_actions(doc, code_actions)
+    async def _did_open(self, doc: BaseDocument):
+        await self._handle_paragraphs(
+            doc,
+            doc.paragraphs_at_offset(0, len(doc.cleaned_source), cleaned=True),
+        )
 
-    def _did_change(self, doc: BaseDocument, changes: List[Interval]):
-        diagnostics = list()
-        code_actions = list()
+    async def _did_change(self, doc: BaseDocument, changes: List[Interval]):
+        paragraphs = list()
         checked = set()
         for change in changes:
             for paragraph in doc.paragraphs_at_offset(
@@ -214,15 +212,26 @@ class OllamaAnalyser(Analyser):
                 if paragraph in checked:
                     continue
 
-                diags, actions = self._handle_paragraph(doc, paragraph)
-                diagnostics.extend(diags)
-                code_actions.extend(actions)
+                paragraphs.append(paragraph)
                 checked.add(paragraph)
 
+        await self._handle_paragraphs(doc, paragraphs)
+
+    async def _handle_paragraphs(self, doc: BaseDocument, paragraphs: List[Interval]):
+        diagnostics = list()
+        code_actions = list()
+        # the paragraphs are requested concurrently
+        for diags, actions in await self.gather_requests(
+            self._handle_paragraph(doc, paragraph)
+            for paragraph in paragraphs
+        ):
+            diagnostics.extend(diags)
+            code_actions.extend(actions)
+
         self.add_diagnostics(doc, diagnostics)
         self.add_code_actions(doc, code_actions)
 
-    def _handle_paragraph(self, doc: BaseDocument, paragraph: Interval):
+    async def _handle_paragraph(self, doc: BaseDocument, paragraph: Interval):
         if (
             len(doc.text_at_offset(paragraph.start, paragraph.length, True).strip())
             == 0
@@ -232,7 +241,7 @@ class OllamaAnalyser(Analyser):
         pos_range = doc.range_at_offset(paragraph.start, paragraph.length, True)
         self.remove_code_items_at_range(doc, pos_range)
 
-        diags, actions = self._analyse(
+        diags, actions = await self._analyse(
             doc.text_at_offset(paragraph.start, paragraph.length, True),
             doc,
             paragraph.start,
@@ -247,7 +256,7 @@ class OllamaAnalyser(Analyser):
 
         return diagnostics, code_actions
 
-    def command_generate(self, uri: str, prompt: str, position: str, new_line=True):
+    async def command_generate(self, uri: str, prompt: str, position: str, new_line=True):
         with ProgressBar(
             self.language_server,
             f"{self.name} generating",
@@ -255,7 +264,7 @@ class OllamaAnalyser(Analyser):
         ):
             doc = self.get_document(uri)
 
-            result = self._generate(prompt)
+            result = await self._generate(prompt)
             if result is None:
                 return [], []
 
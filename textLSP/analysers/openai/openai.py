@@ -19,7 +19,7 @@ from lsprotocol.types import (
     VersionedTextDocumentIdentifier,
     WorkspaceEdit,
 )
-from openai import APIError, Omit, OpenAI, omit
+from openai import APIError, AsyncOpenAI, Omit, omit
 from openai.types.shared.reasoning_effort import ReasoningEffort
 from pygls.lsp.server import LanguageServer
 
@@ -87,12 +87,12 @@ class OpenAIAnalyser(Analyser):
         url = self.config.get(self.CONFIGURATION_URL, self.SETTINGS_DEFAULT_URL)
         if url is not None and url.lower() == "none":
             url = None
-        self._client = OpenAI(
+        self._client = AsyncOpenAI(
             api_key=self.config[self.CONFIGURATION_API_KEY],
             base_url=url,
         )
 
-    def _chat_endpoint(
+    async def _chat_endpoint(
         self,
         system_msg: str,
         user_msg: str,
@@ -113,7 +113,7 @@ class OpenAIAnalyser(Analyser):
             messages.append({"role": "user", "content": user_msg}),
 
         logger.debug(f"Input messages: {messages}")
-        res = self._client.chat.completions.create(
+        res = await self._client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
@@ -127,8 +127,8 @@ class OpenAIAnalyser(Analyser):
 
         return res
 
-    def _edit(self, text) -> List[TokenDiff]:
-        res = self._chat_endpoint(
+    async def _edit(self, text) -> List[TokenDiff]:
+        res = await self._chat_endpoint(
             system_msg=self.config.get(
                 self.CONFIGURATION_EDIT_INSTRUCTION,
                 self.SETTINGS_DEFAULT_EDIT_INSTRUCTION,
@@ -161,8 +161,8 @@ class OpenAIAnalyser(Analyser):
 
         return []
 
-    def _generate(self, text) -> Optional[str]:
-        res = self._chat_endpoint(
+    async def _generate(self, text) -> Optional[str]:
+        res = await self._chat_endpoint(
             user_msg=text,
             system_msg=None,
             model=self.config.get(
@@ -195,7 +195,7 @@ class OpenAIAnalyser(Analyser):
 
         return None
 
-    def _analyse(
+    async def _analyse(
         self, text, doc, offset=0
     ) -> Tuple[List[Diagnostic], List[CodeAction]]:
         diagnostics = list()
@@ -205,7 +205,7 @@ class OpenAIAnalyser(Analyser):
         text = text.rstrip()
 
         try:
-            edits = self._edit(text)
+            edits = await self._edit(text)
         except APIError as e:
             self.language_server.window_show_message(
                 ShowMessageParams(
@@ -213,6 +213,7 @@ class OpenAIAnalyser(Analyser):
                     type=MessageType.Error,
                 )
             )
+            self._skip_result_cache()
             edits = []
 
         for edit in edits:
@@ -225,9 +226,14 @@ class OpenAIAnalyser(Analyser):
                     edit.offset -= 1
                     edit.length += 1
 
+        ranges = doc.ranges_at_offsets(
+            [edit.offset + offset for edit in edits],
+            [edit.length for edit in edits],
+            True,
+        )
+        for edit, range in zip(edits, ranges):
             token = edit.old_token
 
-            range = doc.range_at_offset(edit.offset + offset, edit.length, True)
             range = Range(
                 start=range.start,
                 end=Position(
@@ -264,43 +270,46 @@ class OpenAIAnalyser(Analyser):
 
         return diagnostics, code_actions
 
-    def _did_open(self, doc: BaseDocument):
-        diagnostics = list()
-        code_actions = list()
-        checked = set()
-        for paragraph in doc.paragraphs_at_offset(
-            0, len(doc.cleaned_source), cleaned=True
-        ):
-            diags, actions = self._handle_paragraph(doc, paragraph)
-            diagnostics.extend(diags)
-            code_actions.extend(actions)
-            checked.add(paragraph)
-
-        self.add_diagnostics(doc, diagnostics)
-        self.add_code_actions(doc, code_actions)
+    async def _did_open(self, doc: BaseDocument):
+        await self._handle_paragraphs(
+            doc,
+            doc.paragraphs_at_offset(0, len(doc.cleaned_source), cleaned=True),
+        )
 
-    def _did_change(self, doc: BaseDocument, changes: List[Interval]):
-        diagnostics = list()
-        code_actions = list()
+    async def _did_change(self, doc: BaseDocument, changes: List[Interval]):
+        paragraphs = list()
         checked = set()
         for change in changes:
-            paragraph = doc.paragraph_at_offset(
+            # a change can span several paragraphs, e.g. a chunk of a long
+            # document, which are requested one by one
+            for paragraph in doc.paragraphs_at_offset(
                 change.start,
                 min_offset=change.start + change.length - 1,
                 cleaned=True,
-            )
-            if paragraph in checked:
-                continue
+            ):
+                if paragraph in checked:
+                    continue
 
-            diags, actions = self._handle_paragraph(doc, paragraph)
+                paragraphs.append(paragraph)
+                checked.add(paragraph)
+
+        await self._handle_paragraphs(doc, paragraphs)
+
+    async def _handle_paragraphs(self, doc: BaseDocument, paragraphs: List[Interval]):
+        diagnostics = list()
+        code_actions = list()
+        # the paragraphs are requested concurrently
+        for diags, actions in await self.gather_requests(
+            self._handle_paragraph(doc, paragraph)
+            for paragraph in paragraphs
+        ):
             diagnostics.extend(diags)
             code_actions.extend(actions)
-            checked.add(paragraph)
 
         self.add_diagnostics(doc, diagnostics)
         self.add_code_actions(doc, code_actions)
 
-    def _handle_paragraph(self, doc: BaseDocument, paragraph: Interval):
+    async def _handle_paragraph(self, doc: BaseDocument, paragraph: Interval):
         if (
             len(doc.text_at_offset(paragraph.start, paragraph.length, True).strip())
             == 0
@@ -310,7 +319,7 @@ class OpenAIAnalyser(Analyser):
         pos_range = doc.range_at_offset(paragraph.start, paragraph.length, True)
         self.remove_code_items_at_range(doc, pos_range)
 
-        diags, actions = self._analyse(
+        diags, actions = await self._analyse(
             doc.text_at_offset(paragraph.start, paragraph.length, True),
             doc,
             paragraph.start,
@@ -325,7 +334,7 @@ class OpenAIAnalyser(Analyser):
 
         return diagnostics, code_actions
 
-    def command_generate(self, uri: str, prompt: str, position: str, new_line=True):
+    async def command_generate(self, uri: str, prompt: str, position: str, new_line=True):
         with ProgressBar(
             self.language_server,
             f"{self.name} generating",
@@ -334,7 +343,7 @@ class OpenAIAnalyser(Analyser):
             doc = self.get_document(uri)
 
             try:
-                new_text = self._generate(prompt)
+                new_text = await self._generate(prompt)
             except APIError as e:
                 self.language_server.window_show_message(
                     ShowMessageParams(
@@ -1,6 +1,8 @@
 import logging
 import argparse
 
+from .documents.document import TreeSitterDocument
+from .langid import warm_up_language_identifier
 from .server import SERVER
 
 
@@ -25,10 +27,63 @@ def getArguments():
         default='WARNING',
         choices=list(logging._nameToLevel.keys())
     )
+    parser.add_argument(
+        '--grammar-build',
+        action='store_true',
+        help='Clone and build missing or out of date grammar libraries when'
+        ' opening documents, instead of only using the ones built by'
+        ' `build-grammars`.'
+    )
+
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser(
+        'build-grammars',
+        help='Build the tree-sitter grammar libraries into the user cache.'
+    )
+    build_parser.add_argument(
+        '-s',
+        '--source',
+        type=str,
+        action='append',
+        default=list(),
+        metavar='NAME=PATH',
+        help='Build a grammar from a local source folder instead of cloning'
+        ' it, e.g. latex=/path/to/tree-sitter-latex. Can be repeated.'
+    )
+    build_parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        help='Number of grammars built in parallel.'
+    )
+    build_parser.add_argument(
+        '-f',
+        '--force',
+        action='store_true',
+        help='Rebuild up to date libraries as well.'
+    )
 
     return parser.parse_args()
 
 
+def build_grammars(args):
+    source_paths = dict()
+    for source in args.source:
+        name, sep, source_path = source.partition('=')
+        if sep == '':
+            raise SystemExit(f'Invalid grammar source: {source}')
+        source_paths[name] = source_path
+
+    built = TreeSitterDocument.build_libraries(
+        source_paths,
+        args.jobs,
+        args.force,
+    )
+    for name, is_built in sorted(built.items()):
+        status = 'built' if is_built else 'up to date'
+        print(f'{name}: {status} ({TreeSitterDocument.LIB_PATH_TEMPLATE.format(name)})')
+
+
 def main():
     args = getArguments()
 
@@ -38,6 +93,13 @@ def main():
 
     logging.basicConfig(level=logging._nameToLevel[log_level])
 
+    if args.command == 'build-grammars':
+        build_grammars(args)
+        return
+
+    TreeSitterDocument.BUILD_ON_DEMAND = args.grammar_build
+    warm_up_language_identifier()
+
     if address is not None and port is not None:
         SERVER.start_tcp(address, port)
     else:
@@ -1,14 +1,29 @@
+import asyncio
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import copy
+import hashlib
+from importlib.metadata import version
+import json
 import logging
+import mmap
+import os
 from os import path
+import pkgutil
 from platform import system
+import struct
 import sys
 import tempfile
-from dataclasses import dataclass
-from itertools import chain
-from typing import Dict, Generator, List, Optional
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Generator, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
 
 import langdetect
+import numpy as np
 from lsprotocol.types import (
     Position,
     Range,
@@ -18,11 +33,27 @@ from lsprotocol.types import (
 )
 from pygls.workspace import TextDocument
 from pygls.workspace.position_codec import PositionCodec
-from tree_sitter import Language, Node, Parser, Tree
+from tree_sitter import Language, Node, Parser, Query, Tree
 
 from .. import documents
-from ..types import Interval, OffsetPositionInterval, OffsetPositionIntervalList
-from ..utils import get_class, get_user_cache, git_clone, synchronized
+from ..langid import get_language_identifier
+from ..types import (
+    Interval,
+    LineIndex,
+    OffsetPositionIntervalList,
+    Rope,
+    RopeLineIndex,
+    SpanTree,
+    TextBoundaryIndex,
+)
+from ..utils import (
+    INSTANCE_LOCK_ATTRIBUTE,
+    get_class,
+    get_textlsp_version,
+    get_user_cache,
+    git_clone,
+    synchronized_method,
+)
 
 logger = logging.getLogger(__name__)
 _codec = PositionCodec()
@@ -34,10 +65,32 @@ class BaseDocument(TextDocument):
 
     CONFIGURATION_LANGUAGE = 'language'
     CONFIGURATION_MIN_LANG_DETECT = 'min_length_language_detect'
+    CONFIGURATION_LANGUAGE_DETECTOR = 'language_detector'
+    CONFIGURATION_ROPE = 'rope'
+    CONFIGURATION_LARGE_FILE_SIZE = 'large_file_size'
 
     DEFAULT_LANGUAGE = 'auto:en'
     DEFAULT_NATURAL_LANGUAGE = 'en'
     DEFAULT_MIN_LANG_DETECT = 20
+    DEFAULT_LANGUAGE_DETECTOR = 'builtin'
+
+    LANGUAGE_DETECTOR_BUILTIN = 'builtin'
+    LANGUAGE_DETECTOR_LANGDETECT = 'langdetect'
+    DEFAULT_ROPE = False
+    DEFAULT_LARGE_FILE_SIZE = 2_000_000
+
+    # number of characters of long texts used for language detection
+    LANGUAGE_SAMPLE_SIZE = 2000
+    # number of evenly spaced windows the sample is taken from
+    LANGUAGE_SAMPLE_WINDOWS = 4
+    # number of paragraph languages cached per document
+    LANGUAGE_CACHE_SIZE = 1024
+    # maximum number of lines a region is extended with on each side to reach
+    # the paragraph boundaries
+    REGION_MAX_CONTEXT_LINES = 50
+    # single line put on the first line of regions which do not start at the
+    # beginning of the document, so that they are parsed as document content
+    REGION_HEADER = ''
 
     def __init__(self, *args, config: Dict = None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -47,6 +100,77 @@ class BaseDocument(TextDocument):
             self.config = config
 
         self._language = None
+        # (hash, length) of paragraph texts -> detected language
+        self._paragraph_languages = OrderedDict()
+        self._line_index = None
+        self._cleaned_line_index = None
+        self._boundary_index = None
+        self._cleaned_boundary_index = None
+        self._rope = None
+        self._is_large = None
+
+    @property
+    def is_large(self) -> bool:
+        """
+        Whether the document is over the configured size limit. Large documents
+        are not cleaned or analysed as a whole, only the regions returned by
+        `get_region`. It is decided once, when first checked.
+        """
+        if self._is_large is None:
+            limit = self.config.get(
+                BaseDocument.CONFIGURATION_LARGE_FILE_SIZE,
+                BaseDocument.DEFAULT_LARGE_FILE_SIZE,
+            )
+            self._is_large = bool(limit) and self.source_length > limit
+        return self._is_large
+
+    @property
+    def source_length(self) -> int:
+        """
+        The length of the source, without materialising a rope backed source.
+        """
+        if self._rope is not None:
+            return len(self._rope)
+        return len(self.source)
+
+    def get_region(self, position_range: Range) -> Tuple[Range, 'BaseDocument']:
+        """
+        Returns the line range of the paragraphs around the given range and a
+        document of the same type which only contains these lines. The lines
+        before the region are replaced by empty lines, so that positions in the
+        region document are the same as in this document.
+        """
+        lines = self.lines
+        start_line = min(position_range.start.line, len(lines))
+        end_line = min(max(position_range.end.line + 1, start_line), len(lines))
+
+        limit = max(0, start_line - self.REGION_MAX_CONTEXT_LINES)
+        while start_line > limit and lines[start_line-1].strip() != '':
+            start_line -= 1
+        limit = min(len(lines), end_line + self.REGION_MAX_CONTEXT_LINES)
+        while end_line < limit and lines[end_line-1].strip() != '':
+            end_line += 1
+
+        padding = '\n'*start_line
+        if start_line > 0:
+            padding = self.REGION_HEADER + padding
+        region = type(self)(
+            uri=self.uri,
+            source=padding + ''.join(lines[start_line:end_line]),
+            version=self.version,
+            language_id=self.language_id,
+            config=self.config,
+        )
+        region._is_large = False
+        # paragraph languages are cached by their content
+        region._paragraph_languages = self._paragraph_languages
+        return (
+            Range(
+                start=Position(line=start_line, character=0),
+                end=Position(line=end_line, character=0),
+            ),
+            region,
+        )
 
     @property
     def language(self) -> str:
@@ -60,30 +184,293 @@ class BaseDocument(TextDocument):
 
         return self._language
 
-    def _update_language(self, lang: str):
+    @staticmethod
+    def _parse_language(lang: str) -> Tuple[str, str]:
         """
-        Parameters:
-            lang: str -- Language code or `auto` for automatic language detection.
-                         Optionally: `auto:<default>` such as `auto:en`, to set fallback
-                         language in case the content is too short.
+        Returns the language, which is `AUTO_LANG` for automatic detection,
+        and the fallback language of a language setting.
         """
         lang = lang.split(':')
         default_lang = BaseDocument.DEFAULT_NATURAL_LANGUAGE
 
         if len(lang) > 1:
             default_lang = lang[1]
-        lang = lang[0]
+        return lang[0], default_lang
+
+    def _detect_language(self, text: str) -> Optional[str]:
+        """
+        Detects the language of the text, using evenly spaced windows of long
+        texts. Returns None if the text is too short or has no letters.
+        """
+        if len(text) < self.config.get(
+            BaseDocument.CONFIGURATION_MIN_LANG_DETECT, BaseDocument.DEFAULT_MIN_LANG_DETECT
+        ):
+            return None
+
+        if len(text) > self.LANGUAGE_SAMPLE_SIZE:
+            window = self.LANGUAGE_SAMPLE_SIZE // self.LANGUAGE_SAMPLE_WINDOWS
+            step = (len(text) - window) // (self.LANGUAGE_SAMPLE_WINDOWS - 1)
+            text = '\n'.join(
+                text[idx*step:idx*step+window]
+                for idx in range(self.LANGUAGE_SAMPLE_WINDOWS)
+            )
+
+        detector = self.config.get(
+            BaseDocument.CONFIGURATION_LANGUAGE_DETECTOR,
+            BaseDocument.DEFAULT_LANGUAGE_DETECTOR,
+        )
+        if detector == BaseDocument.LANGUAGE_DETECTOR_BUILTIN:
+            return get_language_identifier().detect(text)
+
+        try:
+            return langdetect.detect(text)
+        except langdetect.LangDetectException:
+            return None
+
+    def _update_language(self, lang: str):
+        """
+        Parameters:
+            lang: str -- Language code or `auto` for automatic language detection.
+                         Optionally: `auto:<default>` such as `auto:en`, to set fallback
+                         language in case the content is too short.
+        """
+        lang, default_lang = self._parse_language(lang)
 
         if lang == BaseDocument.AUTO_LANG:
-            if len(self.cleaned_source) >= self.config.get(
-                BaseDocument.CONFIGURATION_MIN_LANG_DETECT, BaseDocument.DEFAULT_MIN_LANG_DETECT
-            ):
-                lang = langdetect.detect(self.cleaned_source)
-            else:
+            # large documents are not cleaned as a whole
+            lang = self._detect_language(
+                self.source if self.is_large else self.cleaned_source
+            )
+            if lang is None:
                 lang = default_lang
 
         self._language = lang
 
+    def _paragraph_language(self, text: str) -> Optional[str]:
+        key = (hash(text), len(text))
+        cache = self._paragraph_languages
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        lang = self._detect_language(text)
+        cache[key] = lang
+        if len(cache) > self.LANGUAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return lang
+
+    def language_at_interval(self, interval: Interval, cleaned=False) -> str:
+        """
+        Returns the language of the paragraphs overlapping the interval, i.e.
+        the language detected in most of the interval. Detections are cached by
+        paragraph content, so only edited paragraphs are detected again. Falls
+        back to the document language if no paragraph is long enough.
+        """
+        lang, _ = self._parse_language(
+            self.config.get(
+                BaseDocument.CONFIGURATION_LANGUAGE, BaseDocument.DEFAULT_LANGUAGE
+            )
+        )
+        if lang != BaseDocument.AUTO_LANG:
+            return lang
+
+        source = self.cleaned_source if cleaned else self.source
+        if interval.start <= 0 and interval.start + interval.length >= len(source):
+            return self.language
+
+        end = interval.start + interval.length
+        lengths = dict()
+        for paragraph in self.paragraphs_at_offset(
+            interval.start,
+            min_offset=end - 1,
+            cleaned=cleaned,
+        ):
+            paragraph_end = paragraph.start + paragraph.length
+            lang = self._paragraph_language(
+                source[paragraph.start:paragraph_end].strip()
+            )
+            if lang is not None:
+                overlap = min(end, paragraph_end) - max(interval.start, paragraph.start)
+                lengths[lang] = lengths.get(lang, 0) + max(1, overlap)
+
+        if len(lengths) == 0:
+            return self.language
+        return max(lengths, key=lengths.get)
+
+    @property
+    def languages(self) -> Set[str]:
+        """
+        The document language and the languages detected in its paragraphs.
+        """
+        res = {
+            lang
+            for lang in self._paragraph_languages.values()
+            if lang is not None
+        }
+        res.add(self.language)
+        return res
+
+    @property
+    def source(self) -> str:
+        if self._rope is not None:
+            return self._rope.text
+        return super().source
+
+    def _use_rope(self) -> bool:
+        use_rope = self.config.get(
+            self.CONFIGURATION_ROPE,
+            self.DEFAULT_ROPE,
+        )
+        if use_rope and self._rope is None:
+            self._rope = Rope(self.source)
+            self._source = None
+        elif not use_rope and self._rope is not None:
+            self._source = self._rope.text
+            self._rope = None
+
+        return use_rope
+
+    def _source_bytes(self) -> bytes:
+        if self._rope is not None:
+            return self._rope.to_bytes()
+        return bytes(self.source, 'utf-8')
+
+    def _byte_offset(self, offset: int) -> int:
+        if self._rope is not None:
+            return self._rope.byte_offset(offset)
+        return self._get_line_index().byte_offset(offset)
+
+    def get_change_offsets(self, change: TextDocumentContentChangePartial):
+        """
+        Returns the start and end offsets of the range replaced by the change
+        in the current version of the source, following the semantics of
+        `TextDocument._apply_incremental_change`.
+        """
+        index = self._get_edit_index()
+        lines = index.lines
+        change_range = self._position_codec.range_from_client_units(
+            lines,
+            change.range,
+        )
+        start_line = change_range.start.line
+        end_line = change_range.end.line
+
+        if start_line == len(lines):
+            length = index.line_start(len(lines))
+            return length, length
+
+        start_offset = index.line_start(start_line) + min(
+            change_range.start.character,
+            len(lines[start_line]),
+        )
+        end_offset = index.line_start(end_line) + min(
+            change_range.end.character,
+            len(lines[end_line]),
+        )
+        return start_offset, end_offset
+
+    def _apply_incremental_change(self, change: TextDocumentContentChangePartial) -> None:
+        start_offset, end_offset = self.get_change_offsets(change)
+        if not self._use_rope():
+            source = self.source
+            self._source = source[:start_offset] + change.text + source[end_offset:]
+            return
+
+        self._rope.replace(start_offset, end_offset, change.text)
+
+    def _apply_full_change(self, change: TextDocumentContentChangeEvent) -> None:
+        super()._apply_full_change(change)
+        if self._rope is not None:
+            self._rope = Rope(self._source)
+            self._source = None
+
+    def apply_change(self, change: TextDocumentContentChangeEvent) -> None:
+        # the indices of the current source are updated instead of rebuilt,
+        # except for rope backed sources, which are not materialised while
+        # editing, so their indices are rebuilt when needed
+        indices = list()
+        change_offsets = None
+        if (
+            isinstance(change, TextDocumentContentChangePartial)
+            and self._is_sync_kind_incremental
+            and not self._use_rope()
+        ):
+            change_offsets = self.get_change_offsets(change)
+            indices = [
+                index
+                for index in (self._boundary_index, self._line_index)
+                if index is not None and index.text is self.source
+            ]
+
+        super().apply_change(change)
+        self._cleaned_line_index = None
+
+        if len(indices) > 0:
+            source = self.source
+            for index in indices:
+                index.update(
+                    source,
+                    change_offsets[0],
+                    change_offsets[1],
+                    len(change.text),
+                )
+        if self._boundary_index not in indices:
+            self._boundary_index = None
+        if self._line_index not in indices:
+            self._line_index = None
+
+    def _get_boundary_index(self, cleaned=False) -> TextBoundaryIndex:
+        """
+        Returns the paragraph and sentence boundary index of the current
+        version of the (cleaned) source.
+        """
+        source = self.source
+        if cleaned:
+            cleaned_source = self.cleaned_source
+            if cleaned_source is not source:
+                if (
+                    self._cleaned_boundary_index is None
+                    or self._cleaned_boundary_index.text is not cleaned_source
+                ):
+                    self._cleaned_boundary_index = TextBoundaryIndex(cleaned_source)
+                return self._cleaned_boundary_index
+
+        if self._boundary_index is None or self._boundary_index.text is not source:
+            self._boundary_index = TextBoundaryIndex(source)
+        return self._boundary_index
+
+    def _get_edit_index(self):
+        """
+        Returns the line index used for locating edits in the source. With a
+        rope backed source this does not materialise the text.
+        """
+        if self._rope is not None and not self._rope.has_irregular_line_breaks:
+            return RopeLineIndex(self._rope)
+        return self._get_line_index()
+
+    def _get_line_index(self, cleaned=False) -> LineIndex:
+        """
+        Returns the line index of the current version of the (cleaned) source.
+        The index is rebuilt lazily whenever the underlying text changed.
+        """
+        source = self.source
+        if cleaned:
+            cleaned_source = self.cleaned_source
+            if cleaned_source is not source:
+                if (
+                    self._cleaned_line_index is None
+                    or self._cleaned_line_index.text is not cleaned_source
+                ):
+                    self._cleaned_line_index = LineIndex(cleaned_source)
+                return self._cleaned_line_index
+
+        if self._line_index is None or self._line_index.text is not source:
+            self._line_index = LineIndex(source)
+        return self._line_index
+
+    @property
+    def lines(self):
+        return self._get_line_index().lines
 
     @property
     def cleaned_source(self) -> str:
@@ -91,24 +478,22 @@ class BaseDocument(TextDocument):
 
     @property
     def cleaned_lines(self):
-        return self.cleaned_source.splitlines(True)
+        return self._get_line_index(True).lines
 
     def position_at_offset(self, offset: int, cleaned=False) -> Position:
-        pos = 0
-        lines = self.cleaned_lines if cleaned else self.lines
-        for lidx, line in enumerate(lines):
-            line_len = len(line)
-            if pos + line_len > offset:
-                return Position(
-                    line=lidx,
-                    character=offset-pos
-                )
-            pos += line_len
+        index = self._get_line_index(cleaned)
+        num_lines = len(index)
+        lidx = index.line_at_offset(offset)
+        if lidx < num_lines:
+            return Position(
+                line=lidx,
+                character=offset-index.line_start(lidx)
+            )
 
-        assert offset == pos, 'Offset it over the document\'s end!'
+        assert offset == index.line_start(num_lines), 'Offset it over the document\'s end!'
         return Position(
-            line=lidx,
-            character=offset-pos
+            line=max(0, num_lines-1),
+            character=0
         )
 
     def range_at_offset(self, offset: int, length: int, cleaned=False) -> Range:
@@ -122,20 +507,19 @@ class BaseDocument(TextDocument):
                 end=start,
             )
 
-        length = start.character + length
-        lines = self.cleaned_lines if cleaned else self.lines
-        for lidx, line in enumerate(lines[start.line:], start.line):
-            line_len = len(line)
-            if line_len >= length:
-                return Range(
-                    start=start,
-                    end=Position(
-                        line=lidx,
-                        character=length-1
-                    )
+        index = self._get_line_index(cleaned)
+        end_offset = index.line_start(start.line) + start.character + length
+        lidx = index.line_ending_at_offset(end_offset, start.line)
+        if lidx < len(index):
+            return Range(
+                start=start,
+                end=Position(
+                    line=lidx,
+                    character=end_offset-index.line_start(lidx)-1
                 )
-            length -= line_len
+            )
 
+        lines = index.lines
         return Range(
             start=start,
             end=Position(
@@ -144,85 +528,89 @@ class BaseDocument(TextDocument):
             )
         )
 
+    @staticmethod
+    def _build_ranges(start_lines, start_characters, end_lines, end_characters) -> List[Range]:
+        return [
+            Range(
+                start=Position(line=start_line, character=start_character),
+                end=Position(line=end_line, character=end_character),
+            )
+            for start_line, start_character, end_line, end_character in zip(
+                start_lines.tolist(),
+                start_characters.tolist(),
+                end_lines.tolist(),
+                end_characters.tolist(),
+            )
+        ]
+
+    def ranges_at_offsets(
+        self,
+        offsets: Sequence[int],
+        lengths: Sequence[int],
+        cleaned=False,
+    ) -> List[Range]:
+        """
+        Returns the same ranges as `range_at_offset()` for each offset and
+        length, looking up all of them at once.
+        """
+        index = self._get_line_index(cleaned)
+        num_lines = len(index)
+        lines = index.lines
+        line_starts = np.asarray(index.line_starts, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+
+        start_lines = np.maximum(np.searchsorted(line_starts, offsets, 'right') - 1, 0)
+        # the end of the document is the start of the last line
+        over_end = start_lines >= num_lines
+        start_lines[over_end] = max(0, num_lines-1)
+        start_characters = offsets - line_starts[start_lines]
+        start_characters[over_end] = 0
+
+        end_offsets = line_starts[start_lines] + start_characters + lengths
+        end_lines = np.maximum(
+            np.searchsorted(line_starts, end_offsets, 'left'),
+            start_lines + 1,
+        ) - 1
+        over_end = end_lines >= num_lines
+        end_lines[over_end] = num_lines-1
+        end_characters = end_offsets - line_starts[end_lines] - 1
+        if num_lines > 0:
+            end_characters[over_end] = len(lines[-1])-1
+
+        empty = lengths == 0
+        end_lines[empty] = start_lines[empty]
+        end_characters[empty] = start_characters[empty]
+
+        return self._build_ranges(start_lines, start_characters, end_lines, end_characters)
+
     def offset_at_position(self, position: Position, cleaned=False) -> int:
         # doesn't really matter
-        lines = self.cleaned_lines if cleaned else self.lines
-        pos = _codec.position_from_client_units(lines, position)
+        index = self._get_line_index(cleaned)
+        pos = _codec.position_from_client_units(index.lines, position)
         row, col = pos.line, pos.character
-        return col + sum(len(line) for line in lines[:row])
+        return col + index.line_start(row)
 
     def text_at_offset(self, offset: int, length: int, cleaned=False) -> Interval:
         source = self.cleaned_source if cleaned else self.source
         return source[offset:offset+length]
 
     def sentence_at_offset(self, offset: int, min_length=0, cleaned=False) -> Interval:
-        start_idx = offset
-        end_idx = offset
-        source = self.cleaned_source if cleaned else self.source
-        len_source = len(source)
-
-        assert start_idx >= 0
-        assert end_idx < len_source
-
-        while True:
-            if start_idx - 2 < 0:
-                start_idx = 0
-                break
-            if source[start_idx-2] in {'.', '!', '?'} and source[start_idx-1] in {' ', '\n'}:
-                break
-            start_idx -= 1
-
-        while end_idx < len_source-1:
-            if (
-                    end_idx >= 1
-                    and source[end_idx-1] in {'.', '!', '?'}
-                    and source[end_idx in {' ', '\n'}]
-                    and end_idx-start_idx+1 >= min_length
-            ):
-                break
-            end_idx += 1
-
-        return Interval(start_idx, end_idx-start_idx+1)
+        return self._get_boundary_index(cleaned).sentence_at_offset(
+            offset,
+            min_length,
+        )
 
     def paragraph_at_offset(self, offset: int, min_length=0, min_offset=0, cleaned=False) -> Interval:
         """
         Returns the last paragraph if offset is over the content length.
         returns (start_offset, length)
         """
-        source = self.cleaned_source if cleaned else self.source
-        len_source = len(source)
-
-        start_idx = offset
-        assert start_idx >= 0
-        if start_idx >= len_source:
-            start_idx = len_source - 1
-        end_idx = start_idx
-
-        while (
-            start_idx >= 0
-            and not (
-                all(source[start_idx-i] == '\n' for i in range(1, min(3, start_idx+1)))
-                or all(source[start_idx-i] == '\n' for i in range(min(2, start_idx+1)))  # empty line
-            )
-        ):
-            start_idx -= 1
-
-        while True:
-            while (
-                end_idx < len_source-1
-                and not (
-                    all(source[end_idx+i] == '\n' for i in range(min(2, len_source-end_idx)))
-                    or all(source[start_idx-i] == '\n' for i in range(min(2, start_idx+1)))  # empty line
-                )
-            ):
-                end_idx += 1
-
-            if end_idx < len_source-1 and (end_idx-start_idx+1 < min_length or end_idx <= min_offset):
-                end_idx += 1
-            else:
-                break
-
-        return Interval(start_idx, end_idx-start_idx+1)
+        return self._get_boundary_index(cleaned).paragraph_at_offset(
+            offset,
+            min_length,
+            min_offset,
+        )
 
     def paragraph_at_position(self, position: Position, cleaned=False) -> Interval:
         offset = self.offset_at_position(position, cleaned)
@@ -264,8 +652,25 @@ class BaseDocument(TextDocument):
 
         return res
 
+    def get_snapshot(self) -> 'BaseDocument':
+        """
+        Returns a copy of the document for reading the current version on
+        another thread, e.g. for cleaning or analysing it. It shares nothing
+        that changes modify in place.
+        """
+        snapshot = copy.copy(self)
+        snapshot._source = self.source
+        snapshot._rope = None
+        snapshot._line_index = None
+        snapshot._cleaned_line_index = None
+        snapshot._boundary_index = None
+        snapshot._cleaned_boundary_index = None
+        snapshot._paragraph_languages = OrderedDict(self._paragraph_languages)
+        snapshot.__dict__.pop(INSTANCE_LOCK_ATTRIBUTE, None)
+        return snapshot
+
     def last_position(self, cleaned=False):
-        lines = self.cleaned_lines if cleaned else self.lines
+        lines = self._get_line_index(cleaned).lines
         return Position(
             line=(len(lines)-1),
             character=len(lines[-1])-1
@@ -273,10 +678,27 @@ class BaseDocument(TextDocument):
 
 
 class CleanableDocument(BaseDocument):
+    # attributes which deep copies share with the original
+    DEEPCOPY_SHARED_ATTRIBUTES = frozenset()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._cleaned_source = None
+        # (source, snapshot, future) of the cleaning running on a worker
+        # thread
+        self._cleaning = None
+
+    def __deepcopy__(self, memo):
+        cls = self.__class__
+        result = cls.__new__(cls)
+        memo[id(self)] = result
+        for k, v in self.__dict__.items():
+            if k in self.DEEPCOPY_SHARED_ATTRIBUTES:
+                setattr(result, k, v)
+            elif k not in {INSTANCE_LOCK_ATTRIBUTE, '_cleaning'}:
+                setattr(result, k, copy.deepcopy(v, memo))
+        result._cleaning = None
+        return result
 
     @property
     def cleaned_source(self) -> str:
@@ -284,11 +706,51 @@ class CleanableDocument(BaseDocument):
             self._sync_clean_source()
         return self._cleaned_source
 
-    @synchronized
+    @synchronized_method
     def _sync_clean_source(self):
         # just so that implementations don't need to remember to use
-        # synchronized
-        self._clean_source()
+        # synchronized_method
+        if self._cleaned_source is None:
+            self._clean_source()
+
+    async def wait_cleaned_source(self) -> str:
+        """
+        Returns the cleaned source. If it is not ready, a snapshot of the
+        current source is cleaned on a worker thread, so that the event loop
+        is not blocked. Concurrent callers wait for the same snapshot.
+        """
+        while self._cleaned_source is None:
+            source = self.source
+            if self._cleaning is None or self._cleaning[0] is not source:
+                snapshot = self.get_snapshot()
+                future = asyncio.get_running_loop().run_in_executor(
+                    None,
+                    snapshot._sync_clean_source,
+                )
+                self._cleaning = (source, snapshot, future)
+
+            source, snapshot, future = self._cleaning
+            try:
+                await asyncio.shield(future)
+            finally:
+                if self._cleaning is not None and self._cleaning[2] is future:
+                    self._cleaning = None
+            # the document might have changed in the meantime
+            if self._cleaned_source is None and self.source is source:
+                self._apply_snapshot(snapshot)
+
+        return self._cleaned_source
+
+    def get_snapshot(self) -> 'CleanableDocument':
+        snapshot = super().get_snapshot()
+        snapshot._cleaning = None
+        return snapshot
+
+    def _apply_snapshot(self, snapshot: 'CleanableDocument'):
+        """
+        Takes over the results of cleaning a snapshot of the current source.
+        """
+        self._cleaned_source = snapshot._cleaned_source
 
     def _clean_source(self):
         raise NotImplementedError()
@@ -309,6 +771,20 @@ class CleanableDocument(BaseDocument):
 
         raise NotImplementedError()
 
+    def ranges_at_offsets(
+        self,
+        offsets: Sequence[int],
+        lengths: Sequence[int],
+        cleaned=False,
+    ) -> List[Range]:
+        if not cleaned:
+            return super().ranges_at_offsets(offsets, lengths, cleaned)
+
+        return [
+            self.range_at_offset(offset, length, cleaned)
+            for offset, length in zip(offsets, lengths)
+        ]
+
     def offset_at_position(self, position: Position, cleaned=False) -> int:
         if not cleaned:
             return super().offset_at_position(position, cleaned)
@@ -376,40 +852,232 @@ class TextNode():
         return len(self.text)
 
 
+@dataclass
+class TextNodeIteratorState():
+    """
+    The state `TreeSitterDocument._iterate_text_nodes()` carries from one
+    capture to the next.
+    """
+    last_sent: Optional[TextNode] = None
+    new_lines_after: List[tuple] = field(default_factory=list)
+
+
+class CleaningCheckpoint(NamedTuple):
+    """
+    Snapshot of the text node iteration before the first capture starting at
+    `point`, from which cleaning can be resumed.
+    """
+    point: tuple
+    # the largest end point of the captures before point
+    max_end: tuple
+    interval_idx: int
+    offset: int
+    last_sent: Optional[TextNode]
+    new_lines_after: tuple
+
+
+class _Resynchronized(Exception):
+    """
+    Stops cleaning once the rest of the text intervals is known.
+    """
+    def __init__(self, checkpoint_idx: int):
+        super().__init__(checkpoint_idx)
+        self.checkpoint_idx = checkpoint_idx
+
+
+class TreeSitterGrammar():
+    """
+    The compiled language and query of a document type, shared by all of its
+    documents. Parsers keep state between parses, so they are handed out
+    from a pool instead.
+    """
+    def __init__(self, language: Language, query: Query, version: str = None):
+        self.language = language
+        self.query = query
+        # description of the sources the language was built from
+        self.version = version
+        self._parsers: List[Parser] = list()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def parser(self) -> Generator[Parser, None, None]:
+        with self._lock:
+            parser = self._parsers.pop() if len(self._parsers) > 0 else None
+        if parser is None:
+            parser = TreeSitterDocument.get_parser(language=self.language)
+        try:
+            yield parser
+        finally:
+            with self._lock:
+                self._parsers.append(parser)
+
+
+class CleaningCache():
+    """
+    On-disk cache of cleaned documents. A file holds the columns of the text
+    intervals, the cleaned source and the detected language of a document,
+    so that unchanged documents are not parsed and cleaned again when they
+    are reopened. Files are read through a memory map and replaced
+    atomically, the least recently used ones are removed.
+    """
+    MAGIC = b'TLSPCLN1'
+    # magic, number of intervals and the sizes of the cleaned source and the
+    # language in bytes
+    HEADER = struct.Struct('<8sQQQ')
+    SUFFIX = '.bin'
+
+    def __init__(self, directory: str, max_files: int = 256):
+        self.directory = directory
+        self.max_files = max_files
+
+    def _get_path(self, key: str) -> str:
+        return path.join(self.directory, key + self.SUFFIX)
+
+    def load(self, key: str) -> Optional[Tuple[OffsetPositionIntervalList, str, Optional[str]]]:
+        """
+        Returns the text intervals, the cleaned source and the language stored
+        for the key, or None.
+        """
+        file_path = self._get_path(key)
+        try:
+            with open(file_path, 'rb') as fin:
+                with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    magic, num_intervals, text_size, language_size = self.HEADER.unpack_from(buffer)
+                    columns_size = (
+                        num_intervals
+                        * len(OffsetPositionIntervalList.COLUMNS)
+                        * struct.calcsize(OffsetPositionIntervalList.SERIALIZED_TYPECODE)
+                    )
+                    offset = self.HEADER.size + columns_size
+                    if (
+                        magic != self.MAGIC
+                        or len(buffer) != offset + text_size + language_size
+                    ):
+                        return None
+
+                    intervals = OffsetPositionIntervalList.from_buffer(
+                        buffer,
+                        num_intervals,
+                        self.HEADER.size,
+                    )
+                    cleaned_source = str(buffer[offset:offset+text_size], 'utf-8')
+                    offset += text_size
+                    language = str(buffer[offset:offset+language_size], 'utf-8')
+            # recently used files are kept
+            os.utime(file_path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+        return intervals, cleaned_source, language or None
+
+    def store(
+        self,
+        key: str,
+        intervals: OffsetPositionIntervalList,
+        cleaned_source: str,
+        language: Optional[str],
+    ):
+        text = cleaned_source.encode('utf-8')
+        language = (language or '').encode('utf-8')
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(self.HEADER.pack(self.MAGIC, len(intervals), len(text), len(language)))
+                fout.write(intervals.to_bytes())
+                fout.write(text)
+                fout.write(language)
+            os.replace(tmp_path, self._get_path(key))
+        except OSError as e:
+            logger.warning(f'Could not write the cleaning cache: {e}')
+            if tmp_path is not None and path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._evict()
+
+    def _evict(self):
+        try:
+            entries = [
+                entry
+                for entry in os.scandir(self.directory)
+                if entry.name.endswith(self.SUFFIX)
+            ]
+            if len(entries) <= self.max_files:
+                return
+
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries)-self.max_files]:
+                os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f'Could not clean up the cleaning cache: {e}')
+
+
 class TreeSitterDocument(CleanableDocument):
     LIB_PATH_TEMPLATE = '{}/treesitter/{}.so'.format(get_user_cache(), '{}')
+    # description of the sources a library was built from
+    LIB_INFO_PATH_TEMPLATE = '{}/treesitter/{}.json'.format(get_user_cache(), '{}')
 
-    # faster persing method is still buggy
+    # grammar of the document type, set by subclasses
+    LANGUAGE_NAME = None
+    GRAMMAR_URL = None
+    GRAMMAR_BRANCH = None
+
+    # build missing or stale libraries when a document is opened, otherwise
+    # they have to be built ahead of time with `textlsp build-grammars`.
+    # Enabled by `textlsp --grammar-build`.
+    BUILD_ON_DEMAND = False
+
+    # re-clean the full document after every change instead of only the
+    # edited region
     CONFIGURATION_REPARSE_ALL = 'reparse_all'
-    DEFAULT_REPARSE_ALL = True
+    DEFAULT_REPARSE_ALL = False
+
+    # number of captures between cleaning checkpoints
+    CHECKPOINT_STEP = 32
+    # number of lines queried for captures at once when resuming cleaning,
+    # doubled for each subsequent query up to CAPTURE_WINDOW_MAX_LINES
+    CAPTURE_WINDOW_LINES = 16
+    CAPTURE_WINDOW_MAX_LINES = 2048
+    # Full parses run in slices of this many microseconds. Tree-sitter holds
+    # the GIL while parsing, so this lets the event loop run while a worker
+    # thread parses a large document.
+    PARSE_SLICE_MICROS = 20000
+    # number of slices after which the rest of the source is parsed at once
+    PARSE_MAX_SLICES = 500
+
+    # keep the cleaned source of opened documents on disk, so that unchanged
+    # documents are not parsed and cleaned again when they are reopened
+    CONFIGURATION_CLEANING_CACHE = 'cleaning_cache'
+    DEFAULT_CLEANING_CACHE = False
+    CLEANING_CACHE_DIR = '{}/cleaning'.format(get_user_cache())
+    CLEANING_CACHE_MAX_FILES = 256
+
+    # grammars loaded in this process, keyed by document type and grammar
+    _grammars: Dict[tuple, TreeSitterGrammar] = dict()
+    _grammars_lock = threading.RLock()
+
+    DEEPCOPY_SHARED_ATTRIBUTES = frozenset({'_grammar', '_ts_language', '_tree', '_query'})
 
     def __init__(self, language_name, grammar_url, branch, *args, **kwargs):
         super().__init__(*args, **kwargs)
         #######################################################################
         # Do not deepcopy these
-        self._ts_language = self.get_language(language_name, grammar_url, branch)
-        self._ts_parser = self.get_parser(
-            language_name,
-            grammar_url,
-            branch,
-            self._ts_language
-        )
+        self._grammar = self._get_grammar(language_name, grammar_url, branch)
+        self._ts_language = self._grammar.language
         self._tree = None
-        self._query = self._build_query()
+        self._query = self._grammar.query
         #######################################################################
 
         self._text_intervals = None
-
-    def __deepcopy__(self, memo):
-        cls = self.__class__
-        result = cls.__new__(cls)
-        memo[id(self)] = result
-        for k, v in self.__dict__.items():
-            if k not in {'_ts_language', '_ts_parser', '_tree', '_query'}:
-                setattr(result, k, copy.deepcopy(v, memo))
-            else:
-                setattr(result, k, v)
-        return result
+        self._checkpoints = None
+        self._previous_cleaned_source = None
+        # whether the source was changed since the document was opened
+        self._source_changed = False
+        # the source split into tree-sitter rows and the source it belongs to
+        self._tree_lines = None
+        self._tree_lines_source = None
 
     @classmethod
     def compile_library(cls, output_path: str, repo_paths: List[str]) -> bool:
@@ -479,28 +1147,173 @@ class TreeSitterDocument(CleanableDocument):
             )
         return True
 
+    @staticmethod
+    def _get_sources_mtime(repo_path: str) -> float:
+        src_path = path.join(repo_path, 'src')
+        return max(
+            path.getmtime(path.join(src_path, file_name))
+            for file_name in os.listdir(src_path)
+        )
+
     @classmethod
-    def build_library(cls, name, url, branch=None) -> None:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            git_clone(url, tmpdir, branch)
-            cls.compile_library(
-                cls.LIB_PATH_TEMPLATE.format(name),
-                [tmpdir]
-            )
+    def _get_library_info(cls, url, branch=None, source_path=None) -> Dict:
+        info = {
+            'url': url,
+            'branch': branch,
+            'tree_sitter': version('tree_sitter'),
+            'source': None,
+            'source_mtime': None,
+        }
+        if source_path is not None:
+            info['source'] = path.abspath(source_path)
+            info['source_mtime'] = cls._get_sources_mtime(source_path)
+        return info
 
     @classmethod
-    def get_language(cls, name, url, branch=None) -> Language:
+    def is_library_stale(cls, name, url, branch=None, source_path=None) -> bool:
+        """
+        Returns whether the library of the grammar is missing or was built
+        from other sources. Libraries built from local sources are stale
+        only if the sources changed since.
+        """
+        if not path.exists(cls.LIB_PATH_TEMPLATE.format(name)):
+            return True
+
         try:
-            return Language(
-                cls.LIB_PATH_TEMPLATE.format(name),
-                name,
+            with open(cls.LIB_INFO_PATH_TEMPLATE.format(name)) as fin:
+                info = json.load(fin)
+        except (OSError, ValueError):
+            return True
+
+        if source_path is None and info.get('source') is not None:
+            # built from local sources, only the version of tree-sitter matters
+            return info.get('tree_sitter') != version('tree_sitter')
+
+        return info != cls._get_library_info(url, branch, source_path)
+
+    @classmethod
+    def build_library(cls, name, url, branch=None, source_path=None, force=False) -> bool:
+        """
+        Builds the library of a grammar from a local source folder or by
+        cloning its repository, unless it is up to date.
+
+        Returns `True` if the library was built.
+        """
+        if not force and not cls.is_library_stale(name, url, branch, source_path):
+            return False
+
+        lib_path = cls.LIB_PATH_TEMPLATE.format(name)
+        os.makedirs(path.dirname(lib_path), exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=path.dirname(lib_path)) as tmpdir:
+            if source_path is None:
+                repo_path = path.join(tmpdir, 'repo')
+                git_clone(url, repo_path, branch)
+            else:
+                repo_path = source_path
+
+            # build next to the final path and move it in place, so that
+            # running servers never load a partial library
+            tmp_lib_path = path.join(tmpdir, path.basename(lib_path))
+            cls.compile_library(tmp_lib_path, [repo_path])
+            info_path = cls.LIB_INFO_PATH_TEMPLATE.format(name)
+            tmp_info_path = path.join(tmpdir, path.basename(info_path))
+            with open(tmp_info_path, 'w') as fout:
+                json.dump(cls._get_library_info(url, branch, source_path), fout)
+
+            os.replace(tmp_lib_path, lib_path)
+            os.replace(tmp_info_path, info_path)
+
+        return True
+
+    @staticmethod
+    def get_document_classes() -> List[type]:
+        """
+        Returns the tree-sitter based document types.
+        """
+        res = list()
+        for module in pkgutil.iter_modules(documents.__path__):
+            try:
+                res.append(
+                    get_class(
+                        '{}.{}'.format(documents.__name__, module.name),
+                        TreeSitterDocument,
+                    )
+                )
+            except ImportError:
+                pass
+        return res
+
+    @classmethod
+    def build_libraries(
+            cls,
+            source_paths: Dict[str, str] = None,
+            jobs: int = None,
+            force=False,
+    ) -> Dict[str, bool]:
+        """
+        Builds the libraries of all grammars in parallel. `source_paths` maps
+        language names to local source folders, other grammars are cloned.
+
+        Returns whether each library was built.
+        """
+        if source_paths is None:
+            source_paths = dict()
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                doc_cls.LANGUAGE_NAME: executor.submit(
+                    doc_cls.build_library,
+                    doc_cls.LANGUAGE_NAME,
+                    doc_cls.GRAMMAR_URL,
+                    doc_cls.GRAMMAR_BRANCH,
+                    source_paths.get(doc_cls.LANGUAGE_NAME),
+                    force,
+                )
+                for doc_cls in cls.get_document_classes()
+            }
+        return {
+            name: future.result()
+            for name, future in futures.items()
+        }
+
+    @classmethod
+    def get_language(cls, name, url, branch=None) -> Language:
+        lib_path = cls.LIB_PATH_TEMPLATE.format(name)
+        if (
+            cls.is_library_stale(name, url, branch)
+            # libraries built before their sources were recorded are used
+            # until they are rebuilt by `textlsp build-grammars`
+            and not (
+                path.exists(lib_path)
+                and not path.exists(cls.LIB_INFO_PATH_TEMPLATE.format(name))
             )
+        ):
+            if cls.BUILD_ON_DEMAND:
+                cls.build_library(name, url, branch)
+            elif path.exists(lib_path):
+                logger.warning(
+                    f'The {name} grammar library is out of date. Run'
+                    ' `textlsp build-grammars` to update it.'
+                )
+            else:
+                message = (
+                    f'The {name} grammar library is missing. Run'
+                    ' `textlsp build-grammars` to build it.'
+                )
+                logger.error(message)
+                raise RuntimeError(message)
+
+        try:
+            return Language(lib_path, name)
         except Exception:
-            cls.build_library(name, url, branch)
-            return Language(
-                cls.LIB_PATH_TEMPLATE.format(name),
-                name,
-            )
+            if not cls.BUILD_ON_DEMAND:
+                logger.error(
+                    f'The {name} grammar library could not be loaded. Run'
+                    ' `textlsp build-grammars --force` to rebuild it.'
+                )
+                raise
+            cls.build_library(name, url, branch, force=True)
+            return Language(lib_path, name)
 
     @classmethod
     def get_parser(cls, name=None, url=None, branch=None, language=None) -> Parser:
@@ -512,11 +1325,78 @@ class TreeSitterDocument(CleanableDocument):
         parser.set_language(language)
         return parser
 
-    def _build_query(self):
+    def get_snapshot(self) -> 'TreeSitterDocument':
+        snapshot = super().get_snapshot()
+        # edited in place by incremental changes
+        snapshot._tree = None
+        snapshot._tree_lines = None
+        snapshot._tree_lines_source = None
+        if self._text_intervals is not None:
+            snapshot._text_intervals = copy.copy(self._text_intervals)
+        return snapshot
+
+    def _apply_snapshot(self, snapshot: 'TreeSitterDocument'):
+        super()._apply_snapshot(snapshot)
+        self._tree = snapshot._tree
+        self._text_intervals = snapshot._text_intervals
+        self._checkpoints = snapshot._checkpoints
+        self._tree_lines = snapshot._tree_lines
+        self._tree_lines_source = snapshot._tree_lines_source
+        if self._language is None:
+            # detected or loaded with the cleaning cache
+            self._language = snapshot._language
+
+    def _use_rope(self) -> bool:
+        # the parser and the text of the nodes need the source as one byte
+        # string, so a rope would be joined on every edit
+        return False
+
+    def _get_grammar(self, name, url, branch=None) -> TreeSitterGrammar:
+        key = (type(self), name, url, branch)
+        grammar = self._grammars.get(key)
+        if grammar is not None:
+            return grammar
+
+        with self._grammars_lock:
+            grammar = self._grammars.get(key)
+            if grammar is None:
+                # _build_query() compiles against the language of the document
+                self._ts_language = self.get_language(name, url, branch)
+                try:
+                    with open(self.LIB_INFO_PATH_TEMPLATE.format(name)) as fin:
+                        grammar_version = fin.read()
+                except OSError:
+                    grammar_version = json.dumps(self._get_library_info(url, branch))
+                grammar = TreeSitterGrammar(
+                    self._ts_language,
+                    self._build_query(),
+                    grammar_version,
+                )
+                self._grammars[key] = grammar
+            return grammar
+
+    def _build_query(self) -> Query:
         raise NotImplementedError()
 
     def _parse_source(self):
-        return self._ts_parser.parse(bytes(self.source, 'utf-8'))
+        source = self._source_bytes()
+        with self._grammar.parser() as parser:
+            # with a language, parsing only fails when the slice times out
+            parser.set_language(self._grammar.language)
+            parser.set_timeout_micros(self.PARSE_SLICE_MICROS)
+            try:
+                for _ in range(self.PARSE_MAX_SLICES):
+                    try:
+                        return parser.parse(source)
+                    except ValueError:
+                        # timed out, the next call resumes parsing
+                        time.sleep(0)
+
+                parser.set_timeout_micros(0)
+                return parser.parse(source)
+            finally:
+                parser.set_timeout_micros(0)
+                parser.reset()
 
     @property
     def tree(self) -> Tree:
@@ -524,496 +1404,456 @@ class TreeSitterDocument(CleanableDocument):
             self._tree = self._parse_source()
         return self._tree
 
-    def _clean_source(self, change: TextDocumentContentChangePartial = None):
-        self._text_intervals = OffsetPositionIntervalList()
+    def _get_tree_lines(self) -> List[str]:
+        """
+        Returns the lines of the source as numbered by the rows of the tree,
+        i.e. split at \\n only. Incremental changes update the lines around
+        the edit instead of splitting the source again.
+        """
+        source = self.source
+        if self._tree_lines is None or self._tree_lines_source is not source:
+            self._tree_lines = source.split('\n')
+            self._tree_lines_source = source
+        return self._tree_lines
 
-        offset = 0
-        start_point = (0, 0)
-        end_point = (sys.maxsize, sys.maxsize)
-        for node in self._iterate_text_nodes(self.tree, start_point, end_point):
-            node_len = len(node)
-            self._text_intervals.add_interval_values(
-                    offset,
-                    offset+node_len-1,
-                    node.start_point[0],
-                    node.start_point[1],
-                    node.end_point[0],
-                    node.end_point[1],
-                    node.text,
-            )
-            offset += node_len
+    def _get_cleaning_cache(self) -> Optional[CleaningCache]:
+        """
+        Returns the cleaning cache if it is enabled and the document was not
+        changed since it was opened, i.e. it is likely to be opened again with
+        the same content.
+        """
+        use_cache = self.config.get(
+            self.CONFIGURATION_CLEANING_CACHE,
+            self.DEFAULT_CLEANING_CACHE,
+        )
+        if not use_cache or self._source_changed:
+            return None
+        return CleaningCache(self.CLEANING_CACHE_DIR, self.CLEANING_CACHE_MAX_FILES)
 
-        self._cleaned_source = ''.join(self._text_intervals.values)
+    def _get_cleaning_settings(self) -> tuple:
+        """
+        Returns the settings which the cleaned source and the detected
+        language depend on.
+        """
+        return (
+            self.config.get(self.CONFIGURATION_LANGUAGE, self.DEFAULT_LANGUAGE),
+            self.config.get(self.CONFIGURATION_MIN_LANG_DETECT, self.DEFAULT_MIN_LANG_DETECT),
+            self.config.get(self.CONFIGURATION_LANGUAGE_DETECTOR, self.DEFAULT_LANGUAGE_DETECTOR),
+        )
 
-    def _iterate_text_nodes(
-            self,
-            tree: Tree,
-            start_point,
-            end_point,
-    ) -> Generator[TextNode, None, None]:
-        raise NotImplementedError()
+    def _get_cache_key(self) -> str:
+        """
+        Returns the hash of the source and of everything the cleaning depends
+        on: the document type, the grammar, the version of textLSP and the
+        cleaning settings.
+        """
+        digest = hashlib.sha256()
+        for part in (
+            f'{type(self).__module__}.{type(self).__qualname__}',
+            self._grammar.version or '',
+            get_textlsp_version(),
+            json.dumps(self._get_cleaning_settings(), default=str),
+        ):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        digest.update(self._source_bytes())
+        return digest.hexdigest()
 
-    def _get_edit_positions(self, change):
-        lines = self.lines
-        change_range = change.range
-        change_range = _codec.range_from_client_units(lines, change_range)
-        start_line = change_range.start.line
-        start_col = change_range.start.character
-        end_line = change_range.end.line
-        end_col = change_range.end.character
-        len_lines = len(lines)
-        if len_lines == 0:
-            start_byte = 0
-            end_byte = 0
-        else:
-            if end_line >= len(lines):
-                # this could happen eg when the last line is deleted
-                end_line = len(lines) - 1
-                end_col = len(lines[end_line]) - 1
-
-            start_byte = len(bytes(
-                ''.join(
-                    lines[:start_line] + [lines[start_line][:start_col]]
-                ),
-                'utf-8',
-            ))
-            end_byte = len(bytes(
-                ''.join(
-                    lines[:end_line] + [lines[end_line][:end_col]]
-                ),
-                'utf-8',
-            ))
-        text_bytes = len(bytes(change.text, 'utf-8'))
-
-        if end_byte - start_byte == 0:
-            # INSERT
-            old_end_byte = start_byte
-            new_end_byte = start_byte + text_bytes
-            start_point = (start_line, start_col)
-            old_end_point = start_point
-            new_lines = change.text.count('\n')
-            new_end_point = (
-                start_line + new_lines,
-                (start_col + text_bytes) if new_lines == 0 else len(bytes(
-                    change.text.split('\n')[-1],
-                    'utf-8'
-                )),
-            )
-        elif text_bytes == 0:
-            # DELETE
-            old_end_byte = end_byte
-            new_end_byte = start_byte
-            start_point = (start_line, start_col)
-            old_end_point = (end_line, end_col)
-            new_end_point = start_point
-        else:
-            # REPLACE
-            old_end_byte = end_byte
-            new_end_byte = start_byte + text_bytes
-            start_point = (start_line, start_col)
-            old_end_point = (end_line, end_col)
-
-            new_lines = change.text.count('\n')
-            deleted_lines = end_line - start_line
-            if new_lines == 0 and deleted_lines == 0:
-                new_end_line = end_line
-                new_end_col = end_col + text_bytes - (end_col - start_col)
-            elif new_lines > 0 and deleted_lines == 0:
-                new_end_line = end_line + new_lines
-                new_end_col = len(bytes(change.text.split('\n')[-1], 'utf-8'))
-            elif new_lines == 0 and deleted_lines > 0:
-                new_end_line = end_line - deleted_lines
-                new_end_col = end_col + text_bytes - (end_col - start_col)
-            else:
-                new_end_line = end_line + new_lines - deleted_lines
-                new_end_col = len(bytes(change.text.split('\n')[-1], 'utf-8'))
+    def _clean_source(self, change: TextDocumentContentChangePartial = None):
+        cache = self._get_cleaning_cache()
+        if cache is not None:
+            key = self._get_cache_key()
+            cached = cache.load(key)
+            if cached is not None:
+                # the tree is only parsed when the document is changed
+                self._text_intervals, self._cleaned_source, language = cached
+                self._checkpoints = None
+                if self._language is None:
+                    self._language = language
+                return
 
-            new_end_point = (
-                new_end_line,
-                new_end_col,
+        self._text_intervals = OffsetPositionIntervalList()
+        self._checkpoints = [
+            CleaningCheckpoint(
+                point=(0, 0),
+                max_end=(-1, -1),
+                interval_idx=0,
+                offset=0,
+                last_sent=None,
+                new_lines_after=(),
             )
-
-        return (
-                start_line,
-                start_col,
-                end_line,
-                end_col,
-                start_byte,
-                old_end_byte,
-                new_end_byte,
-                text_bytes,
-                start_point,
-                old_end_point,
-                new_end_point,
+        ]
+
+        texts = list()
+        self._add_text_nodes(
+            # queried in windows, which keeps each call holding the GIL short
+            self._iterate_captures((0, 0)),
+            TextNodeIteratorState(),
+            self._text_intervals,
+            texts,
+            self._checkpoints[0],
         )
 
-    def _get_node_and_iterator_for_edit(
-            self,
-            start_point,
-            old_end_point,
-            new_end_point,
-            last_changed_point,
-            old_tree_first_node_new_end_point,
-            old_tree_end_point,
-    ):
-        sp = start_point
-        if len(self._text_intervals) > 0:
-            old_first_interval_end_point = (
-                self._text_intervals.get_interval(0).position_range.end.line,
-                self._text_intervals.get_interval(0).position_range.end.character
-            )
-        else:
-            old_first_interval_end_point = (0, 0)
-        if start_point < old_first_interval_end_point:
-            # there's new content at the beginning, we need to parse the next
-            # subtree as well, since there are no necessary whitespace tokens in
-            # the current text_intervals
-            tmp_point = old_tree_first_node_new_end_point
-        else:
-            tmp_point = (0, 0)
-        # last_changed_point is needed to handle subtrees being broken into
-        # multiple ones
-        ep = max(tmp_point, new_end_point, last_changed_point)
-
-        if start_point > old_tree_end_point:
-            # edit at the end of the file
-            # need to extend the range to include the last node since there
-            # might be relevant content (e.g. multiple newlines) that was
-            # ignored since it was at the end
-            if old_end_point[1] > 0:
-                sp = (old_tree_end_point[0], max(0, old_tree_end_point[1]-1))
-            else:
-                sp = (max(0, old_tree_end_point[0]-1), 0)
-
-        node_iter = self._iterate_text_nodes(self.tree, sp, ep)
-        node = next(node_iter)
-        while node.text == '\n' and node.start_point == (0, 1) and node.end_point == (0, 1):
-            # empty tree is selected
-            assert next(node_iter, None) is None
-            if sp > (0, 0):
-                sp = (max(0, sp[0]-1), 0)
-            else:
-                node.start_point = start_point
-                node.end_point = start_point
-                break
-
-            node_iter = self._iterate_text_nodes(self.tree, sp, ep)
-            node = next(node_iter)
+        self._cleaned_source = ''.join(texts)
 
-        return node, chain([node], node_iter)
+        if cache is not None:
+            cache.store(key, self._text_intervals, self._cleaned_source, self.language)
 
-    def _get_intervals_before_edit(
+    def _iterate_text_nodes(
             self,
-            node,
-    ):
-        # offset = 0
-        for interval_idx in range(len(self._text_intervals)):
-            interval = self._text_intervals.get_interval(interval_idx)
-            if interval.value == '\n' and interval.position_range.start == interval.position_range.end:
-                # newline added by parser but not in source
-                interval_end = (interval.position_range.end.line+1, 0)
-                if interval_end >= node.start_point:
-                    # FIXME This is very messy. Handling these dummy newlines
-                    # should be refactored.
-                    interval.value = ' '
-                    # offset += len(interval.value)
-                    # text_intervals.add_interval(interval)
-                    yield interval
-                    break
-            else:
-                interval_end = (
-                    interval.position_range.end.line,
-                    interval.position_range.end.character,
-                )
-                if interval_end >= node.start_point:
-                    break
-
-            # offset += len(interval.value)
-            # text_intervals.add_interval(interval)
-            yield interval
+            captures: Iterable[Tuple[Node, str]],
+            lines: List[str],
+            state: TextNodeIteratorState,
+    ) -> Generator[TextNode, None, None]:
+        """
+        Yields the text nodes of the captures. Everything that has to be
+        remembered between captures must be kept in `state`, so that the
+        iteration can be resumed from any capture.
+        """
+        raise NotImplementedError()
 
-    def _get_edited_intervals_and_last_node(
+    def _add_text_nodes(
             self,
-            node_iter,
-            offset,
-    ):
-        tmp_intvals = list()
-        last_new_node = None
-        tmp_node = None
-        for node in node_iter:
-            node_len = len(node)
-            tmp_intvals.append(
-                OffsetPositionInterval(
-                    offset_interval=Interval(
-                        start=offset,
-                        length=node_len
-                    ),
-                    position_range=Range(
-                        start=Position(
-                            line=node.start_point[0],
-                            character=node.start_point[1],
-                        ),
-                        end=Position(
-                            line=node.end_point[0],
-                            character=node.end_point[1],
-                        ),
-                    ),
-                    value=node.text,
+            captures: Iterable[Tuple[Node, str]],
+            state: TextNodeIteratorState,
+            text_intervals: OffsetPositionIntervalList,
+            texts: List[str],
+            checkpoint: CleaningCheckpoint,
+            resync: Callable[[tuple, TextNodeIteratorState], Optional[int]] = None,
+    ) -> Optional[Tuple[int, int, tuple]]:
+        """
+        Adds the text nodes of the captures to `text_intervals` and their text
+        to `texts`, continuing from `checkpoint`, and records a checkpoint in
+        `self._checkpoints` every CHECKPOINT_STEP captures.
+
+        Consecutive nodes in a line, which are mapped to the source character
+        by character, are merged into one interval. The intervals do not
+        store their text, it is the corresponding slice of the cleaned source.
+
+        Before each capture `resync(point, state)` is asked whether the rest
+        of the intervals is already known. If it returns the index of an old
+        checkpoint, the iteration stops and the index, the offset and the
+        largest capture end point reached are returned.
+        """
+        interval_idx = checkpoint.interval_idx
+        offset = checkpoint.offset
+        max_end = checkpoint.max_end
+        # [start offset, line, start character, end character] of the nodes
+        # merged into the next interval
+        run = None
+
+        def add_run():
+            nonlocal run
+            if run is not None:
+                run_offset, line, start_character, end_character = run
+                text_intervals.add_interval_values(
+                    run_offset,
+                    offset-1,
+                    line,
+                    start_character,
+                    line,
+                    end_character,
+                    None,
                 )
-            )
-            offset += node_len
-            last_new_node = tmp_node
-            tmp_node = node
+                run = None
+
+        def checkpointed_captures():
+            nonlocal max_end
+            last_point = None
+            count = 0
+            for capture in captures:
+                point = capture[0].start_point
+                if point != last_point:
+                    if resync is not None:
+                        idx = resync(point, state)
+                        if idx is not None:
+                            add_run()
+                            raise _Resynchronized(idx)
+                    if count >= self.CHECKPOINT_STEP:
+                        add_run()
+                        self._checkpoints.append(
+                            CleaningCheckpoint(
+                                point=point,
+                                max_end=max_end,
+                                interval_idx=interval_idx + len(text_intervals),
+                                offset=offset,
+                                last_sent=state.last_sent,
+                                new_lines_after=tuple(state.new_lines_after),
+                            )
+                        )
+                        count = 0
+                    last_point = point
+                count += 1
+                max_end = max(max_end, capture[0].end_point)
+                yield capture
+
+        lines = self._get_tree_lines()
+        try:
+            for node in self._iterate_text_nodes(checkpointed_captures(), lines, state):
+                text = node.text
+                node_len = len(text)
+                start_line, start_character = node.start_point
+                end_line, end_character = node.end_point
+                if (
+                    start_line == end_line
+                    and end_character - start_character == node_len - 1
+                    and '\n' not in text
+                ):
+                    if run is not None and run[1] == start_line and run[3] + 1 == start_character:
+                        run[3] = end_character
+                    else:
+                        add_run()
+                        run = [offset, start_line, start_character, end_character]
+                else:
+                    add_run()
+                    text_intervals.add_interval_values(
+                            offset,
+                            offset+node_len-1,
+                            start_line,
+                            start_character,
+                            end_line,
+                            end_character,
+                            None,
+                    )
+                texts.append(text)
+                offset += node_len
+        except _Resynchronized as resynchronized:
+            return resynchronized.checkpoint_idx, offset, max_end
 
-        return tmp_intvals, last_new_node
+        add_run()
+        return None
 
-    def _get_idx_after_edited_tree(
-        self,
-        old_end_point,
-        new_end_point,
-        text_bytes,
-        last_new_end_point,
-        last_changed_point
-    ):
-        # we take the max since none parseable content could have been
-        # added at the end
-        last_new_end_point = max(last_changed_point, last_new_end_point)
-
-        row_diff = new_end_point[0] - old_end_point[0]
-        if last_new_end_point[0] < new_end_point[0]:
-            # parse ended before the edit, happens when non parseable
-            # part is edited or all content was deleted
-            last_new_end_point = (
-                max(old_end_point, new_end_point)[0],
-                max(old_end_point, new_end_point)[1] + 1
-            )
-        elif last_new_end_point[0] > new_end_point[0]:
-            # parse ended in a later line  as the edit, i.e. its
-            # position is only affected by line shift
-            last_new_end_point = (
-                last_new_end_point[0] - row_diff,
-                last_new_end_point[1] + 1
-            )
-        elif row_diff == 0:
-            # the parse ended in the line of the edit
-            last_new_end_point = (
-                last_new_end_point[0],
-                last_new_end_point[1] - (new_end_point[1] - old_end_point[1]) + text_bytes + 1
-            )
-        elif row_diff > 0:
-            # the edit was in the line of the last node which is now
-            # shifted
-            last_new_end_point = (
-                last_new_end_point[0] - row_diff,
-                old_end_point[1] + last_new_end_point[1] - new_end_point[1] + 1
-            )
-        else:
-            # the edit was in the line of the last node which is now
-            # shifted
-            last_new_end_point = (
-                last_new_end_point[0] - row_diff,
-                new_end_point[1] + last_new_end_point[1] - old_end_point[1] + 1
+    def _iterate_captures(self, start_point: tuple) -> Generator[Tuple[Node, str], None, None]:
+        """
+        Yields the captures of the tree starting at or after `start_point` in
+        the same order as a query of the full tree would. The tree is queried
+        in growing windows of lines, so that captures that are not consumed
+        are not computed either.
+        """
+        root = self.tree.root_node
+        window_start = start_point
+        window_lines = self.CAPTURE_WINDOW_LINES
+        while True:
+            window_end = (window_start[0] + window_lines, 0)
+            last_window = window_end[0] > root.end_point[0]
+            if last_window:
+                window_end = (sys.maxsize, sys.maxsize)
+
+            for capture in self._query.captures(root, start_point=window_start, end_point=window_end):
+                # captures of nodes which start before the window
+                point = capture[0].start_point
+                if window_start <= point < window_end:
+                    yield capture
+
+            if last_window:
+                return
+            window_start = window_end
+            window_lines = min(2 * window_lines, self.CAPTURE_WINDOW_MAX_LINES)
+
+    def _point_at_offset(self, offset: int) -> tuple:
+        """
+        Returns the tree-sitter point, i.e. row and byte column, of an offset.
+        """
+        index = self._get_line_index()
+        if index.has_irregular_line_breaks:
+            # tree-sitter only breaks rows at \n
+            source = self.source
+            line_start = source.rfind('\n', 0, offset) + 1
+            return (
+                source.count('\n', 0, line_start),
+                len(source[line_start:offset].encode('utf-8')),
             )
 
-        last_idx = self._text_intervals.get_idx_at_position(
-            Position(
-                line=max(0, last_new_end_point[0]),
-                character=max(0, last_new_end_point[1])
-            ),
-            strict=False,
-        )
-        return last_idx
+        row = index.line_at_offset(offset)
+        if row == len(index) and row > 0 and not index.lines[-1].endswith('\n'):
+            row -= 1
+        return (row, index.byte_offset(offset) - index.byte_start(row))
 
-    def _handle_intervals_after_edit_shifted(
+    @staticmethod
+    def _shift_point(point: tuple, start_point: tuple, old_end_point: tuple, new_end_point: tuple) -> tuple:
+        """
+        Maps a point of the text before an edit to the text after it.
+        """
+        if point <= start_point:
+            return point
+        if point < old_end_point:
+            return new_end_point
+        if point[0] == old_end_point[0]:
+            return (new_end_point[0], new_end_point[1] + point[1] - old_end_point[1])
+        return (point[0] + new_end_point[0] - old_end_point[0], point[1])
+
+    def _update_text_intervals(
             self,
-            last_idx,
-            start_col,
-            end_line,
-            end_col,
-            old_end_point,
-            new_end_point,
-            text_bytes,
-            offset,
-            text_intervals,
+            old_tree: Tree,
+            old_cleaned_source: str,
+            start_point: tuple,
+            old_end_point: tuple,
+            new_end_point: tuple,
     ):
-        while last_idx > 1:
-            interval = self._text_intervals.get_interval(last_idx-1)
-            if (interval.value != '\n' or interval.position_range.start !=
-                    interval.position_range.end):
-                # not dummy newline
-                break
-            last_idx -= 1
+        """
+        Re-cleans the region of the source affected by an edit. Cleaning is
+        resumed from the last checkpoint before the edit and the parts of
+        the tree that changed, and stops as soon as the state of the iteration
+        matches an old checkpoint after them. The old intervals from that
+        checkpoint on are kept, shifted by the edit.
+        """
+        tree = self.tree
+        first_changed_point = start_point
+        last_changed_point = new_end_point
+        for changed_range in old_tree.changed_ranges(tree):
+            first_changed_point = min(first_changed_point, changed_range.start_point)
+            last_changed_point = max(last_changed_point, changed_range.end_point)
+
+        def shift(point):
+            return self._shift_point(point, start_point, old_end_point, new_end_point)
+
+        def shift_node(node):
+            if node is None:
+                return None
+            return TextNode(
+                text=node.text,
+                start_point=shift(node.start_point),
+                end_point=shift(node.end_point),
+            )
 
-        row_diff = new_end_point[0] - old_end_point[0]
-        col_diff = text_bytes - (end_col - start_col)
-        for interval_idx in range(last_idx, len(self._text_intervals)):
-            interval = self._text_intervals.get_interval(interval_idx)
+        # the captures before the checkpoint and the text they depend on
+        # have to be before the changes
+        old_checkpoints = self._checkpoints
+        start_idx = max(0, bisect.bisect_left(
+            old_checkpoints,
+            first_changed_point,
+            key=lambda checkpoint: max(checkpoint.point, checkpoint.max_end),
+        ) - 1)
+        start_checkpoint = old_checkpoints[start_idx]
+        line_shift = new_end_point[0] - old_end_point[0]
+
+        def resync(point, state):
+            # Only the lines after the changes are the same as before,
+            # including the text between the last sent node and the next
+            # capture.
+            if point[0] <= last_changed_point[0]:
+                return None
+            if state.last_sent is not None and state.last_sent.end_point[0] <= last_changed_point[0]:
+                return None
+
+            old_point = (point[0] - line_shift, point[1])
+            idx = bisect.bisect_left(
+                old_checkpoints,
+                old_point,
+                start_idx + 1,
+                key=lambda checkpoint: checkpoint.point,
+            )
+            if idx == len(old_checkpoints) or old_checkpoints[idx].point != old_point:
+                return None
+
+            checkpoint = old_checkpoints[idx]
             if (
-                len(text_intervals) == 0
-                and interval.value.count('\n') > 0
-                and interval.value.strip() == ''
+                state.last_sent != shift_node(checkpoint.last_sent)
+                or state.new_lines_after != [shift(p) for p in checkpoint.new_lines_after]
             ):
-                continue
-            node_len = len(interval.value)
-            if interval.position_range.start.line > end_line:
-                start_line_offset = row_diff
-                start_char_offset = 0
-                end_line_offset = row_diff
-                end_char_offset = 0
-            elif (interval.position_range.start.line == end_line
-                  and interval.position_range.start.character >= end_col):
-                start_line_offset = row_diff
-                start_char_offset = col_diff
-                end_line_offset = row_diff
-                if interval.position_range.end.line > interval.position_range.start.line:
-                    end_char_offset = 0
-                else:
-                    end_char_offset = col_diff
-            else:
-                # These are the special newlines which are not in the source
-                # but added by the parser to separate paragraphs
-                assert (interval.value == '\n' and interval.position_range.start ==
-                        interval.position_range.end)
-                last_interval_range = text_intervals.get_interval(-1).position_range
-                interval_range = interval.position_range
-                # we need to set start and end position to the same value
-                # which is the same line as the last item in text_intervals
-                # and one column to the right
-                end_line_offset = last_interval_range.end.line - interval_range.end.line
-                start_line_offset = interval_range.end.line - interval_range.start.line + end_line_offset
-                end_char_offset = last_interval_range.end.character - interval_range.end.character + 1
-                start_char_offset = interval_range.end.character - interval_range.start.character + end_char_offset
-
-            text_intervals.add_interval_values(
-                offset,
-                offset+node_len-1,
-                interval.position_range.start.line + start_line_offset,
-                interval.position_range.start.character + start_char_offset,
-                interval.position_range.end.line + end_line_offset,
-                interval.position_range.end.character + end_char_offset,
-                interval.value,
-            )
-            offset += node_len
+                return None
+            return idx
 
-    def _build_updated_text_intervals(
-            self,
-            start_line,
-            start_col,
-            end_line,
-            end_col,
-            start_byte,
-            old_end_byte,
-            new_end_byte,
-            start_point,
-            old_end_point,
-            new_end_point,
-            text_bytes,
-            last_changed_point,
-            old_tree_first_node_new_end_point,
-            old_tree_end_point,
-    ):
+        self._checkpoints = old_checkpoints[:start_idx+1]
         text_intervals = OffsetPositionIntervalList()
-
-        # get first edited node and iterator for all edited nodes
-        node, node_iter = self._get_node_and_iterator_for_edit(
-            start_point,
-            old_end_point,
-            new_end_point,
-            last_changed_point,
-            old_tree_first_node_new_end_point,
-            old_tree_end_point,
-        )
-
-        # copy the text intervals up to the start of the change
-        for interval in self._get_intervals_before_edit(node):
-            text_intervals.add_interval(interval)
-
-        if len(text_intervals) > 0:
-            offset = interval.offset_interval.start + interval.offset_interval.length
-        else:
-            offset = 0
-
-        # handle the nodes that were in the edited subtree
-        new_intervals, last_new_node = self._get_edited_intervals_and_last_node(
-            node_iter,
-            offset,
+        texts = [old_cleaned_source[:start_checkpoint.offset]]
+        resynchronized = self._add_text_nodes(
+            self._iterate_captures(start_checkpoint.point),
+            TextNodeIteratorState(
+                start_checkpoint.last_sent,
+                list(start_checkpoint.new_lines_after),
+            ),
+            text_intervals,
+            texts,
+            start_checkpoint,
+            resync,
         )
-        if last_new_node is None:
-            return None
 
-        for interval in new_intervals[:-1]:
-            # there's always a newline return at the end of the file which
-            # is not needed if we are not really at the end of the file yet
-            # text_intervals.add_interval_values(*interval)
-            text_intervals.add_interval(interval)
-        offset = interval.offset_interval.start + interval.offset_interval.length
-
-        # add remaining intervals shifted
-        last_new_end_point = last_new_node.end_point
-        last_idx = self._get_idx_after_edited_tree(
-            old_end_point,
-            new_end_point,
-            text_bytes,
-            last_new_end_point,
-            last_changed_point
-        )
-        if last_idx+1 >= len(self._text_intervals):
-            # we are actually at the end of the file so add the final newline
-            text_intervals.add_interval(new_intervals[-1])
+        if resynchronized is None:
+            self._text_intervals.splice(
+                start_checkpoint.interval_idx,
+                len(self._text_intervals),
+                text_intervals,
+            )
         else:
-            self._handle_intervals_after_edit_shifted(
-                    last_idx,
-                    start_col,
-                    end_line,
-                    end_col,
-                    old_end_point,
-                    new_end_point,
-                    text_bytes,
-                    offset,
-                    text_intervals,
+            idx, offset, max_end = resynchronized
+            resync_checkpoint = old_checkpoints[idx]
+            offset_shift = offset - resync_checkpoint.offset
+            interval_shift = (
+                start_checkpoint.interval_idx
+                + len(text_intervals)
+                - resync_checkpoint.interval_idx
+            )
+            # the intervals after the resync point are in lines after the
+            # edit, so only their line changes
+            self._text_intervals.splice(
+                start_checkpoint.interval_idx,
+                resync_checkpoint.interval_idx,
+                text_intervals,
+                offset_shift,
+                line_shift,
             )
+            for checkpoint in old_checkpoints[idx:]:
+                self._checkpoints.append(
+                    CleaningCheckpoint(
+                        point=shift(checkpoint.point),
+                        # the old value might come from a capture before the
+                        # resync point, in which case this overestimates it
+                        max_end=max(max_end, shift(checkpoint.max_end)),
+                        interval_idx=checkpoint.interval_idx + interval_shift,
+                        offset=checkpoint.offset + offset_shift,
+                        last_sent=shift_node(checkpoint.last_sent),
+                        new_lines_after=tuple(shift(p) for p in checkpoint.new_lines_after),
+                    )
+                )
+            texts.append(old_cleaned_source[resync_checkpoint.offset:])
 
-        return text_intervals
+        self._cleaned_source = ''.join(texts)
 
     def _apply_incremental_change(self, change: TextDocumentContentChangePartial) -> None:
         """Apply an ``Incremental`` text change to the document"""
-        reparse_all = self.config.setdefault(
+        reparse_all = self.config.get(
             self.CONFIGURATION_REPARSE_ALL,
             self.DEFAULT_REPARSE_ALL,
         )
-        if reparse_all:
+        if reparse_all or self._tree is None:
             self._tree = None
-
-        if self._tree is None:
+            self._text_intervals = None
             super()._apply_incremental_change(change)
             return
 
-        tree = self.tree
-        (
-                start_line,
-                start_col,
-                end_line,
-                end_col,
-                start_byte,
-                old_end_byte,
-                new_end_byte,
-                text_bytes,
-                start_point,
-                old_end_point,
-                new_end_point,
-        ) = self._get_edit_positions(change)
+        start, end = self.get_change_offsets(change)
+        start_byte = self._byte_offset(start)
+        old_end_byte = self._byte_offset(end)
+        start_point = self._point_at_offset(start)
+        old_end_point = self._point_at_offset(end)
+        tree_lines = None
+        if self._tree_lines_source is self.source:
+            tree_lines = self._tree_lines
 
-        # bookkeeping for later source cleaning
-        capture = self._query.captures(
-            tree.root_node,
-        )
-        if len(capture) == 0:
-            old_tree_first_node = None
-            old_tree_end_point = None
+        super()._apply_incremental_change(change)
+
+        if tree_lines is not None:
+            source = self.source
+            row_start = source.rfind('\n', 0, start) + 1
+            row_end = source.find('\n', start + len(change.text))
+            if row_end == -1:
+                row_end = len(source)
+            tree_lines[start_point[0]:old_end_point[0]+1] = source[row_start:row_end].split('\n')
+            self._tree_lines_source = source
+
+        new_text = change.text.encode('utf-8')
+        new_end_byte = start_byte + len(new_text)
+        num_rows = new_text.count(b'\n')
+        if num_rows == 0:
+            new_end_point = (start_point[0], start_point[1] + len(new_text))
         else:
-            old_tree_first_node = capture[0][0]
-            old_tree_end_point = capture[-1][0].end_point
+            new_end_point = (
+                start_point[0] + num_rows,
+                len(new_text) - new_text.rfind(b'\n') - 1,
+            )
 
+        tree = self._tree
         tree.edit(
             start_byte=start_byte,
             old_end_byte=old_end_byte,
@@ -1022,74 +1862,54 @@ class TreeSitterDocument(CleanableDocument):
             old_end_point=old_end_point,
             new_end_point=new_end_point,
         )
-        super()._apply_incremental_change(change)
-        new_source = bytes(self.source, 'utf-8')
-        self._tree = self._ts_parser.parse(
-            new_source,
-            tree
-        )
+        with self._grammar.parser() as parser:
+            self._tree = parser.parse(self._source_bytes(), tree)
 
-        if old_tree_first_node is not None:
-            old_tree_first_node.edit(
-                start_byte=start_byte,
-                old_end_byte=old_end_byte,
-                new_end_byte=new_end_byte,
-                start_point=start_point,
-                old_end_point=old_end_point,
-                new_end_point=new_end_point,
-            )
-            old_tree_first_node_new_end_point = old_tree_first_node.end_point
+        if self._text_intervals is None or self._previous_cleaned_source is None:
+            self._text_intervals = None
         else:
-            old_tree_first_node_new_end_point = None
-
-        last_changed_point = (-1, -1)
-        for change in tree.changed_ranges(self.tree):
-            last_changed_point = max(last_changed_point, change.end_point)
-
-        if old_tree_end_point is not None:
-            # rebuild the cleaned source
-            text_intervals = self._build_updated_text_intervals(
-                start_line,
-                start_col,
-                end_line,
-                end_col,
-                start_byte,
-                old_end_byte,
-                new_end_byte,
+            self._update_text_intervals(
+                tree,
+                self._previous_cleaned_source,
                 start_point,
                 old_end_point,
                 new_end_point,
-                text_bytes,
-                last_changed_point,
-                old_tree_first_node_new_end_point,
-                old_tree_end_point,
             )
 
-            if text_intervals is not None:
-                self._text_intervals = text_intervals
-                self._cleaned_source = ''.join(self._text_intervals.values)
-        else:
-            self._clean_source()
-
     def _apply_full_change(self, change: TextDocumentContentChangeEvent) -> None:
         """Apply a ``Full`` text change to the document."""
         super()._apply_full_change(change)
         self._tree = None
+        self._text_intervals = None
+
+    def apply_change(self, change: TextDocumentContentChangeEvent) -> None:
+        # the unchanged parts of the previous cleaned source are reused by
+        # incremental cleaning
+        self._previous_cleaned_source = self._cleaned_source
+        self._source_changed = True
+        super().apply_change(change)
+        self._previous_cleaned_source = None
 
     def position_at_offset(self, offset: int, cleaned=False) -> Position:
         if not cleaned:
             return super().position_at_offset(offset, cleaned)
 
         if self._cleaned_source is None:
-            self._clean_source()
+            self._sync_clean_source()
 
-        item = self._text_intervals.get_interval_at_offset(offset)
-        assert offset >= item.offset_interval.start
-        diff = offset - item.offset_interval.start
+        idx = self._text_intervals.get_idx_at_offset(offset)
+        (
+            offset_start,
+            _,
+            start_line,
+            start_character,
+            *_,
+        ) = self._text_intervals.get_interval_values(idx)
+        assert offset >= offset_start
 
         return Position(
-            line=item.position_range.start.line,
-            character=item.position_range.start.character+diff,
+            line=start_line,
+            character=start_character+offset-offset_start,
         )
 
     def range_at_offset(self, offset: int, length: int, cleaned=False) -> Range:
@@ -1104,14 +1924,23 @@ class TreeSitterDocument(CleanableDocument):
             )
 
         offset += length
-        item = self._text_intervals.get_interval_at_offset(offset-1)
-        item_end = item.offset_interval.start + item.offset_interval.length
-        assert offset <= item_end, f'{offset}, {item_end}, {item}'
+        idx = self._text_intervals.get_idx_at_offset(offset-1)
+        (
+            _,
+            offset_end,
+            _,
+            _,
+            end_line,
+            end_character,
+            _,
+        ) = self._text_intervals.get_interval_values(idx)
+        item_end = offset_end + 1
+        assert offset <= item_end, f'{offset}, {item_end}, {idx}'
         diff = item_end - offset
 
         end = Position(
-            line=item.position_range.end.line,
-            character=item.position_range.end.character-diff,
+            line=end_line,
+            character=end_character-diff,
         )
 
         return Range(
@@ -1119,29 +1948,72 @@ class TreeSitterDocument(CleanableDocument):
             end=end,
         )
 
+    def ranges_at_offsets(
+        self,
+        offsets: Sequence[int],
+        lengths: Sequence[int],
+        cleaned=False,
+    ) -> List[Range]:
+        if not cleaned:
+            return super().ranges_at_offsets(offsets, lengths, cleaned)
+
+        if self._cleaned_source is None:
+            self._sync_clean_source()
+
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        (
+            offset_start,
+            offset_end,
+            start_line,
+            start_character,
+            end_line,
+            end_character,
+        ) = self._text_intervals.get_column_arrays()
+        last_idx = len(offset_end) - 1
+
+        idx = np.minimum(np.searchsorted(offset_end, offsets, 'left'), last_idx)
+        start_lines = start_line[idx]
+        start_characters = start_character[idx] + offsets - offset_start[idx]
+
+        end_offsets = offsets + lengths
+        idx = np.minimum(np.searchsorted(offset_end, end_offsets - 1, 'left'), last_idx)
+        end_lines = end_line[idx]
+        end_characters = end_character[idx] - (offset_end[idx] + 1 - end_offsets)
+
+        empty = lengths == 0
+        end_lines[empty] = start_lines[empty]
+        end_characters[empty] = start_characters[empty]
+
+        return self._build_ranges(start_lines, start_characters, end_lines, end_characters)
+
     def offset_at_position(self, position: Position, cleaned=False) -> int:
         if not cleaned:
             return super().offset_at_position(position, cleaned)
 
         if self._cleaned_source is None:
-            self._clean_source()
+            self._sync_clean_source()
 
-        item = self._text_intervals.get_interval_at_position(position, False)
+        idx = self._text_intervals.get_idx_at_position(position, False)
+        (
+            offset_start,
+            _,
+            _,
+            start_character,
+            end_line,
+            *_,
+        ) = self._text_intervals.get_interval_values(idx)
 
-        if (
-            item.position_range.end.line == position.line
-            and item.position_range.start.character <= position.character
-        ):
-            diff = position.character - item.position_range.start.character
-            return item.offset_interval.start + diff
-        return item.offset_interval.start
+        if end_line == position.line and start_character <= position.character:
+            return offset_start + position.character - start_character
+        return offset_start
 
     def paragraphs_at_range(self, position_range: Range, cleaned=False) -> List[Interval]:
         if not cleaned:
             return super().paragraphs_at_range(position_range, cleaned)
 
         if self._cleaned_source is None:
-            self._clean_source()
+            self._sync_clean_source()
 
         res = list()
         res_set = set()
@@ -1150,14 +2022,21 @@ class TreeSitterDocument(CleanableDocument):
             position_range.start,
             strict=False
         )
+        range_end = (position_range.end.line, position_range.end.character)
         for i in range(idx, len(self._text_intervals)):
-            interval = self._text_intervals.get_interval(i)
-            if interval.position_range.start > position_range.end:
+            (
+                offset_start,
+                offset_end,
+                start_line,
+                start_character,
+                *_,
+            ) = self._text_intervals.get_interval_values(i)
+            if (start_line, start_character) > range_end:
                 break
 
             paragraph = self.paragraph_at_offset(
-                interval.offset_interval.start,
-                min_length=interval.offset_interval.length,
+                offset_start,
+                min_length=offset_end-offset_start+1,
                 cleaned=True
             )
             if paragraph is not None and paragraph not in res_set:
@@ -1171,10 +2050,13 @@ class TreeSitterDocument(CleanableDocument):
             return super().last_position(cleaned)
 
         if self._cleaned_source is None:
-            self._clean_source()
+            self._sync_clean_source()
 
-        last = self._text_intervals.get_interval(len(self._text_intervals)-1)
-        return last.position_range.end
+        *_, end_line, end_character, _ = self._text_intervals.get_interval_values(-1)
+        return Position(
+            line=end_line,
+            character=end_character,
+        )
 
 
 class DocumentTypeFactory():
@@ -1199,6 +2081,8 @@ class DocumentTypeFactory():
     ) -> TextDocument:
         lang = config.get(BaseDocument.CONFIGURATION_LANGUAGE)
         min_len = config.get(BaseDocument.CONFIGURATION_MIN_LANG_DETECT)
+        detector = config.get(BaseDocument.CONFIGURATION_LANGUAGE_DETECTOR)
+        large_file_size = config.get(BaseDocument.CONFIGURATION_LARGE_FILE_SIZE)
         try:
             type = DocumentTypeFactory.get_file_type(language_id)
             cls = get_class(
@@ -1217,6 +2101,16 @@ class DocumentTypeFactory():
                 and BaseDocument.CONFIGURATION_MIN_LANG_DETECT not in config
             ):
                 config[BaseDocument.CONFIGURATION_MIN_LANG_DETECT] = min_len
+            if (
+                detector is not None
+                and BaseDocument.CONFIGURATION_LANGUAGE_DETECTOR not in config
+            ):
+                config[BaseDocument.CONFIGURATION_LANGUAGE_DETECTOR] = detector
+            if (
+                large_file_size is not None
+                and BaseDocument.CONFIGURATION_LARGE_FILE_SIZE not in config
+            ):
+                config[BaseDocument.CONFIGURATION_LARGE_FILE_SIZE] = large_file_size
 
             return cls(
                 config=config,
@@ -1232,6 +2126,10 @@ class DocumentTypeFactory():
                 config[BaseDocument.CONFIGURATION_LANGUAGE] = lang
             if min_len is not None:
                 config[BaseDocument.CONFIGURATION_MIN_LANG_DETECT] = min_len
+            if detector is not None:
+                config[BaseDocument.CONFIGURATION_LANGUAGE_DETECTOR] = detector
+            if large_file_size is not None:
+                config[BaseDocument.CONFIGURATION_LARGE_FILE_SIZE] = large_file_size
 
             return BaseDocument(
                 config=config,
@@ -1243,148 +2141,221 @@ class DocumentTypeFactory():
             )
 
 
-class ChangeTracker():
+class JournalEntry(NamedTuple):
+    version: Optional[int]
+    # pre-edit source offsets of the replaced range, -1 for full document
+    # changes
+    start: int
+    end: int
+    # length of the inserted text
+    length: int
+
+
+class ChangeJournal():
+    """
+    Version-stamped list of the changes of a document in source offsets. A
+    journal is shared by several `ChangeTracker`s which read it from their
+    own position. If `cleaned`, the trackers map the changes to cleaned
+    offsets when they are read, so recording a change does not clean the
+    document.
+
+    The journal does not keep a copy of the document. It is updated after a
+    change was applied and the pre-edit offsets of the change are derived from
+    the updated document: the text before the edited range did not change, and
+    the difference in the length of the document is due to the replaced range.
+    """
     def __init__(self, doc: BaseDocument, cleaned=False):
-        self.document = None
-        self._set_document(doc)
         self.cleaned = cleaned
-        length = len(doc.cleaned_source) if cleaned else len(doc.source)
-        # list of tuples (span_length, was_changed)
-        # negative span_length means that the span was deleted
-        self._items = [(length, False)]
-        self.full_document_change = False
+        self._document = weakref.ref(doc)
+        self.length = doc.source_length
+        self.version = doc.version
+        self._entries = list()
+        # journal position of the first entry in _entries
+        self._base = 0
+        self._trackers = weakref.WeakSet()
+
+    @property
+    def end(self) -> int:
+        return self._base + len(self._entries)
+
+    @property
+    def document(self) -> Optional[BaseDocument]:
+        # the last updated document, if it is still open
+        return self._document()
 
-    def _set_document(self, doc: BaseDocument):
-        # XXX not too memory efficient
-        self.document = copy.deepcopy(doc)
+    def _get_entry(
+            self,
+            change: TextDocumentContentChangePartial,
+            updated_doc: BaseDocument,
+            length: int,
+    ) -> JournalEntry:
+        start = change.range.start
+        text = change.text
+        num_lines = text.count('\n')
+        if num_lines == 0:
+            character = start.character + _codec.client_num_units(text)
+        else:
+            character = _codec.client_num_units(text[text.rindex('\n')+1:])
+        end = Position(line=start.line+num_lines, character=character)
+
+        start_offset, end_offset = updated_doc.get_change_offsets(
+            TextDocumentContentChangePartial(range=Range(start=start, end=end), text=''),
+        )
+        inserted_length = max(0, end_offset - start_offset)
+        return JournalEntry(
+            updated_doc.version,
+            start_offset,
+            max(start_offset, start_offset + inserted_length + self.length - length),
+            inserted_length,
+        )
 
     def update_document(
             self,
             change: TextDocumentContentChangeEvent,
             updated_doc: BaseDocument
     ):
-        if self.full_document_change:
-            return
-
+        """
+        Records a change which was already applied to `updated_doc`.
+        """
+        length = updated_doc.source_length
         if type(change) == TextDocumentContentChangeWholeDocument:
-            self.full_document_change = True
-            self._items = [(-1, True)]
-            return
-
-        new_lst = list()
-        start_offset = self.document.offset_at_position(
-            change.range.start,
-            self.cleaned,
-        )
-        end_offset = self.document.offset_at_position(
-            change.range.end,
-            self.cleaned,
-        )
-
-        item_idx, item_offset = self._get_offset_idx(start_offset)
-        change_length = len(change.text)
-        range_length = end_offset-start_offset
-        relative_start_offset = start_offset - item_offset
-
-        if relative_start_offset > 0:
-            # add item from the beginning of the item to the start of the change
-            new_lst.append((relative_start_offset, self._items[item_idx][1]))
+            self._entries.append(
+                JournalEntry(updated_doc.version, -1, -1, length)
+            )
+        elif change.range.start != change.range.end or len(change.text) > 0:
+            # empty changes (sent by some clients) are skipped
+            self._entries.append(self._get_entry(change, updated_doc, length))
 
-        if start_offset == end_offset and change_length == 0:
-            # nothing to do (I'm not sure what this is)
-            self._set_document(updated_doc)
-            return
+        self._document = weakref.ref(updated_doc)
+        self.length = length
+        self.version = updated_doc.version
 
-        if change_length == 0:
-            # deletion
-            new_lst.append((0, True))
+    def get_entries(self, position: int) -> List[JournalEntry]:
+        return self._entries[position-self._base:]
 
-            tmp_item = (
-                self._items[item_idx][0]-relative_start_offset-range_length,
-                self._items[item_idx][1]
-            )
-            if tmp_item[0] != 0:
-                new_lst.append(tmp_item)
-        elif range_length == 0:
-            # insertion
-            new_lst.append((change_length, True))
-
-            tmp_item = (
-                self._items[item_idx][0]-relative_start_offset,
-                self._items[item_idx][1]
-            )
-            if tmp_item[0] > 0:
-                new_lst.append(tmp_item)
-        else:
-            # replacement
-            new_lst.append((change_length, True))
-
-            tmp_item = (
-                self._items[item_idx][0]-relative_start_offset-(change_length-range_length),
-                self._items[item_idx][1]
-            )
-            if tmp_item[0] > 0:
-                new_lst.append(tmp_item)
+    def trim(self):
+        """
+        Drops the entries which were read by all trackers.
+        """
+        position = min(
+            (tracker.position for tracker in self._trackers),
+            default=self.end,
+        )
+        del self._entries[:position-self._base]
+        self._base = position
 
-        self._replace_at(item_idx, new_lst)
-        self._set_document(updated_doc)
 
-    def _get_offset_idx(self, offset):
-        pos = 0
-        idx = 0
-        len_items = len(self._items)
+class ChangeTracker():
+    """
+    Keeps track of the edited spans of a document since its last check by
+    reading a `ChangeJournal` from a position.
+    """
+    def __init__(self, doc: BaseDocument, cleaned=False, journal: ChangeJournal = None):
+        if journal is None:
+            journal = ChangeJournal(doc, cleaned)
+        self.journal = journal
+        self.cleaned = journal.cleaned
+        self.position = journal.end
+        journal._trackers.add(self)
 
-        while pos <= offset and idx < len_items-1 and pos+self._items[idx][0] <= offset:
-            pos += max(0, self._items[idx][0])
-            idx += 1
+    def update_document(
+            self,
+            change: TextDocumentContentChangeEvent,
+            updated_doc: BaseDocument
+    ):
+        """
+        Records a change which was already applied to `updated_doc`.
+        """
+        self.journal.update_document(change, updated_doc)
 
-        return idx, pos
+    def reset(self):
+        """
+        Marks the changes so far as seen.
+        """
+        self.position = self.journal.end
+        self.journal.trim()
 
-    def _replace_at(self, idx, tuples):
-        length = len(tuples)
-        assert length > 0
-        self._items[idx] = tuples[0]
-        for i in range(1, length):
-            self._items.insert(idx+i, tuples[i])
+    @property
+    def full_document_change(self) -> bool:
+        return any(
+            entry.start < 0
+            for entry in self.journal.get_entries(self.position)
+        )
 
     def get_changes(self) -> List[Interval]:
-        if self.cleaned:
-            doc_length = len(self.document.cleaned_source)
+        """
+        Returns the minimal sorted list of non-overlapping and non-adjacent
+        intervals which cover the changed text. Deletions mark the character
+        before them.
+        """
+        doc = self.journal.document
+        if self.cleaned and isinstance(doc, CleanableDocument):
+            doc_length = len(doc.cleaned_source)
         else:
-            doc_length = len(self.document.source)
-
+            doc = None
+            doc_length = self.journal.length
         if self.full_document_change:
             return [Interval(0, doc_length)]
 
-        res = list()
-        seen = set()
-        pos = 0
-        for item in self._items:
-            if item[1]:
-                length = item[0]
-                if length < 0:
-                    position = max(0, pos+length)
-                    # use pos instead of position since the doc_length will change after modification
-                    length = min(length*-1, doc_length-pos)
-                else:
-                    position = pos
+        spans = SpanTree()
+        for entry in self.journal.get_entries(self.position):
+            if entry.length > 0:
+                span_start = entry.start
+                span_end = entry.start + entry.length
+            else:
+                span_start = max(0, entry.start-1)
+                span_end = entry.start
+
+            spans.replace(
+                entry.start,
+                entry.end,
+                span_start,
+                span_end,
+                entry.length - entry.end + entry.start,
+            )
 
-                if position >= doc_length:
-                    position = doc_length-1
-                    length = 0
+        spans = list(spans)
+        if doc is not None:
+            spans = self._get_cleaned_spans(doc, spans)
 
-                if length == 0 and position > 0:
-                    position -= 1
-                    length = 1
+        res = list()
+        for start, end in spans:
+            end = min(end, doc_length)
+            if start >= doc_length:
+                start = max(0, doc_length-1)
+            if len(res) > 0 and res[-1].start + res[-1].length >= start:
+                # spans which were clipped to the end of the document
+                start = res.pop().start
+            res.append(Interval(start, end-start))
 
-                intv = Interval(position, length)
+        return res
 
-                if intv not in seen:
-                    res.append(intv)
-                    seen.add(intv)
-            pos += max(0, item[0])
+    @staticmethod
+    def _get_cleaned_spans(
+        doc: CleanableDocument,
+        spans: List[Tuple[int, int]],
+    ) -> List[Tuple[int, int]]:
+        """
+        Maps the spans from source to cleaned offsets. Spans without cleaned
+        text mark the cleaned character before them.
+        """
+        length = doc.source_length
+        res = list()
+        for start, end in spans:
+            start = doc.offset_at_position(
+                doc.position_at_offset(min(start, length)),
+                True,
+            )
+            end = doc.offset_at_position(
+                doc.position_at_offset(min(end, length)),
+                True,
+            )
+            if end <= start:
+                end = start
+                start = max(0, start-1)
+            res.append((start, end))
 
         return res
 
     def __len__(self):
-        return len([item for item in self._items if item[1]])
+        return len(self.journal.get_entries(self.position))
@@ -1,10 +1,15 @@
-from typing import Generator
-from tree_sitter import Tree
+from typing import Generator, Iterable, List, Tuple
+from tree_sitter import Node
 
-from ..document import TreeSitterDocument, TextNode
+from ..document import TreeSitterDocument, TextNode, TextNodeIteratorState
 
 
 class LatexDocument(TreeSitterDocument):
+    LANGUAGE_NAME = 'latex'
+    GRAMMAR_URL = 'https://github.com/latex-lsp/tree-sitter-latex'
+    GRAMMAR_BRANCH = 'v0.3.0'
+    REGION_HEADER = '\\begin{document}'
+
     TEXT = 'text'
     WORD = 'word'
     SECTION = 'section'
@@ -40,9 +45,9 @@ class LatexDocument(TreeSitterDocument):
 
     def __init__(self, *args, **kwargs):
         super().__init__(
-            'latex',
-            'https://github.com/latex-lsp/tree-sitter-latex',
-            'v0.3.0',
+            self.LANGUAGE_NAME,
+            self.GRAMMAR_URL,
+            self.GRAMMAR_BRANCH,
             *args,
             **kwargs,
         )
@@ -62,41 +67,36 @@ class LatexDocument(TreeSitterDocument):
 
     def _iterate_text_nodes(
             self,
-            tree: Tree,
-            start_point,
-            end_point,
+            captures: Iterable[Tuple[Node, str]],
+            lines: List[str],
+            state: TextNodeIteratorState,
     ) -> Generator[TextNode, None, None]:
-        lines = tree.text.decode('utf-8').split('\n')
-
-        last_sent = None
-        new_lines_after = list()
-
-        for node in self._query.captures(tree.root_node, start_point=start_point, end_point=end_point):
+        for node in captures:
             # Check if we need some newlines after previous elements
-            while len(new_lines_after) > 0:
-                if node[0].start_point > new_lines_after[0]:
-                    if last_sent is not None:
-                        for nl in TextNode.get_new_lines(2, last_sent.end_point):
-                            last_sent = nl
+            while len(state.new_lines_after) > 0:
+                if node[0].start_point > state.new_lines_after[0]:
+                    if state.last_sent is not None:
+                        for nl in TextNode.get_new_lines(2, state.last_sent.end_point):
+                            state.last_sent = nl
                             yield nl
-                    new_lines_after.pop(0)
+                    state.new_lines_after.pop(0)
                 else:
                     break
 
             if node[1] == self.NODE_CONTENT:
                 # check if we need newlines due to linebreaks in source
                 if (
-                    last_sent is not None
-                    and last_sent.text[-1] != '\n'
-                    and node[0].start_point[0] - last_sent.end_point[0] > 1
-                    and '' in lines[last_sent.end_point[0]+1:node[0].start_point[0]]
+                    state.last_sent is not None
+                    and state.last_sent.text[-1] != '\n'
+                    and node[0].start_point[0] - state.last_sent.end_point[0] > 1
+                    and '' in lines[state.last_sent.end_point[0]+1:node[0].start_point[0]]
                 ):
-                    for nl_node in TextNode.get_new_lines(2, last_sent.end_point):
+                    for nl_node in TextNode.get_new_lines(2, state.last_sent.end_point):
                         yield nl_node
-                        last_sent = nl_node
+                        state.last_sent = nl_node
 
                 # handle spaces
-                if self._needs_space_before(node[0], lines, last_sent):
+                if self._needs_space_before(node[0], lines, state.last_sent):
                     sp = node[0].start_point
                     if sp[1] > 0:
                         yield TextNode.space(
@@ -106,12 +106,12 @@ class LatexDocument(TreeSitterDocument):
                     else:
                         yield TextNode.space(
                             start_point=(
-                                last_sent.end_point[0],
-                                last_sent.end_point[1]+1
+                                state.last_sent.end_point[0],
+                                state.last_sent.end_point[1]+1
                             ),
                             end_point=(
-                                last_sent.end_point[0],
-                                last_sent.end_point[1]+1
+                                state.last_sent.end_point[0],
+                                state.last_sent.end_point[1]+1
                             ),
                         )
 
@@ -121,31 +121,31 @@ class LatexDocument(TreeSitterDocument):
                 # - https://github.com/latex-lsp/tree-sitter-latex/issues/73
                 # - https://github.com/latex-lsp/tree-sitter-latex/issues/74
                 # and remove this block when the issues are fixed.
-                line = self.lines[node[0].end_point[0]]
+                line = lines[node[0].end_point[0]]
                 char = None
                 if node[0].end_point[1] < len(line):
                     char = line[node[0].end_point[1]]
 
                 if char in {',', '-'}:
-                    last_sent = TextNode(
+                    state.last_sent = TextNode(
                         text=node[0].text.decode('utf-8')+char,
                         start_point=node[0].start_point,
                         end_point=(node[0].end_point[0], node[0].end_point[1])  # node.end_point[1]-1+1
                     )
                 else:
                     ###########################################################
-                    last_sent = TextNode.from_ts_node(node[0])
-                yield last_sent
+                    state.last_sent = TextNode.from_ts_node(node[0])
+                yield state.last_sent
             elif node[1] == self.NODE_NEWLINE_BEFORE_AFTER:
-                new_lines_after.append(node[0].end_point)
-                if last_sent is not None:
-                    for nl_node in TextNode.get_new_lines(2, last_sent.end_point):
+                state.new_lines_after.append(node[0].end_point)
+                if state.last_sent is not None:
+                    for nl_node in TextNode.get_new_lines(2, state.last_sent.end_point):
                         yield nl_node
-                        last_sent = nl_node
+                        state.last_sent = nl_node
 
         yield from TextNode.get_new_lines(
             1,
-            last_sent.end_point if last_sent else (0, 0)
+            state.last_sent.end_point if state.last_sent else (0, 0)
         )
 
     def _needs_space_before(self, node, lines, last_sent) -> bool:
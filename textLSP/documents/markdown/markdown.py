@@ -1,10 +1,14 @@
-from typing import Generator
-from tree_sitter import Tree
+from typing import Generator, Iterable, List, Tuple
+from tree_sitter import Node
 
-from ..document import TreeSitterDocument, TextNode
+from ..document import TreeSitterDocument, TextNode, TextNodeIteratorState
 
 
 class MarkDownDocument(TreeSitterDocument):
+    LANGUAGE_NAME = 'markdown'
+    GRAMMAR_URL = 'https://github.com/ikatyang/tree-sitter-markdown'
+    GRAMMAR_BRANCH = 'v0.7.1'
+
     SUBFOLDER_MARKDOWN = 'tree-sitter-markdown'
     SUBFOLDER_MARKDOWN_INLINE = 'tree-sitter-markdown-inline'
 
@@ -49,9 +53,9 @@ class MarkDownDocument(TreeSitterDocument):
 
     def __init__(self, *args, **kwargs):
         super().__init__(
-            'markdown',
-            'https://github.com/ikatyang/tree-sitter-markdown',
-            'v0.7.1',
+            self.LANGUAGE_NAME,
+            self.GRAMMAR_URL,
+            self.GRAMMAR_BRANCH,
             *args,
             **kwargs,
         )
@@ -72,34 +76,19 @@ class MarkDownDocument(TreeSitterDocument):
 
     def _iterate_text_nodes(
             self,
-            tree: Tree,
-            start_point,
-            end_point,
+            captures: Iterable[Tuple[Node, str]],
+            lines: List[str],
+            state: TextNodeIteratorState,
     ) -> Generator[TextNode, None, None]:
-        lines = tree.text.decode('utf-8').split('\n')
-
-        last_sent = None
-        new_lines_after = list()
-
-        if start_point == end_point:
-            # FIXME This is a weird issue, it seems that in some cases nothing
-            # is selected if the interval is empty, but not in all cases. See
-            # markdown_text.py test_edits() where first two characters of
-            # '# Header' is removed
-            end_point = (
-                end_point[0],
-                end_point[1] + 1
-            )
-
-        for node in self._query.captures(tree.root_node, start_point=start_point, end_point=end_point):
+        for node in captures:
             # Check if we need some newlines after previous elements
-            while len(new_lines_after) > 0:
-                if node[0].start_point > new_lines_after[0]:
-                    if last_sent is not None:
-                        for nl in TextNode.get_new_lines(1, last_sent.end_point):
-                            last_sent = nl
+            while len(state.new_lines_after) > 0:
+                if node[0].start_point > state.new_lines_after[0]:
+                    if state.last_sent is not None:
+                        for nl in TextNode.get_new_lines(1, state.last_sent.end_point):
+                            state.last_sent = nl
                             yield nl
-                    new_lines_after.pop(0)
+                    state.new_lines_after.pop(0)
                 else:
                     break
 
@@ -107,7 +96,7 @@ class MarkDownDocument(TreeSitterDocument):
                 if len(node[0].text.decode('utf-8').strip()) == 0:
                     continue
                 # handle spaces
-                if self._needs_space_before(node[0], lines, last_sent):
+                if self._needs_space_before(node[0], lines, state.last_sent):
                     sp = node[0].start_point
                     if sp[1] > 0:
                         yield TextNode.space(
@@ -117,27 +106,27 @@ class MarkDownDocument(TreeSitterDocument):
                     else:
                         yield TextNode.space(
                             start_point=(
-                                last_sent.end_point[0],
-                                last_sent.end_point[1]+1
+                                state.last_sent.end_point[0],
+                                state.last_sent.end_point[1]+1
                             ),
                             end_point=(
-                                last_sent.end_point[0],
-                                last_sent.end_point[1]+1
+                                state.last_sent.end_point[0],
+                                state.last_sent.end_point[1]+1
                             ),
                         )
 
                 for nl in self._handle_text_nodes(node[0]):
-                    last_sent = nl
+                    state.last_sent = nl
                     yield nl
 
             elif node[1] == self.NODE_NEWLINE_AFTER_ONE:
-                self._insert_point_in_order(node[0].end_point, new_lines_after)
+                self._insert_point_in_order(node[0].end_point, state.new_lines_after)
             elif node[1] == self.NODE_NEWLINE_AFTER_TWO:
-                self._insert_point_in_order(node[0].end_point, new_lines_after, 2)
+                self._insert_point_in_order(node[0].end_point, state.new_lines_after, 2)
 
         yield from TextNode.get_new_lines(
             1,
-            last_sent.end_point if last_sent else (0, 0)
+            state.last_sent.end_point if state.last_sent else (0, 0)
         )
 
     def _handle_text_nodes(self, inline_node) -> Generator[TextNode, None, None]:
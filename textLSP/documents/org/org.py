@@ -1,10 +1,14 @@
-from typing import Generator
-from tree_sitter import Tree, Node
+from typing import Generator, Iterable, List, Tuple
+from tree_sitter import Node
 
-from ..document import TreeSitterDocument, TextNode
+from ..document import TreeSitterDocument, TextNode, TextNodeIteratorState
 
 
 class OrgDocument(TreeSitterDocument):
+    LANGUAGE_NAME = 'org'
+    GRAMMAR_URL = 'https://github.com/milisims/tree-sitter-org'
+    GRAMMAR_BRANCH = 'v1.3.1'
+
     CONFIGURATION_TODO_KEYWORDS = 'org_todo_keywords'
 
     DEFAULT_TODO_KEYWORDS = {'TODO', 'DONE'}
@@ -39,9 +43,9 @@ class OrgDocument(TreeSitterDocument):
 
     def __init__(self, *args, **kwargs):
         super().__init__(
-            'org',
-            'https://github.com/milisims/tree-sitter-org',
-            'v1.3.1',
+            self.LANGUAGE_NAME,
+            self.GRAMMAR_URL,
+            self.GRAMMAR_BRANCH,
             *args,
             **kwargs,
         )
@@ -52,6 +56,11 @@ class OrgDocument(TreeSitterDocument):
         if type(keywords) != set:
             self.config[self.CONFIGURATION_TODO_KEYWORDS] = set(keywords)
 
+    def _get_cleaning_settings(self) -> tuple:
+        return super()._get_cleaning_settings() + (
+            sorted(self.config[self.CONFIGURATION_TODO_KEYWORDS]),
+        )
+
     def _build_query(self):
         query_str = ''
 
@@ -71,40 +80,35 @@ class OrgDocument(TreeSitterDocument):
 
     def _iterate_text_nodes(
             self,
-            tree: Tree,
-            start_point,
-            end_point,
+            captures: Iterable[Tuple[Node, str]],
+            lines: List[str],
+            state: TextNodeIteratorState,
     ) -> Generator[TextNode, None, None]:
-        lines = tree.text.decode('utf-8').split('\n')
-
-        last_sent = None
-        new_lines_after = list()
-
-        for node in self._query.captures(tree.root_node, start_point=start_point, end_point=end_point):
+        for node in captures:
             # Check if we need some newlines after previous elements
-            while len(new_lines_after) > 0:
-                if node[0].start_point > new_lines_after[0]:
-                    if last_sent is not None:
-                        for nl in TextNode.get_new_lines(1, last_sent.end_point):
-                            last_sent = nl
+            while len(state.new_lines_after) > 0:
+                if node[0].start_point > state.new_lines_after[0]:
+                    if state.last_sent is not None:
+                        for nl in TextNode.get_new_lines(1, state.last_sent.end_point):
+                            state.last_sent = nl
                             yield nl
-                    new_lines_after.pop(0)
+                    state.new_lines_after.pop(0)
                 else:
                     break
 
             if node[1] == self.NODE_CONTENT:
                 # check if we need newlines due to linebreaks in source
                 # if (
-                #     last_sent is not None
-                #     and node[0].start_point[0] - last_sent.end_point[0] > 1
-                #     and '' in lines[last_sent.end_point[0]+1:node[0].start_point[0]]
+                #     state.last_sent is not None
+                #     and node[0].start_point[0] - state.last_sent.end_point[0] > 1
+                #     and '' in lines[state.last_sent.end_point[0]+1:node[0].start_point[0]]
                 # ):
-                #     for nl_node in TextNode.get_new_lines(1, last_sent.end_point):
+                #     for nl_node in TextNode.get_new_lines(1, state.last_sent.end_point):
                 #         yield nl_node
-                #         last_sent = nl_node
+                #         state.last_sent = nl_node
 
                 # handle spaces
-                if self._needs_space_before(node[0], lines, last_sent):
+                if self._needs_space_before(node[0], lines, state.last_sent):
                     sp = node[0].start_point
                     if sp[1] > 0:
                         yield TextNode.space(
@@ -114,35 +118,35 @@ class OrgDocument(TreeSitterDocument):
                     else:
                         yield TextNode.space(
                             start_point=(
-                                last_sent.end_point[0],
-                                last_sent.end_point[1]+1
+                                state.last_sent.end_point[0],
+                                state.last_sent.end_point[1]+1
                             ),
                             end_point=(
-                                last_sent.end_point[0],
-                                last_sent.end_point[1]+1
+                                state.last_sent.end_point[0],
+                                state.last_sent.end_point[1]+1
                             ),
                         )
 
-                if self._valid_content_node(node[0]):
-                    last_sent = TextNode.from_ts_node(node[0])
-                    yield last_sent
+                if self._valid_content_node(node[0], lines):
+                    state.last_sent = TextNode.from_ts_node(node[0])
+                    yield state.last_sent
             elif node[1] == self.NODE_NEWLINE_AFTER_ONE:
-                self._insert_point_in_order(node[0].end_point, new_lines_after)
+                self._insert_point_in_order(node[0].end_point, state.new_lines_after)
             elif node[1] == self.NODE_NEWLINE_AFTER_TWO:
-                self._insert_point_in_order(node[0].end_point, new_lines_after, 2)
+                self._insert_point_in_order(node[0].end_point, state.new_lines_after, 2)
 
         yield from TextNode.get_new_lines(
             1,
-            last_sent.end_point if last_sent else (0, 0)
+            state.last_sent.end_point if state.last_sent else (0, 0)
         )
 
-    def _valid_content_node(self, node: Node):
+    def _valid_content_node(self, node: Node, lines: List[str]):
         return not (
             node.parent is not None
             and node.parent.parent is not None
             and node.parent.parent.type == self.HEADLINE
             and node.text.decode('utf-8') in self.config[self.CONFIGURATION_TODO_KEYWORDS]
-            and self.lines[node.start_point[0]][:node.start_point[1]] == '*' * max(1, node.start_point[1]-1) + ' '
+            and lines[node.start_point[0]][:node.start_point[1]] == '*' * max(1, node.start_point[1]-1) + ' '
         )
 
     @staticmethod
@@ -1,6 +1,13 @@
 import re
 
-from lsprotocol.types import Position, Range
+from typing import List, Sequence
+
+from lsprotocol.types import (
+    Position,
+    Range,
+    TextDocumentContentChangeEvent,
+    TextDocumentContentChangePartial,
+)
 
 from ..document import CleanableDocument
 from ...types import Interval
@@ -23,12 +30,108 @@ class TxtDocument(CleanableDocument):
         else:
             self._cleaned_source = self.source
 
+    def apply_change(self, change: TextDocumentContentChangeEvent) -> None:
+        if (
+            self._cleaned_source is None
+            or not isinstance(change, TextDocumentContentChangePartial)
+            or not self._is_sync_kind_incremental
+            or not self.config.get(self.CONFIGURATION_PARSE, self.DEFAULT_PARSE)
+        ):
+            super().apply_change(change)
+            return
+
+        start, end = self.get_change_offsets(change)
+        cleaned_source = self._cleaned_source
+        super().apply_change(change)
+        self._cleaned_source = self._clean_edited_region(
+            cleaned_source,
+            start,
+            end,
+            len(change.text),
+        )
+
+    def _clean_edited_region(self, old_cleaned_source, start, end, length):
+        """
+        Re-cleans the lines around an edit that replaced the [start, end)
+        offsets of the old source with `length` characters, and splices the
+        result into the old cleaned source.
+
+        Cleaning keeps the length of the text, so offsets outside of the
+        edited region only shift. PATTERN_BREAK_INLINE matches are three
+        characters long and do not overlap, so the region is extended to line
+        starts where a regex scan of the full text is in the same state as a
+        scan started there (see `_is_restart_point()`).
+        """
+        source = self.source
+
+        region_start = start
+        if region_start > 0:
+            region_start = source.rfind('\n', 0, region_start-1) + 1
+            while not self._is_restart_point(source, region_start):
+                region_start = source.rfind('\n', 0, region_start-1) + 1
+
+        new_end = start + length
+        region_end = self._next_line_start(source, new_end)
+        while not self._is_restart_point(source, region_end):
+            region_end = self._next_line_start(source, region_end)
+
+        region = self.PATTERN_BREAK_INLINE.sub(
+            r'\1 \2',
+            # the next character is needed to decide whether the last
+            # newline of the region is replaced
+            source[region_start:region_end+1],
+        )[:region_end-region_start]
+
+        old_region_end = region_end - length + end - start
+        cleaned_source = (
+            old_cleaned_source[:region_start]
+            + region
+            + old_cleaned_source[old_region_end:]
+        )
+
+        boundary_index = self._cleaned_boundary_index
+        if boundary_index is not None and boundary_index.text is old_cleaned_source:
+            boundary_index.update(
+                cleaned_source,
+                region_start,
+                old_region_end,
+                len(region),
+            )
+
+        return cleaned_source
+
+    @staticmethod
+    def _next_line_start(text: str, offset: int) -> int:
+        idx = text.find('\n', offset)
+        if idx == -1:
+            return len(text)
+        return idx + 1
+
+    @staticmethod
+    def _is_restart_point(text: str, offset: int) -> bool:
+        """
+        A line start is a safe point to restart PATTERN_BREAK_INLINE matching
+        unless the line consists of a single character, which could be both
+        the end of the previous and the start of the next match.
+        """
+        if offset == 0 or offset >= len(text) - 1:
+            return True
+        return text[offset] == '\n' or text[offset+1] != '\n'
+
     def position_at_offset(self, offset: int, cleaned=False) -> Position:
         return super().position_at_offset(offset, False)
 
     def range_at_offset(self, offset: int, length: int, cleaned=False) -> Range:
         return super().range_at_offset(offset, length, False)
 
+    def ranges_at_offsets(
+        self,
+        offsets: Sequence[int],
+        lengths: Sequence[int],
+        cleaned=False,
+    ) -> List[Range]:
+        return super().ranges_at_offsets(offsets, lengths, False)
+
     def offset_at_position(self, position: Position, cleaned=False) -> int:
         return super().offset_at_position(position, False)
 
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from importlib.metadata import version
+from typing import List, Optional
+
+import numpy as np
+
+from .utils import get_user_cache
+
+logger = logging.getLogger(__name__)
+
+
+class NGramLanguageIdentifier():
+    """
+    Naive Bayes character n-gram language identifier.
+
+    The language profiles of langdetect are compiled once into NumPy arrays
+    in the user cache, which are memory-mapped when loaded:
+        ngrams.npy -- sorted integer keys of the known n-grams
+        log_probs.npy -- (n-gram, language) matrix of log probabilities
+        charmap.npy -- normalized code point of each BMP character
+    Scoring a text is a vectorized lookup of its n-gram keys.
+    """
+    PROFILE_PATH_TEMPLATE = '{}/langid/{}'.format(get_user_cache(), '{}')
+
+    MAX_N = 3
+    # bits of a character in the n-gram keys
+    CHAR_BITS = 21
+    SPACE = ord(' ')
+    # frequency assigned to n-grams missing from a language profile
+    UNSEEN_FREQUENCY = 0.5
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = self.PROFILE_PATH_TEMPLATE.format(version('langdetect'))
+        if not os.path.exists(os.path.join(path, 'languages.json')):
+            self.compile_profiles(path)
+
+        with open(os.path.join(path, 'languages.json')) as fin:
+            self.languages: List[str] = json.load(fin)
+        self._ngrams = np.load(os.path.join(path, 'ngrams.npy'), mmap_mode='r')
+        self._log_probs = np.load(os.path.join(path, 'log_probs.npy'), mmap_mode='r')
+        self._charmap = np.load(os.path.join(path, 'charmap.npy'), mmap_mode='r')
+
+    @classmethod
+    def _get_key(cls, ngram: str) -> int:
+        key = 0
+        for idx, char in enumerate(ngram):
+            key |= ord(char) << (cls.CHAR_BITS * (cls.MAX_N - idx - 1))
+        return key
+
+    @classmethod
+    def compile_profiles(cls, path: str) -> None:
+        import langdetect
+        from langdetect.utils.ngram import NGram
+
+        logger.info(f'Compiling language profiles: {path}')
+        profile_dir = os.path.join(os.path.dirname(langdetect.__file__), 'profiles')
+        languages = sorted(os.listdir(profile_dir))
+        profiles = list()
+        for lang in languages:
+            with open(os.path.join(profile_dir, lang)) as fin:
+                profiles.append(json.load(fin))
+
+        ngrams = sorted(
+            {ngram for profile in profiles for ngram in profile['freq']},
+            key=cls._get_key,
+        )
+        ngram_idxs = {ngram: idx for idx, ngram in enumerate(ngrams)}
+        ngram_lengths = np.array([len(ngram) for ngram in ngrams])
+
+        log_probs = np.empty((len(ngrams), len(languages)), dtype=np.float16)
+        for lang_idx, profile in enumerate(profiles):
+            n_words = np.maximum(np.array(profile['n_words'], dtype=np.float64), 1)
+            column = np.log(cls.UNSEEN_FREQUENCY / n_words[ngram_lengths-1])
+            for ngram, freq in profile['freq'].items():
+                column[ngram_idxs[ngram]] = np.log(freq / n_words[len(ngram)-1])
+            log_probs[:, lang_idx] = column
+
+        charmap = np.array(
+            [ord(NGram.normalize(chr(code))) for code in range(0x10000)],
+            dtype=np.uint32,
+        )
+
+        # compile into a temporary directory and move it in place, so that
+        # concurrent processes never see partial profiles
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=parent)
+        try:
+            np.save(
+                os.path.join(tmpdir, 'ngrams.npy'),
+                np.array([cls._get_key(ngram) for ngram in ngrams], dtype=np.int64),
+            )
+            np.save(os.path.join(tmpdir, 'log_probs.npy'), log_probs)
+            np.save(os.path.join(tmpdir, 'charmap.npy'), charmap)
+            with open(os.path.join(tmpdir, 'languages.json'), 'w') as fout:
+                json.dump(languages, fout)
+            os.replace(tmpdir, path)
+        except OSError:
+            if not os.path.exists(os.path.join(path, 'languages.json')):
+                raise
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _get_text_keys(self, text: str) -> np.ndarray:
+        """
+        Returns the keys of the n-grams of the text as extracted by
+        langdetect: n-grams do not contain spaces, except at their start or
+        end.
+        """
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        charmap = self._charmap
+        is_bmp = codes < len(charmap)
+        codes = np.where(
+            is_bmp,
+            charmap[np.where(is_bmp, codes, 0)],
+            codes,
+        ).astype(np.int64)
+
+        # collapse runs of spaces and pad the text with spaces
+        codes = np.concatenate(([self.SPACE], codes, [self.SPACE]))
+        is_space = codes == self.SPACE
+        # drop spaces following a space
+        codes = codes[~np.concatenate(([False], is_space[1:] & is_space[:-1]))]
+        is_space = codes == self.SPACE
+
+        bits = self.CHAR_BITS
+        unigrams = codes[~is_space] << (2 * bits)
+        bigrams = (codes[:-1] << (2 * bits)) | (codes[1:] << bits)
+        trigrams = (
+            (codes[:-2] << (2 * bits)) | (codes[1:-1] << bits) | codes[2:]
+        )[~is_space[1:-1]]
+        return np.concatenate((unigrams, bigrams, trigrams))
+
+    def detect(self, text: str) -> Optional[str]:
+        """
+        Returns the most probable language of the text, or None if it has no
+        known n-grams.
+        """
+        keys = self._get_text_keys(text)
+        idxs = np.searchsorted(self._ngrams, keys)
+        is_valid = idxs < len(self._ngrams)
+        idxs = idxs[is_valid]
+        idxs = idxs[self._ngrams[idxs] == keys[is_valid]]
+        if len(idxs) == 0:
+            return None
+
+        idxs, counts = np.unique(idxs, return_counts=True)
+        scores = counts.astype(np.float32) @ self._log_probs[idxs].astype(np.float32)
+        return self.languages[int(np.argmax(scores))]
+
+
+def get_language_identifier() -> NGramLanguageIdentifier:
+    global _language_identifier
+    # only callers waiting for the identifier are blocked while the profiles
+    # are compiled
+    with _language_identifier_lock:
+        if _language_identifier is None:
+            _language_identifier = NGramLanguageIdentifier()
+    return _language_identifier
+
+
+def warm_up_language_identifier() -> threading.Thread:
+    """
+    Loads the language identifier, compiling its profiles on the first run,
+    on a background thread, so that the first detection does not wait for it.
+    """
+    def load():
+        try:
+            get_language_identifier()
+        except Exception as e:
+            logger.warning(f'Could not load the language identifier: {e}')
+
+    thread = threading.Thread(target=load, name='textLSP-langid', daemon=True)
+    thread.start()
+    return thread
+
+
+_language_identifier = None
+_language_identifier_lock = threading.Lock()
@@ -15,6 +15,8 @@ from lsprotocol.types import (
     TEXT_DOCUMENT_COMPLETION,
     SHUTDOWN,
     PublishDiagnosticsParams,
+    Position,
+    Range,
 )
 from lsprotocol.types import (
     DidOpenTextDocumentParams,
@@ -76,6 +78,9 @@ class TextLSPLanguageServer(LanguageServer):
     COMMAND_ANALYSE = 'analyse'
     COMMAND_CUSTOM = 'custom_command'
 
+    # params: {textDocument: {uri}, ranges: [Range]}
+    NOTIFICATION_VISIBLE_RANGES = 'textLSP/visibleRanges'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.settings = dict()
@@ -167,6 +172,23 @@ async def did_close(ls: TextLSPLanguageServer, params: DidCloseTextDocumentParam
     await ls.analyser_handler.did_close(params)
 
 
+@SERVER.feature(TextLSPLanguageServer.NOTIFICATION_VISIBLE_RANGES)
+async def did_change_visible_ranges(ls: TextLSPLanguageServer, params):
+    # custom notification params are not converted to lsprotocol types
+    cursor = getattr(params, 'cursor', None)
+    await ls.analyser_handler.did_change_visible_ranges(
+        params.textDocument.uri,
+        [
+            Range(
+                start=Position(line=r.start.line, character=r.start.character),
+                end=Position(line=r.end.line, character=r.end.character),
+            )
+            for r in params.ranges
+        ],
+        None if cursor is None else Position(line=cursor.line, character=cursor.character),
+    )
+
+
 @SERVER.feature(SHUTDOWN)
 def shutdown(ls: TextLSPLanguageServer, params: ShutdownRequest):
     ls.shutdown()
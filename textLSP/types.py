@@ -2,10 +2,16 @@ import re
 import bisect
 import enum
 import difflib
+import random
+import sys
 import uuid
 
-from typing import Optional, Any, List
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Optional, Any, List, Tuple
 from dataclasses import dataclass
+import numpy as np
 from sortedcontainers import SortedDict
 
 from lsprotocol.types import (
@@ -55,14 +61,30 @@ class OffsetPositionInterval():
 
 
 class OffsetPositionIntervalList():
+    """
+    Intervals stored column-wise in arrays of machine integers. Lookups by
+    index return plain tuples (see `get_interval_values()`), the
+    `OffsetPositionInterval` objects are only built by `get_interval()`.
+    """
+    TYPECODE = 'l'
+    # columns are serialized as little-endian 64-bit integers
+    SERIALIZED_TYPECODE = 'q'
+    COLUMNS = (
+        '_offset_start',
+        '_offset_end',
+        '_position_start_line',
+        '_position_start_character',
+        '_position_end_line',
+        '_position_end_character',
+    )
 
     def __init__(self):
-        self._offset_start = list()
-        self._offset_end = list()
-        self._position_start_line = list()
-        self._position_start_character = list()
-        self._position_end_line = list()
-        self._position_end_character = list()
+        self._offset_start = array(self.TYPECODE)
+        self._offset_end = array(self.TYPECODE)
+        self._position_start_line = array(self.TYPECODE)
+        self._position_start_character = array(self.TYPECODE)
+        self._position_end_line = array(self.TYPECODE)
+        self._position_end_character = array(self.TYPECODE)
         self._value = list()
 
     def add_interval_values(
@@ -94,6 +116,117 @@ class OffsetPositionIntervalList():
             interval.value,
         )
 
+    def splice(
+        self,
+        start: int,
+        end: int,
+        intervals: 'OffsetPositionIntervalList',
+        offset_shift: int = 0,
+        line_shift: int = 0,
+    ):
+        """
+        Replaces the intervals in the [start, end) index range with the given
+        ones and shifts the offsets and lines of the intervals after them.
+        """
+        def shifted(column, shift):
+            if shift == 0:
+                return column[end:]
+            return array(self.TYPECODE, [item + shift for item in column[end:]])
+
+        self._offset_start[start:] = intervals._offset_start + shifted(self._offset_start, offset_shift)
+        self._offset_end[start:] = intervals._offset_end + shifted(self._offset_end, offset_shift)
+        self._position_start_line[start:] = (
+            intervals._position_start_line
+            + shifted(self._position_start_line, line_shift)
+        )
+        self._position_start_character[start:] = (
+            intervals._position_start_character
+            + self._position_start_character[end:]
+        )
+        self._position_end_line[start:] = (
+            intervals._position_end_line
+            + shifted(self._position_end_line, line_shift)
+        )
+        self._position_end_character[start:] = (
+            intervals._position_end_character
+            + self._position_end_character[end:]
+        )
+        self._value[start:] = intervals._value + self._value[end:]
+
+    def __copy__(self) -> 'OffsetPositionIntervalList':
+        # splice() edits the columns in place, so they are not shared
+        res = type(self)()
+        for name in self.COLUMNS:
+            setattr(res, name, getattr(self, name)[:])
+        res._value = self._value[:]
+        return res
+
+    def to_bytes(self) -> bytes:
+        """
+        Returns the columns one after the other, in the order of `COLUMNS`.
+        The values are not serialized.
+        """
+        res = list()
+        item_size = array(self.SERIALIZED_TYPECODE).itemsize
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if column.itemsize != item_size or sys.byteorder != 'little':
+                column = array(self.SERIALIZED_TYPECODE, column)
+                if sys.byteorder != 'little':
+                    column.byteswap()
+            res.append(column.tobytes())
+        return b''.join(res)
+
+    @classmethod
+    def from_buffer(cls, buffer, length: int, offset: int = 0) -> 'OffsetPositionIntervalList':
+        """
+        Reads `length` intervals serialized by `to_bytes()` from the offset of
+        a buffer, e.g. a memory map. The values of the intervals are None.
+        """
+        res = cls()
+        item_size = array(cls.SERIALIZED_TYPECODE).itemsize
+        size = length * item_size
+        with memoryview(buffer) as view:
+            for name in cls.COLUMNS:
+                # read directly if the machine integers are the same
+                column = array(cls.TYPECODE)
+                serialized = column if column.itemsize == item_size else array(cls.SERIALIZED_TYPECODE)
+                serialized.frombytes(view[offset:offset+size])
+                if sys.byteorder != 'little':
+                    serialized.byteswap()
+                if serialized is not column:
+                    column.fromlist(serialized.tolist())
+                setattr(res, name, column)
+                offset += size
+        res._value = [None] * length
+        return res
+
+    def get_column_arrays(self) -> Tuple[np.ndarray, ...]:
+        """
+        Returns numpy views of the columns, in the order of `COLUMNS`. The
+        list cannot be modified while the views exist, so they should not be
+        kept.
+        """
+        return tuple(
+            np.frombuffer(getattr(self, name), dtype=np.dtype(self.TYPECODE))
+            for name in self.COLUMNS
+        )
+
+    def get_interval_values(self, idx: int) -> Tuple[int, int, int, int, int, int, Any]:
+        """
+        Returns the interval at the index in the order of the arguments of
+        `add_interval_values()`, i.e. with an inclusive end offset.
+        """
+        return (
+            self._offset_start[idx],
+            self._offset_end[idx],
+            self._position_start_line[idx],
+            self._position_start_character[idx],
+            self._position_end_line[idx],
+            self._position_end_character[idx],
+            self._value[idx],
+        )
+
     def get_interval(self, idx: int) -> OffsetPositionInterval:
         return OffsetPositionInterval(
             offset_interval=Interval(
@@ -128,30 +261,30 @@ class OffsetPositionIntervalList():
                 key=lambda x:x[1]
             )
         ]
-        self._offset_start = [
+        self._offset_start = array(self.TYPECODE, [
             self._offset_start[idx]
             for idx in indices
-        ]
-        self._offset_end = [
+        ])
+        self._offset_end = array(self.TYPECODE, [
             self._offset_end[idx]
             for idx in indices
-        ]
-        self._position_start_line = [
+        ])
+        self._position_start_line = array(self.TYPECODE, [
             self._position_start_line[idx]
             for idx in indices
-        ]
-        self._position_start_character = [
+        ])
+        self._position_start_character = array(self.TYPECODE, [
             self._position_start_character[idx]
             for idx in indices
-        ]
-        self._position_end_line = [
+        ])
+        self._position_end_line = array(self.TYPECODE, [
             self._position_end_line[idx]
             for idx in indices
-        ]
-        self._position_end_character = [
+        ])
+        self._position_end_character = array(self.TYPECODE, [
             self._position_end_character[idx]
             for idx in indices
-        ]
+        ])
 
     def get_idx_at_offset(self, offset: int) -> int:
         min_lst = self._offset_start
@@ -183,16 +316,18 @@ class OffsetPositionIntervalList():
         if position.line > self._position_end_line[idx]:
             return None if strict else length-1
 
-        lst = list()
-        i = idx
-        while self._position_end_line[i] == self._position_end_line[idx]:
-            lst.append(self._position_end_character[i])
-            i += 1
-            if i >= length:
-                break
-
-        idx2 = bisect.bisect_left(lst, position.character)
-        idx += idx2
+        # intervals ending in the same line are sorted by their end character
+        line_end_idx = bisect.bisect_right(
+            self._position_end_line,
+            self._position_end_line[idx],
+            idx,
+        )
+        idx = bisect.bisect_left(
+            self._position_end_character,
+            position.character,
+            idx,
+            line_end_idx,
+        )
 
         if idx == length:
             return None if strict else length-1
@@ -217,6 +352,662 @@ class OffsetPositionIntervalList():
         return self.get_interval(idx)
 
 
+class LineIndex():
+    """
+    Line start offsets of a text, for mapping between offsets and line
+    numbers with bisect. Lines are split the same way as
+    `str.splitlines(True)`.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.lines = tuple(text.splitlines(True))
+        # line_starts[i] is the offset of line i, the last item is the length
+        # of the text
+        self.line_starts = [0]
+        self.line_starts.extend(accumulate(len(line) for line in self.lines))
+        # utf-8 byte offsets of the lines, built when first needed
+        self._byte_starts = None
+        # number of lines which do not end with \n
+        self._unterminated = sum(not line.endswith('\n') for line in self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def line_start(self, line: int) -> int:
+        return self.line_starts[line]
+
+    @property
+    def has_irregular_line_breaks(self) -> bool:
+        """
+        Whether lines are broken by characters other than \n, i.e. the lines
+        are not the rows of tree-sitter.
+        """
+        unterminated = self._unterminated
+        if unterminated > 0 and self.lines[-1].splitlines() == [self.lines[-1]]:
+            # the last line without a line break
+            unterminated -= 1
+        return unterminated > 0
+
+    def _get_byte_starts(self) -> List[int]:
+        if self._byte_starts is None:
+            self._byte_starts = [0]
+            self._byte_starts.extend(
+                accumulate(len(line.encode('utf-8')) for line in self.lines)
+            )
+        return self._byte_starts
+
+    def byte_start(self, line: int) -> int:
+        return self._get_byte_starts()[line]
+
+    def byte_offset(self, offset: int) -> int:
+        """
+        Returns the utf-8 byte offset of the offset, only encoding the part of
+        its line before it.
+        """
+        line = self.line_at_offset(offset)
+        if line == len(self.lines):
+            return self._get_byte_starts()[line]
+        return self._get_byte_starts()[line] + len(
+            self.lines[line][:offset-self.line_starts[line]].encode('utf-8')
+        )
+
+    def line_at_offset(self, offset: int) -> int:
+        """
+        Returns the index of the line containing the offset or the number of
+        lines if the offset is not smaller than the length of the text.
+        """
+        return max(0, bisect.bisect_right(self.line_starts, offset) - 1)
+
+    def line_ending_at_offset(self, offset: int, min_line: int = 0) -> int:
+        """
+        Returns the index of the first line (not before `min_line`) whose end
+        is at or after the offset or the number of lines if there is no such
+        line.
+        """
+        return bisect.bisect_left(self.line_starts, offset, min_line+1) - 1
+
+    def update(self, text: str, start: int, end: int, length: int):
+        """
+        Updates the index after the [start, end) range of the old text was
+        replaced by `length` characters, resulting in `text`. Only the lines
+        around the edit are split again.
+        """
+        diff = length - (end - start)
+        # a line break before the edit might be merged with the new text
+        # (\r and \n), so the previous line is split again too
+        first = max(0, self.line_at_offset(start) - 1)
+        last = min(len(self.lines), self.line_at_offset(end) + 2)
+        region_start = self.line_starts[first]
+        lines = text[region_start:self.line_starts[last]+diff].splitlines(True)
+
+        self._unterminated += (
+            sum(not line.endswith('\n') for line in lines)
+            - sum(not line.endswith('\n') for line in self.lines[first:last])
+        )
+        if self._byte_starts is not None:
+            byte_starts = self._byte_starts
+            region_byte_starts = list(accumulate(
+                (len(line.encode('utf-8')) for line in lines),
+                initial=byte_starts[first],
+            ))
+            byte_diff = region_byte_starts[-1] - byte_starts[last]
+            byte_starts[first:] = (
+                region_byte_starts
+                + [offset + byte_diff for offset in byte_starts[last+1:]]
+            )
+
+        self.lines = self.lines[:first] + tuple(lines) + self.lines[last:]
+        self.line_starts[first:] = (
+            list(accumulate((len(line) for line in lines), initial=region_start))
+            + [offset + diff for offset in self.line_starts[last+1:]]
+        )
+        self.text = text
+
+
+class TextBoundaryIndex():
+    """
+    Sorted offsets of paragraph and sentence boundaries of a text for
+    answering paragraph and sentence queries with bisect. The offsets are
+    computed lazily and can be updated after an edit by re-scanning only the
+    edited region.
+    """
+    # (pattern, match width) pairs, the width being the number of characters
+    # that decide whether there is a match at a given offset
+    PARAGRAPH_BREAK = (re.compile('\n(?=\n)'), 2)
+    SENTENCE_BREAK = (re.compile('[.!?](?=[ \n])'), 2)
+    SENTENCE_END = (re.compile('[.!?]'), 1)
+
+    def __init__(self, text: str):
+        self.text = text
+        self._offsets = dict()
+
+    def _get_offsets(self, pattern) -> List[int]:
+        if pattern not in self._offsets:
+            self._offsets[pattern] = [
+                match.start()
+                for match in pattern[0].finditer(self.text)
+            ]
+        return self._offsets[pattern]
+
+    def update(self, text: str, start: int, end: int, length: int):
+        """
+        Updates the index after the [start, end) range of the old text was
+        replaced by `length` characters, resulting in `text`.
+        """
+        diff = length - (end - start)
+        new_end = start + length
+        for pattern, offsets in self._offsets.items():
+            regex, width = pattern
+            left = bisect.bisect_right(offsets, start - width)
+            right = bisect.bisect_left(offsets, end)
+
+            middle = list()
+            for match in regex.finditer(text, max(0, start - width + 1)):
+                if match.start() >= new_end:
+                    break
+                middle.append(match.start())
+
+            offsets[left:] = middle + [offset + diff for offset in offsets[right:]]
+
+        self.text = text
+
+    def paragraph_at_offset(self, offset: int, min_length=0, min_offset=0) -> Interval:
+        """
+        Returns the paragraph containing the offset as defined by
+        `BaseDocument.paragraph_at_offset()`.
+        """
+        text = self.text
+        last = len(text) - 1
+        breaks = self._get_offsets(self.PARAGRAPH_BREAK)
+
+        assert offset >= 0
+        end = min(offset, last)
+        if end < 0:
+            return Interval(end, 1)
+
+        # paragraphs start after two newlines or at the second one of them
+        idx = bisect.bisect_right(breaks, end - 1) - 1
+        if idx < 0:
+            start = 0
+        elif breaks[idx] == end - 1:
+            start = end
+        else:
+            start = breaks[idx] + 2
+        if start == 0 and end > 0 and text[0] == '\n':
+            start = 1
+
+        if (start == 0 and text[0] == '\n') or self._is_paragraph_break(breaks, start - 1):
+            # empty line
+            if end < last and (end - start + 1 < min_length or end <= min_offset):
+                end = min(last, max(end, start + min_length - 1, min_offset + 1))
+            return Interval(start, end - start + 1)
+
+        while True:
+            idx = bisect.bisect_left(breaks, end)
+            end = breaks[idx] if idx < len(breaks) else last
+            if end < last and (end - start + 1 < min_length or end <= min_offset):
+                end += 1
+            else:
+                break
+
+        return Interval(start, end - start + 1)
+
+    @staticmethod
+    def _is_paragraph_break(breaks: List[int], offset: int) -> bool:
+        idx = bisect.bisect_left(breaks, offset)
+        return idx < len(breaks) and breaks[idx] == offset
+
+    def sentence_at_offset(self, offset: int, min_length=0) -> Interval:
+        """
+        Returns the sentence containing the offset as defined by
+        `BaseDocument.sentence_at_offset()`.
+        """
+        last = len(self.text) - 1
+        assert offset >= 0
+        assert offset <= last
+
+        breaks = self._get_offsets(self.SENTENCE_BREAK)
+        idx = bisect.bisect_right(breaks, offset - 2) - 1
+        start = breaks[idx] + 2 if idx >= 0 else 0
+
+        end = offset
+        if end < last:
+            ends = self._get_offsets(self.SENTENCE_END)
+            idx = bisect.bisect_left(ends, max(offset, start + min_length - 1, 1) - 1)
+            end = min(last, ends[idx] + 1) if idx < len(ends) else last
+
+        return Interval(start, end - start + 1)
+
+
+class _RopeNode():
+    __slots__ = (
+        'text',
+        'priority',
+        'left',
+        'right',
+        'length',
+        'byte_length',
+        'newlines',
+        'irregular_newlines',
+    )
+
+    def __init__(self, text: str, priority: float = None):
+        self.text = text
+        self.priority = random.random() if priority is None else priority
+        self.left = None
+        self.right = None
+        self.update()
+
+    def update(self):
+        text = self.text
+        self.length = len(text)
+        self.byte_length = len(text.encode('utf-8'))
+        self.newlines = text.count('\n')
+        self.irregular_newlines = sum(
+            text.count(char)
+            for char in Rope.IRREGULAR_LINE_BREAKS
+        ) - text.count('\r\n')
+        for child in (self.left, self.right):
+            if child is not None:
+                self.length += child.length
+                self.byte_length += child.byte_length
+                self.newlines += child.newlines
+                self.irregular_newlines += child.irregular_newlines
+
+
+class Rope():
+    """
+    Text stored as a treap of chunks. Edits cost O(log n) plus the size of the
+    edited chunks, while the full string and its utf-8 encoding are only
+    materialised on request and cached until the next edit.
+    """
+    CHUNK_SIZE = 1024
+    # characters other than \n that str.splitlines() considers line breaks,
+    # \r is regular if followed by \n in the same chunk
+    IRREGULAR_LINE_BREAKS = '\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+    def __init__(self, text: str = ''):
+        self._root = self._build(text)
+        self._text = text
+        self._bytes = None
+
+    @classmethod
+    def _build(cls, text: str) -> _RopeNode:
+        root = None
+        start = 0
+        while start < len(text):
+            end = start + cls.CHUNK_SIZE
+            # \r\n line breaks are kept in one chunk
+            if end < len(text) and text[end-1] == '\r' and text[end] == '\n':
+                end += 1
+            root = cls._merge(root, _RopeNode(text[start:end]))
+            start = end
+        return root
+
+    @staticmethod
+    def _merge(left: _RopeNode, right: _RopeNode) -> _RopeNode:
+        if left is None:
+            return right
+        if right is None:
+            return left
+
+        if left.priority > right.priority:
+            left.right = Rope._merge(left.right, right)
+            left.update()
+            return left
+
+        right.left = Rope._merge(left, right.left)
+        right.update()
+        return right
+
+    @staticmethod
+    def _split(node: _RopeNode, offset: int):
+        """
+        Splits the tree into the first `offset` characters and the rest.
+        Offsets must be at chunk boundaries.
+        """
+        if node is None:
+            return None, None
+
+        left_length = node.left.length if node.left is not None else 0
+        if offset <= left_length:
+            left, right = Rope._split(node.left, offset)
+            node.left = right
+            node.update()
+            return left, node
+
+        left, right = Rope._split(
+            node.right,
+            offset - left_length - len(node.text),
+        )
+        node.right = left
+        node.update()
+        return node, right
+
+    def _chunk_span(self, offset: int):
+        """
+        Returns the start and end offsets of the chunk containing the offset or
+        the last chunk if the offset is at the end of the text.
+        """
+        node = self._root
+        base = 0
+        last_span = (0, 0)
+        while node is not None:
+            left_length = node.left.length if node.left is not None else 0
+            chunk_start = base + left_length
+            chunk_end = chunk_start + len(node.text)
+            if offset < chunk_start:
+                node = node.left
+            elif offset < chunk_end:
+                return chunk_start, chunk_end
+            else:
+                last_span = (chunk_start, chunk_end)
+                base = chunk_end
+                node = node.right
+
+        return last_span
+
+    @staticmethod
+    def _iter_chunks(node: _RopeNode):
+        stack = list()
+        while len(stack) > 0 or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                yield node.text
+                node = node.right
+
+    def replace(self, start: int, end: int, text: str):
+        """
+        Replaces the characters between the `start` and `end` offsets with
+        `text`.
+        """
+        length = len(self)
+        assert 0 <= start <= end <= length, f'{start}, {end}, {length}'
+
+        chunk_start, _ = self._chunk_span(start)
+        _, chunk_end = self._chunk_span(max(start, end-1))
+        left, rest = self._split(self._root, chunk_start)
+        edited, right = self._split(rest, chunk_end - chunk_start)
+
+        edited = ''.join(self._iter_chunks(edited))
+        edited = (
+            edited[:start-chunk_start]
+            + text
+            + edited[end-chunk_start:]
+        )
+
+        self._root = self._merge(self._merge(left, self._build(edited)), right)
+        self._text = None
+        self._bytes = None
+
+    def __len__(self):
+        return self._root.length if self._root is not None else 0
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = ''.join(self._iter_chunks(self._root))
+        return self._text
+
+    def to_bytes(self) -> bytes:
+        if self._bytes is None:
+            self._bytes = self.text.encode('utf-8')
+        return self._bytes
+
+    def __str__(self):
+        return self.text
+
+    def slice(self, start: int, end: int) -> str:
+        if self._text is not None:
+            return self._text[start:end]
+
+        res = list()
+        self._collect(self._root, 0, start, end, res)
+        return ''.join(res)
+
+    @staticmethod
+    def _collect(node: _RopeNode, base: int, start: int, end: int, res: List[str]):
+        if node is None or base >= end or base + node.length <= start:
+            return
+
+        left_length = node.left.length if node.left is not None else 0
+        Rope._collect(node.left, base, start, end, res)
+        chunk_start = base + left_length
+        chunk_end = chunk_start + len(node.text)
+        if chunk_start < end and chunk_end > start:
+            res.append(node.text[max(0, start-chunk_start):end-chunk_start])
+        Rope._collect(node.right, chunk_end, start, end, res)
+
+    def byte_offset(self, offset: int) -> int:
+        """
+        Returns the utf-8 byte offset of the given character offset.
+        """
+        if self._root is None or self._root.byte_length == self._root.length:
+            # ASCII only
+            return offset
+
+        node = self._root
+        res = 0
+        while node is not None:
+            left_length = node.left.length if node.left is not None else 0
+            left_bytes = node.left.byte_length if node.left is not None else 0
+            if offset <= left_length:
+                node = node.left
+                continue
+
+            res += left_bytes
+            offset -= left_length
+            if offset <= len(node.text):
+                return res + len(node.text[:offset].encode('utf-8'))
+
+            res += len(node.text.encode('utf-8'))
+            offset -= len(node.text)
+            node = node.right
+
+        return res
+
+    @property
+    def has_irregular_line_breaks(self) -> bool:
+        return self._root is not None and self._root.irregular_newlines > 0
+
+    @property
+    def newlines(self) -> int:
+        return self._root.newlines if self._root is not None else 0
+
+    def newline_offset(self, idx: int) -> int:
+        """
+        Returns the offset of the `idx`-th (zero based) newline character.
+        """
+        node = self._root
+        base = 0
+        while node is not None:
+            left_newlines = node.left.newlines if node.left is not None else 0
+            left_length = node.left.length if node.left is not None else 0
+            if idx < left_newlines:
+                node = node.left
+                continue
+
+            idx -= left_newlines
+            base += left_length
+            chunk_newlines = node.text.count('\n')
+            if idx < chunk_newlines:
+                pos = -1
+                for _ in range(idx+1):
+                    pos = node.text.index('\n', pos+1)
+                return base + pos
+
+            idx -= chunk_newlines
+            base += len(node.text)
+            node = node.right
+
+        raise IndexError(idx)
+
+
+class RopeLineIndex():
+    """
+    Provides the interface of `LineIndex` on top of a `Rope` without
+    materialising its text. Only \\n line breaks are handled, so it should not
+    be used for ropes with `has_irregular_line_breaks`.
+    """
+
+    def __init__(self, rope: Rope):
+        self.rope = rope
+        length = len(rope)
+        self._num_lines = rope.newlines
+        if length > 0 and rope.slice(length-1, length) != '\n':
+            self._num_lines += 1
+
+    @property
+    def lines(self):
+        return self
+
+    @property
+    def text(self) -> str:
+        return self.rope.text
+
+    def __len__(self):
+        return self._num_lines
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += self._num_lines
+        if not 0 <= idx < self._num_lines:
+            raise IndexError(idx)
+        return self.rope.slice(self.line_start(idx), self.line_start(idx+1))
+
+    def line_start(self, line: int) -> int:
+        if line == 0:
+            return 0
+        if line > self.rope.newlines:
+            return len(self.rope)
+        return self.rope.newline_offset(line-1) + 1
+
+
+class _SpanNode():
+    __slots__ = (
+        'start',
+        'end',
+        'priority',
+        'left',
+        'right',
+        'shift',
+    )
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        # shift of the offsets which was not applied to the children yet
+        self.shift = 0
+
+    def add_shift(self, shift: int):
+        self.start += shift
+        self.end += shift
+        self.shift += shift
+
+    def push(self):
+        if self.shift != 0:
+            for child in (self.left, self.right):
+                if child is not None:
+                    child.add_shift(self.shift)
+            self.shift = 0
+
+
+class SpanTree():
+    """
+    Sorted, disjoint [start, end) spans stored as a treap. Replacing the spans
+    around a range and shifting the spans after it costs O(log n), since the
+    shifts are applied lazily.
+    """
+
+    def __init__(self):
+        self._root = None
+
+    @staticmethod
+    def _merge(left: _SpanNode, right: _SpanNode) -> _SpanNode:
+        if left is None:
+            return right
+        if right is None:
+            return left
+
+        if left.priority > right.priority:
+            left.push()
+            left.right = SpanTree._merge(left.right, right)
+            return left
+
+        right.push()
+        right.left = SpanTree._merge(left, right.left)
+        return right
+
+    @staticmethod
+    def _split(node: _SpanNode, offset: int, by_end=False):
+        """
+        Splits the tree into the spans starting, or ending if `by_end`, before
+        the offset and the rest.
+        """
+        if node is None:
+            return None, None
+
+        node.push()
+        if (node.end if by_end else node.start) < offset:
+            left, right = SpanTree._split(node.right, offset, by_end)
+            node.right = left
+            return node, right
+
+        left, right = SpanTree._split(node.left, offset, by_end)
+        node.left = right
+        return left, node
+
+    @staticmethod
+    def _edge(node: _SpanNode, last=False) -> _SpanNode:
+        while True:
+            node.push()
+            child = node.right if last else node.left
+            if child is None:
+                return node
+            node = child
+
+    def replace(self, start: int, end: int, span_start: int, span_end: int, shift: int):
+        """
+        Replaces the spans overlapping or touching the [start, end] range with
+        one covering them and [span_start, span_end). The spans after the
+        range are shifted, as is the end of a replaced span ending after it.
+        """
+        left, rest = self._split(self._root, start, True)
+        middle, right = self._split(rest, end+1)
+        if middle is not None:
+            span_start = min(span_start, self._edge(middle).start)
+            last_end = self._edge(middle, True).end
+            if last_end > end:
+                span_end = max(span_end, last_end+shift)
+
+        if right is not None:
+            right.add_shift(shift)
+        self._root = self._merge(
+            self._merge(left, _SpanNode(span_start, span_end)),
+            right,
+        )
+
+    def __iter__(self):
+        stack = list()
+        node = self._root
+        while len(stack) > 0 or node is not None:
+            if node is not None:
+                node.push()
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                yield node.start, node.end
+                node = node.right
+
+
 class PositionDict():
 
     def __init__(self):
@@ -299,6 +1090,45 @@ class PositionDict():
         return iter(self._positions.values())
 
 
+class LRUCache():
+    """
+    Mapping of at most `max_size` items, which evicts the least recently used
+    ones. Counts the hits and misses of `get()`.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
 @enum.unique
 class TextLSPCodeActionKind(str, enum.Enum):
     AcceptSuggestion = CodeActionKind.QuickFix + '.accept_suggestion'
@@ -60,6 +60,34 @@ def synchronized(wrapped):
     return _wrapper
 
 
+INSTANCE_LOCK_ATTRIBUTE = '_instance_lock'
+
+
+def get_instance_lock(obj) -> RLock:
+    """
+    Returns the lock of the object used by `synchronized_method`, creating
+    it on first use.
+    """
+    lock = obj.__dict__.get(INSTANCE_LOCK_ATTRIBUTE)
+    if lock is None:
+        # setdefault is atomic, so concurrent callers get the same lock
+        lock = obj.__dict__.setdefault(INSTANCE_LOCK_ATTRIBUTE, RLock())
+    return lock
+
+
+def synchronized_method(wrapped):
+    """
+    Like `synchronized`, but the lock belongs to the instance the method is
+    called on, so calls on different objects do not block each other. All
+    synchronized methods of an object share its lock.
+    """
+    @wraps(wrapped)
+    def _wrapper(self, *args, **kwargs):
+        with get_instance_lock(self):
+            return wrapped(self, *args, **kwargs)
+    return _wrapper
+
+
 def git_clone(url, dir, branch=None):
     repo = Repo.clone_from(url=url, to_path=dir)
     if branch is not None:
@@ -64,6 +64,6 @@ class TextLSPWorkspace(Workspace):
         text_doc: VersionedTextDocumentIdentifier,
         change: TextDocumentContentChangeEvent
     ):
+        super().update_text_document(text_doc, change)
         doc = self._text_documents[text_doc.uri]
         self.analyser_handler.update_document(doc, change)
-        super().update_text_document(text_doc, change)